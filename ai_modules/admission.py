@@ -0,0 +1,136 @@
+# ai_modules/admission.py
+"""
+Admission control cho phiên mới (/offer) và /api/upload_wav.
+
+Chỉ áp dụng khi MỞ phiên mới; lượt của phiên đã được nhận luôn đi thẳng
+vào pipeline → phiên đang chạy được ưu tiên. Phiên mới bị từ chối (503 +
+Retry-After) hoặc chờ tối đa ADMISSION_QUEUE_TIMEOUT_SEC khi:
+  - số phiên đồng thời >= ADMISSION_MAX_SESSIONS
+  - hàng đợi stage ASR >= ADMISSION_MAX_ASR_QUEUE
+  - p95 (chờ + xử lý) gần đây của stage ADMISSION_P95_STAGE > ADMISSION_MAX_P95_MS
+Giữ tải quanh điểm bão hoà thay vì để mọi người dùng cùng chậm tới timeout.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+ADMISSION_MAX_SESSIONS = int(os.getenv("ADMISSION_MAX_SESSIONS", "50"))
+ADMISSION_MAX_ASR_QUEUE = int(os.getenv("ADMISSION_MAX_ASR_QUEUE", "16"))
+ADMISSION_P95_STAGE = os.getenv("ADMISSION_P95_STAGE", "asr")
+ADMISSION_MAX_P95_MS = float(os.getenv("ADMISSION_MAX_P95_MS", "8000"))
+ADMISSION_P95_WINDOW_SEC = float(os.getenv("ADMISSION_P95_WINDOW_SEC", "30"))
+ADMISSION_QUEUE_TIMEOUT_SEC = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SEC", "0"))
+ADMISSION_RETRY_AFTER_SEC = int(os.getenv("ADMISSION_RETRY_AFTER_SEC", "2"))
+
+_POLL_INTERVAL_SEC = 0.05
+
+
+class AdmissionDecision:
+    __slots__ = ("admitted", "reason", "retry_after", "waited_ms")
+
+    def __init__(self, admitted: bool, reason: Optional[str] = None,
+                 retry_after: int = 0, waited_ms: float = 0.0):
+        self.admitted = admitted
+        self.reason = reason
+        self.retry_after = retry_after
+        self.waited_ms = waited_ms
+
+
+class AdmissionController:
+
+    def __init__(self, pipeline, live_sessions: Callable[[], int],
+                 max_sessions: int = ADMISSION_MAX_SESSIONS,
+                 max_asr_queue: int = ADMISSION_MAX_ASR_QUEUE,
+                 p95_stage: str = ADMISSION_P95_STAGE,
+                 max_p95_ms: float = ADMISSION_MAX_P95_MS,
+                 p95_window_sec: float = ADMISSION_P95_WINDOW_SEC,
+                 queue_timeout_sec: float = ADMISSION_QUEUE_TIMEOUT_SEC,
+                 retry_after_sec: int = ADMISSION_RETRY_AFTER_SEC,
+                 log_callback: Callable = print):
+        self.pipeline = pipeline
+        self.live_sessions = live_sessions
+        self.max_sessions = max_sessions
+        self.max_asr_queue = max_asr_queue
+        self.p95_stage = p95_stage
+        self.max_p95_ms = max_p95_ms
+        self.p95_window_sec = p95_window_sec
+        self.queue_timeout_sec = queue_timeout_sec
+        self.retry_after_sec = retry_after_sec
+        self._log = log_callback
+
+        self._lock = threading.Lock()
+        self.in_flight_uploads = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+
+    # ========================================================
+    # KIỂM TRA TẢI
+    # ========================================================
+    def overload_reason(self) -> Optional[str]:
+        if self.live_sessions() + self.in_flight_uploads >= self.max_sessions:
+            return "max_sessions"
+        if self.pipeline.queue_depth("asr") >= self.max_asr_queue:
+            return "asr_queue"
+        stage = self.pipeline.stage(self.p95_stage)
+        if stage is not None and stage.recent_p95_ms(self.p95_window_sec) > self.max_p95_ms:
+            return "p95_latency"
+        return None
+
+    def _retry_after(self) -> int:
+        """Ước tính thời gian hàng đợi ASR rút bớt (tối thiểu retry_after_sec)."""
+        asr = self.pipeline.stage("asr")
+        if asr is None or not asr.processed:
+            return self.retry_after_sec
+        drain_sec = self.pipeline.queue_depth("asr") * (asr.total_ms / asr.processed) / 1000 / asr.workers
+        return max(self.retry_after_sec, int(math.ceil(drain_sec)))
+
+    async def admit(self) -> AdmissionDecision:
+        """Nhận phiên mới ngay, chờ trong queue_timeout_sec, hoặc từ chối."""
+        started = time.perf_counter()
+        deadline = started + self.queue_timeout_sec
+        reason = self.overload_reason()
+        while reason is not None and time.perf_counter() < deadline:
+            await asyncio.sleep(_POLL_INTERVAL_SEC)
+            reason = self.overload_reason()
+
+        waited_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            if reason is None:
+                self.admitted += 1
+                return AdmissionDecision(True, waited_ms=waited_ms)
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+        retry_after = self._retry_after()
+        self._log(f"[Admission] 🚫 Từ chối phiên mới ({reason}), Retry-After={retry_after}s")
+        return AdmissionDecision(False, reason, retry_after, waited_ms)
+
+    # Upload là phiên 1 lượt → giữ slot tới khi trả kết quả
+    def upload_started(self):
+        with self._lock:
+            self.in_flight_uploads += 1
+
+    def upload_finished(self):
+        with self._lock:
+            self.in_flight_uploads -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        stage = self.pipeline.stage(self.p95_stage)
+        with self._lock:
+            return {
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "live_sessions": self.live_sessions(),
+                "in_flight_uploads": self.in_flight_uploads,
+                "asr_queue_depth": self.pipeline.queue_depth("asr"),
+                "p95_stage": self.p95_stage,
+                "recent_p95_ms": round(stage.recent_p95_ms(self.p95_window_sec), 2) if stage else 0.0,
+                "limits": {
+                    "max_sessions": self.max_sessions,
+                    "max_asr_queue": self.max_asr_queue,
+                    "max_p95_ms": self.max_p95_ms,
+                    "queue_timeout_sec": self.queue_timeout_sec,
+                },
+            }
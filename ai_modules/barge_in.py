@@ -0,0 +1,183 @@
+# ai_modules/barge_in.py
+"""
+Barge-in: người dùng nói chen khi bot đang trả lời.
+
+Recorder đưa mọi frame PCM16 16kHz của track đầu vào cho BargeInController
+(kể cả khi không ghi âm). Chỉ khi bot đã bắt đầu trả lời bằng giọng (track
+đang phát, hoặc lượt đã gửi mảnh audio đầu tiên), VAD năng lượng xác nhận
+giọng nói (>= BARGE_IN_MIN_SPEECH_MS trên ngưỡng) → huỷ token của lượt hiện tại, xoá audio chưa phát trên BotAudioTrack và
+báo cho server bắt đầu lượt mới.
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+from core.cancellation import CancellationToken
+
+BARGE_IN_ENABLED = os.getenv("BARGE_IN_ENABLED", "1") == "1"
+BARGE_IN_THRESHOLD_DBFS = float(os.getenv("BARGE_IN_THRESHOLD_DBFS", "-35"))
+BARGE_IN_MIN_SPEECH_MS = float(os.getenv("BARGE_IN_MIN_SPEECH_MS", "200"))
+# Khoảng lặng ngắn (ms) vẫn coi là cùng một đoạn nói
+BARGE_IN_GAP_MS = float(os.getenv("BARGE_IN_GAP_MS", "60"))
+
+
+def frame_dbfs(pcm: bytes) -> float:
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    if samples.size == 0:
+        return -120.0
+    rms = float(np.sqrt(np.mean(samples * samples)))
+    return 20.0 * np.log10(rms / 32768.0 + 1e-9)
+
+
+class BargeInStats:
+    """Thống kê barge-in dùng chung toàn process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.interruptions = 0
+        self.latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.dropped_audio_sec = 0.0
+        self.cancelled_turns = 0
+        self.saved_ms = 0.0
+
+    def record_interrupt(self, latency_ms: float, dropped_audio_sec: float):
+        with self._lock:
+            self.interruptions += 1
+            self.latency_ms += latency_ms
+            self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+            self.dropped_audio_sec += dropped_audio_sec
+
+    def record_cancelled(self, saved_ms: float):
+        with self._lock:
+            self.cancelled_turns += 1
+            self.saved_ms += saved_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.interruptions
+            return {
+                "interruptions": n,
+                "latency_ms_avg": round(self.latency_ms / n, 2) if n else 0.0,
+                "latency_ms_max": round(self.max_latency_ms, 2),
+                "dropped_audio_sec_total": round(self.dropped_audio_sec, 2),
+                "cancelled_turns": self.cancelled_turns,
+                "saved_compute_ms_total": round(self.saved_ms, 2),
+            }
+
+
+BARGE_IN_STATS = BargeInStats()
+
+
+class BargeInController:
+    """
+    Một instance cho mỗi phiên WebRTC.
+
+    begin_turn() / end_turn(token)  ← vòng đời lượt trong pipeline
+    audio_started(token)            ← mảnh audio đầu tiên của lượt được gửi đi
+    feed(pcm)                       ← recorder gọi với mỗi frame đầu vào
+    on_interrupt(cb)                ← cb(latency_ms) khi barge-in xảy ra
+    """
+
+    def __init__(self, bot_track=None, log_callback=print, enabled: bool = BARGE_IN_ENABLED,
+                 threshold_dbfs: float = BARGE_IN_THRESHOLD_DBFS,
+                 min_speech_ms: float = BARGE_IN_MIN_SPEECH_MS,
+                 stats: BargeInStats = BARGE_IN_STATS):
+        self.bot_track = bot_track
+        self._log = log_callback
+        self.enabled = enabled
+        self.threshold_dbfs = threshold_dbfs
+        self.min_speech_ms = min_speech_ms
+        self.stats = stats
+
+        self._token: Optional[CancellationToken] = None
+        self._speaking = False
+        self._on_interrupt: Optional[Callable[[float], None]] = None
+        self._speech_ms = 0.0
+        self._gap_ms = 0.0
+        self._onset: Optional[float] = None
+
+    def on_interrupt(self, callback: Callable[[float], None]):
+        self._on_interrupt = callback
+
+    # ========================================================
+    # VÒNG ĐỜI LƯỢT
+    # ========================================================
+    def begin_turn(self) -> CancellationToken:
+        self._token = CancellationToken()
+        self._speaking = False
+        return self._token
+
+    def audio_started(self, token: Optional[CancellationToken]):
+        """Lượt `token` đã gửi audio cho client → từ giờ người dùng nói là nói chen."""
+        if token is not None and self._token is token:
+            self._speaking = True
+
+    def end_turn(self, token: CancellationToken):
+        if self._token is token:
+            self._token = None
+            self._speaking = False
+
+    def cancel_turn(self, reason: str = "cancelled") -> bool:
+        """Huỷ lượt đang xử lý không qua VAD (phiên đóng...)."""
+        return self._token is not None and self._token.cancel(reason)
+
+    @property
+    def armed(self) -> bool:
+        """
+        Chỉ nghe barge-in khi bot đang nói: track đang phát, hoặc lượt đang xử lý
+        đã gửi audio (DataChannel). Lượt còn ở ASR / NLU / DM chưa có tiếng bot →
+        tiếng nói tiếp / tiếng ồn ngay sau khi dừng ghi không huỷ lượt của chính người dùng.
+        """
+        if not self.enabled:
+            return False
+        speaking = self._speaking and self._token is not None and not self._token.cancelled
+        playing = self.bot_track is not None and self.bot_track.is_playing
+        return speaking or playing
+
+    # ========================================================
+    # VAD NĂNG LƯỢNG
+    # ========================================================
+    def feed(self, pcm: bytes, sample_rate: int = 16000):
+        if not self.armed:
+            self._speech_ms = self._gap_ms = 0.0
+            self._onset = None
+            return
+
+        frame_ms = len(pcm) / 2 / sample_rate * 1000
+        if frame_dbfs(pcm) >= self.threshold_dbfs:
+            if self._onset is None:
+                self._onset = time.perf_counter()
+            self._speech_ms += frame_ms
+            self._gap_ms = 0.0
+        elif self._onset is not None:
+            self._gap_ms += frame_ms
+            if self._gap_ms > BARGE_IN_GAP_MS:
+                self._speech_ms = self._gap_ms = 0.0
+                self._onset = None
+
+        if self._speech_ms >= self.min_speech_ms:
+            self._interrupt()
+
+    def _interrupt(self):
+        onset = self._onset or time.perf_counter()
+        self._speech_ms = self._gap_ms = 0.0
+        self._onset = None
+
+        if self._token is not None:
+            self._token.cancel("barge_in")
+        dropped_sec = 0.0
+        if self.bot_track is not None:
+            dropped_sec = self.bot_track.clear() / 2 / self.bot_track.sample_rate
+
+        latency_ms = (time.perf_counter() - onset) * 1000
+        self.stats.record_interrupt(latency_ms, dropped_sec)
+        self._log(
+            f"[BargeIn] ✋ Người dùng nói chen → dừng phát ({dropped_sec:.1f}s audio bỏ), "
+            f"latency={latency_ms:.0f}ms"
+        )
+        if self._on_interrupt:
+            self._on_interrupt(latency_ms)
@@ -0,0 +1,107 @@
+# ai_modules/bot_audio_track.py
+"""
+Audio track gửi giọng bot về client qua chính RTCPeerConnection đang mở.
+
+TTS đẩy PCM16 mono vào buffer của track (push); aiortc gọi recv() để lấy
+frame 20ms. recv() tự điều nhịp theo đồng hồ thực (pts tăng đều), nên
+dù TTS trả từng câu không đều nhau, phía client vẫn nhận luồng đều, không
+giật. Hết dữ liệu → phát frame im lặng để giữ nhịp RTP.
+"""
+import asyncio
+import fractions
+import time
+from typing import Callable, Optional
+
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+BOT_AUDIO_FRAME_MS = 20
+# Giới hạn buffer (giây audio) để một phiên không giữ quá nhiều bộ nhớ
+BOT_AUDIO_MAX_BUFFER_SEC = 60
+
+
+class BotAudioTrack(MediaStreamTrack):
+    kind = "audio"
+
+    def __init__(self, sample_rate: int = 16000, frame_ms: int = BOT_AUDIO_FRAME_MS,
+                 max_buffer_sec: float = BOT_AUDIO_MAX_BUFFER_SEC, log_callback: Callable = print):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self._samples_per_frame = sample_rate * frame_ms // 1000
+        self._frame_bytes = self._samples_per_frame * 2
+        self._max_buffer_bytes = int(max_buffer_sec * sample_rate) * 2
+        self._time_base = fractions.Fraction(1, sample_rate)
+        self._log = log_callback
+
+        self._buffer = bytearray()
+        self._start: Optional[float] = None
+        self._pts = 0
+        self._was_playing = False
+        self._on_playback_end: Optional[Callable[[], None]] = None
+
+    # ========================================================
+    # PHÍA TTS
+    # ========================================================
+    def push(self, pcm: bytes):
+        """Thêm PCM16 mono (đúng sample_rate của track) vào hàng phát."""
+        if not pcm:
+            return
+        room = self._max_buffer_bytes - len(self._buffer)
+        if room <= 0:
+            self._log("[BotAudioTrack] ⚠️ Buffer đầy → bỏ mảnh audio mới")
+            return
+        self._buffer.extend(pcm[:room - (room % 2)])
+
+    def clear(self) -> int:
+        """Dừng phát ngay (barge-in). Trả về số bytes chưa phát bị bỏ."""
+        dropped = len(self._buffer)
+        self._buffer.clear()
+        return dropped
+
+    @property
+    def is_playing(self) -> bool:
+        return len(self._buffer) > 0
+
+    @property
+    def buffered_seconds(self) -> float:
+        return len(self._buffer) / 2 / self.sample_rate
+
+    def on_playback_end(self, callback: Callable[[], None]):
+        self._on_playback_end = callback
+
+    # ========================================================
+    # PHÍA AIORTC
+    # ========================================================
+    async def recv(self) -> av.AudioFrame:
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        # Điều nhịp theo thời gian thực: frame thứ n phát tại start + n*20ms
+        if self._start is None:
+            self._start = time.time()
+            self._pts = 0
+        else:
+            self._pts += self._samples_per_frame
+            wait = self._start + self._pts / self.sample_rate - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        if len(self._buffer) >= self._frame_bytes:
+            chunk = bytes(self._buffer[:self._frame_bytes])
+            del self._buffer[:self._frame_bytes]
+        else:
+            chunk = bytes(self._buffer) + b"\x00" * (self._frame_bytes - len(self._buffer))
+            self._buffer.clear()
+
+        playing = len(self._buffer) > 0
+        if self._was_playing and not playing and self._on_playback_end:
+            self._on_playback_end()
+        self._was_playing = playing
+
+        frame = av.AudioFrame(format="s16", layout="mono", samples=self._samples_per_frame)
+        frame.planes[0].update(chunk)
+        frame.sample_rate = self.sample_rate
+        frame.pts = self._pts
+        frame.time_base = self._time_base
+        return frame
@@ -1,12 +1,28 @@
+import asyncio
 import json
-from typing import Any, Dict, Optional, Callable
+import os
+import time
+from typing import Any, Awaitable, Dict, Optional, Callable
 
 # Import đúng cấu trúc dự án
 from core.nlu_connector import NLUModule
 from core.db_connector import SystemIntegrationManager
 from core.intent_whitelist import IntentWhitelist
 from core.logic_manager import LogicManager
+from core.session_store import DialogSession
 from ai_modules.response_generator import ResponseGenerator
+from core.metrics import observe_step
+
+# Timeout từng stage trong lượt hội thoại async (giây)
+NLU_STAGE_TIMEOUT_SEC = float(os.getenv("DM_NLU_TIMEOUT_SEC", "5.0"))
+DB_STAGE_TIMEOUT_SEC = float(os.getenv("DM_DB_TIMEOUT_SEC", "2.0"))
+LOGIC_STAGE_TIMEOUT_SEC = float(os.getenv("DM_LOGIC_TIMEOUT_SEC", "1.0"))
+RG_STAGE_TIMEOUT_SEC = float(os.getenv("DM_RG_TIMEOUT_SEC", "5.0"))
+
+# Action của LogicManager đã có bot_text cố định → không cần dữ liệu DB
+DB_SKIP_ACTIONS = {"fallback", "payment"}
+
+LOGIC_ERROR_RESULT = {"bot_text": "Xin lỗi, hệ thống gặp sự cố."}
 
 
 class DialogManager:
@@ -17,6 +33,10 @@ class DialogManager:
     - Query DB
     - Gọi LogicManager
     - Sinh phản hồi bằng ResponseGenerator
+
+    DialogManager dùng chung cho mọi phiên nên KHÔNG giữ state hội thoại:
+    state / scenario / step_index / history / api_key nằm trong
+    DialogSession (core/session_store.py) truyền vào mỗi lượt.
     """
 
     def __init__(self, log_callback=print, api_key=None, mode="normal"):
@@ -27,18 +47,11 @@ class DialogManager:
         self.mode = mode
         self._log(f"[DM] Khởi tạo chế độ: {self.mode}")
 
-        # API key cho NLU/LLM/TTS
-        self.api_key = api_key
+        # API key mặc định để khởi tạo NLU/RG (key theo phiên nằm trong DialogSession)
+        self.default_api_key = api_key
 
-        # State ban đầu
-        self.state = "START"
-
-        # Scenario
+        # Scenario config (chỉ đọc, dùng chung)
         self.scenarios = {}
-        self.current_scenario = None
-        self.current_step_index = 0
-
-        self._log(f"[DM] State ban đầu: {self.state}")
 
         # Whitelist
         self.whitelist = IntentWhitelist(self._log)
@@ -49,7 +62,7 @@ class DialogManager:
         # NLU module
         self.nlu = NLUModule(
             mode="LLM",
-            api_key=self.api_key,
+            api_key=self.default_api_key,
             log_callback=self._log,
         )
 
@@ -60,14 +73,9 @@ class DialogManager:
             llm_mode="LLM",
             tts_mode="LLM",
             db_mode="LLM",
-            api_key=self.api_key
+            api_key=self.default_api_key
         )
 
-        # Sync API key nếu RG có shared variable
-        if hasattr(self.rg, "api_key_var"):
-            self.rg.api_key_var.value = self.api_key
-            self._log(f"[DM] Sync API key vào RG: {self.api_key}")
-
     # ======================================================================
     #      HÀM TRUNG TÂM – BACKEND RTC GỌI Ở MỌI NƠI
     # ======================================================================
@@ -78,60 +86,214 @@ class DialogManager:
         nlu_json: Optional[Dict[str, Any]] = None,
         wav_id: Optional[str] = None,
         context: Optional[Dict[str, Any]] = None,
+        prefetched: Optional[Dict[str, Any]] = None,
+        session: Optional[DialogSession] = None,
     ) -> Dict[str, Any]:
 
-        self._log(f"[DM] Nhận user_text: {user_text}")
+        session = self._ensure_session(session, wav_id)
+        self._log(f"[DM][{session.session_id}] Nhận user_text: {user_text}")
 
         # --------------------------
-        # 1) ƯU TIÊN NLU JSON (từ ASR/RTC)
+        # 1) NLU
         # --------------------------
-        if nlu_json:
-            self._log(f"[DM] Nhận nlu_json từ backend: {nlu_json}")
-            intent = nlu_json.get("intent", "no_match")
-            entities = nlu_json.get("entities", {})
-
-        else:
-            if user_text is None:
-                user_text = ""
-            nlu_result = self.nlu.get_intent(user_text, context)
-            intent = nlu_result.get("intent", "no_match")
-            entities = nlu_result.get("entities", {})
+        intent, entities = self._resolve_nlu(user_text, nlu_json, context)
 
         # --------------------------
         # 2) DB Query
+        #    (dùng lại kết quả speculative prefetch nếu có)
         # --------------------------
-        try:
-            db_result = self.db.query_data(intent, entities)
-        except Exception as e:
-            self._log(f"[DM] DB lỗi: {e}")
-            db_result = {}
+        prefetched = prefetched or {}
+        if "db_result" in prefetched:
+            db_result = prefetched["db_result"]
+        else:
+            try:
+                db_result = self.db.query_data(intent, entities)
+            except Exception as e:
+                self._log(f"[DM] DB lỗi: {e}")
+                db_result = {}
 
         # --------------------------
         # 3) Logic Manager
         # --------------------------
+        if "logic_result" in prefetched:
+            logic_result = prefetched["logic_result"]
+            logic_manager.update_session(session, logic_result)
+        else:
+            try:
+                logic_result = logic_manager.decide_action(intent, entities, session)
+            except Exception as e:
+                self._log(f"[DM] LogicManager lỗi: {e}")
+                logic_result = dict(LOGIC_ERROR_RESULT)
+
+        # --------------------------
+        # 4) Response Generator
+        # --------------------------
+        return self._build_response(session, user_text, nlu_json, intent, entities, db_result, logic_result)
+
+    # ======================================================================
+    #      PHIÊN BẢN ASYNC – DB VÀ LOGIC CHẠY SONG SONG
+    # ======================================================================
+    async def process_with_logic_manager_async(
+        self,
+        logic_manager,
+        user_text: Optional[str] = "",
+        nlu_json: Optional[Dict[str, Any]] = None,
+        wav_id: Optional[str] = None,
+        context: Optional[Dict[str, Any]] = None,
+        prefetched: Optional[Dict[str, Any]] = None,
+        session: Optional[DialogSession] = None,
+        run_blocking: Optional[Callable[..., Awaitable[Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Cùng kết quả với process_with_logic_manager(), nhưng:
+        - db.query_data() và logic_manager.decide_action() độc lập nhau
+          → chạy đồng thời trong thread, mỗi stage có timeout riêng
+        - Nếu LogicManager quyết định không cần dữ liệu DB
+          (whitelist fallback, chuyển trang thanh toán) → huỷ / bỏ qua DB
+        run_blocking: chạy phần blocking trên executor riêng (VoicePipeline truyền
+        PipelineStage.run_blocking của stage "dm"); không truyền → asyncio.to_thread.
+        """
+        run_blocking = run_blocking or asyncio.to_thread
+        session = self._ensure_session(session, wav_id)
+        self._log(f"[DM][{session.session_id}] (async) Nhận user_text: {user_text}")
+        timings: Dict[str, Any] = {}
+
+        # --------------------------
+        # 1) NLU (chỉ gọi LLM khi backend chưa gửi nlu_json)
+        # --------------------------
+        t0 = time.perf_counter()
         try:
-            logic_result = logic_manager.decide_action(intent, entities)
-        except Exception as e:
-            self._log(f"[DM] LogicManager lỗi: {e}")
-            logic_result = {"bot_text": "Xin lỗi, hệ thống gặp sự cố."}
+            intent, entities = await asyncio.wait_for(
+                run_blocking(self._resolve_nlu, user_text, nlu_json, context),
+                timeout=NLU_STAGE_TIMEOUT_SEC,
+            )
+        except asyncio.TimeoutError:
+            self._log(f"[DM] ⏱️ NLU quá {NLU_STAGE_TIMEOUT_SEC}s → no_match")
+            intent, entities = "no_match", {}
+        timings["nlu_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        observe_step("dm_nlu", timings["nlu_ms"], mode="nlu_json" if nlu_json else "llm")
+
+        # --------------------------
+        # 2) + 3) DB và LogicManager song song
+        # --------------------------
+        prefetched = prefetched or {}
+        t0 = time.perf_counter()
+
+        db_task = None
+        if "db_result" not in prefetched:
+            db_task = asyncio.create_task(
+                asyncio.wait_for(
+                    run_blocking(self.db.query_data, intent, entities),
+                    timeout=DB_STAGE_TIMEOUT_SEC,
+                )
+            )
+            # DB có thể bị bỏ qua → tránh cảnh báo "exception was never retrieved"
+            db_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        if "logic_result" in prefetched:
+            logic_result = prefetched["logic_result"]
+            logic_manager.update_session(session, logic_result)
+        else:
+            try:
+                logic_result = await asyncio.wait_for(
+                    run_blocking(logic_manager.decide_action, intent, entities, session),
+                    timeout=LOGIC_STAGE_TIMEOUT_SEC,
+                )
+            except asyncio.TimeoutError:
+                self._log(f"[DM] ⏱️ LogicManager quá {LOGIC_STAGE_TIMEOUT_SEC}s")
+                logic_result = dict(LOGIC_ERROR_RESULT)
+            except Exception as e:
+                self._log(f"[DM] LogicManager lỗi: {e}")
+                logic_result = dict(LOGIC_ERROR_RESULT)
+        timings["logic_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        observe_step("logic", timings["logic_ms"], model="logic_manager",
+                     mode="prefetched" if "logic_result" in prefetched else "decide_action")
+
+        if "db_result" in prefetched:
+            db_result = prefetched["db_result"]
+        elif (logic_result or {}).get("action") in DB_SKIP_ACTIONS:
+            # Quyết định đã có bot_text cố định → không chờ DB
+            db_task.cancel()
+            db_result = {}
+            timings["db_skipped"] = True
+            self._log(f"[DM] ⏭️ Bỏ qua DB (action={logic_result.get('action')})")
+        else:
+            try:
+                db_result = await db_task
+            except asyncio.TimeoutError:
+                self._log(f"[DM] ⏱️ DB quá {DB_STAGE_TIMEOUT_SEC}s → bỏ qua dữ liệu DB")
+                db_result = {}
+            except Exception as e:
+                self._log(f"[DM] DB lỗi: {e}")
+                db_result = {}
+        timings["db_logic_ms"] = round((time.perf_counter() - t0) * 1000, 2)
 
         # --------------------------
         # 4) Response Generator
         # --------------------------
+        t0 = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                run_blocking(
+                    self._build_response, session, user_text, nlu_json,
+                    intent, entities, db_result, logic_result,
+                ),
+                timeout=RG_STAGE_TIMEOUT_SEC,
+            )
+        except asyncio.TimeoutError:
+            # Thread RG vẫn chạy tiếp và sẽ tự ghi lượt vào history khi xong
+            # → ở đây chỉ trả câu báo lỗi, KHÔNG gọi lại RG / add_turn (tránh 2 lượt)
+            self._log(f"[DM] ⏱️ ResponseGenerator quá {RG_STAGE_TIMEOUT_SEC}s")
+            response = self._response_dict(
+                session, LOGIC_ERROR_RESULT["bot_text"], intent, entities, db_result, dict(LOGIC_ERROR_RESULT)
+            )
+        timings["rg_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        observe_step("response_gen", timings["rg_ms"], model="response_generator")
+
+        response["stage_timings"] = timings
+        return response
+
+    # ======================================================================
+    #      HELPERS
+    # ======================================================================
+    def _ensure_session(self, session: Optional[DialogSession], wav_id: Optional[str]) -> DialogSession:
+        # Không có session → phiên tạm (giữ tương thích cho caller cũ)
+        if session is None:
+            session = DialogSession(wav_id or "ephemeral", api_key=self.default_api_key)
+        return session
+
+    def _resolve_nlu(self, user_text, nlu_json, context):
+        # ƯU TIÊN NLU JSON (từ ASR/RTC)
+        if nlu_json:
+            self._log(f"[DM] Nhận nlu_json từ backend: {nlu_json}")
+            return nlu_json.get("intent", "no_match"), nlu_json.get("entities", {})
+
+        nlu_result = self.nlu.get_intent(user_text or "", context)
+        return nlu_result.get("intent", "no_match"), nlu_result.get("entities", {})
+
+    def _build_response(self, session, user_text, nlu_json, intent, entities,
+                        db_result, logic_result) -> Dict[str, Any]:
         response_text = self.rg.generate(
             intent=intent,
             entities=entities,
             db_data=db_result,
             logic_data=logic_result,
-            state=self.state,
-            scenario=self.current_scenario,
-            step_index=self.current_step_index,
-            api_key=self.api_key,
-            history=[],
+            state=session.state,
+            scenario=session.scenario,
+            step_index=session.step_index,
+            api_key=session.api_key or self.default_api_key,
+            history=list(session.history),
         )
 
-        self._log(f"[DM] Phản hồi cuối: {response_text}")
+        self._log(f"[DM][{session.session_id}] Phản hồi cuối: {response_text}")
 
+        # Lưu lượt hội thoại vào history (bị chặn độ dài) của phiên
+        session.add_turn((nlu_json or {}).get("text") or user_text or "", response_text)
+
+        return self._response_dict(session, response_text, intent, entities, db_result, logic_result)
+
+    @staticmethod
+    def _response_dict(session, response_text, intent, entities, db_result, logic_result) -> Dict[str, Any]:
         # --------------------------
         # 5) RETURN OBJECT (KHÔNG TRẢ STRING NỮA)
         # --------------------------
@@ -141,12 +303,11 @@ class DialogManager:
             "entities": entities,
             "db_result": db_result,
             "logic_result": logic_result,
-            "state": self.state,
-            "scenario": self.current_scenario,
-            "step_index": self.current_step_index
+            "state": session.state,
+            "scenario": session.scenario,
+            "step_index": session.step_index
         }
 
-
 # ======================================================================
 #  Helper backend dùng
 # ======================================================================
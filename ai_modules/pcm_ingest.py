@@ -0,0 +1,120 @@
+# ai_modules/pcm_ingest.py
+"""
+Nhận PCM đóng khung (binary) thay cho media track — không decode Opus,
+không resample trên server.
+
+Mỗi message binary (DataChannel "pcm" hoặc WebSocket /ws/audio):
+
+    [seq: uint32 little-endian][PCM int16 little-endian, mono, 16 kHz]
+
+- seq tăng 1 cho mỗi frame client tạo ra (kể cả frame không gửi), độ dài
+  frame cố định trong phiên (20–40 ms)
+- frame thiếu seq (mất gói / client lọc im lặng) → chèn im lặng cùng độ dài
+  để VAD tách lượt và barge-in vẫn thấy khoảng lặng
+- message chỉ có header = frame im lặng (heartbeat khi client đang lọc)
+- seq nhỏ hơn seq mong đợi (DataChannel unordered, gói đến muộn) → bỏ
+"""
+import os
+import struct
+import threading
+from typing import Any, Callable, Dict, Optional
+
+PCM_INGEST_CHANNEL = "pcm"
+PCM_INGEST_HEADER = struct.Struct("<I")
+PCM_INGEST_FRAME_MS = float(os.getenv("PCM_INGEST_FRAME_MS", "20"))
+# Khoảng trống tối đa được lấp bằng im lặng cho mỗi lần nhảy seq
+PCM_INGEST_MAX_GAP_MS = float(os.getenv("PCM_INGEST_MAX_GAP_MS", "2000"))
+
+
+class IngestStats:
+    """Thống kê ingest PCM dùng chung toàn process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = 0
+        self.frames = 0
+        self.bytes = 0
+        self.silence_frames = 0
+        self.gap_filled_ms = 0.0
+        self.late_frames = 0
+        self.malformed = 0
+
+    def record_session(self):
+        with self._lock:
+            self.sessions += 1
+
+    def record_frame(self, nbytes: int, silent: bool, gap_ms: float):
+        with self._lock:
+            self.frames += 1
+            self.bytes += nbytes
+            if silent:
+                self.silence_frames += 1
+            self.gap_filled_ms += gap_ms
+
+    def record_dropped(self, late: bool):
+        with self._lock:
+            if late:
+                self.late_frames += 1
+            else:
+                self.malformed += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": self.sessions,
+                "frames": self.frames,
+                "bytes": self.bytes,
+                "silence_frames": self.silence_frames,
+                "gap_filled_ms": round(self.gap_filled_ms, 1),
+                "late_frames": self.late_frames,
+                "malformed": self.malformed,
+            }
+
+
+PCM_INGEST_STATS = IngestStats()
+
+
+class PcmIngest:
+    """Một instance cho mỗi phiên: tách header, lấp khoảng trống, đẩy PCM vào sink."""
+
+    def __init__(self, sink: Callable[[bytes], None], sample_rate: int = 16000,
+                 frame_ms: float = PCM_INGEST_FRAME_MS,
+                 max_gap_ms: float = PCM_INGEST_MAX_GAP_MS,
+                 stats: IngestStats = PCM_INGEST_STATS):
+        self._sink = sink
+        self.sample_rate = sample_rate
+        self.max_gap_ms = max_gap_ms
+        self.stats = stats
+        # Độ dài frame (bytes) lấy theo frame có dữ liệu gần nhất
+        self._frame_bytes = int(sample_rate * frame_ms / 1000) * 2
+        self._expected_seq: Optional[int] = None
+        stats.record_session()
+
+    def _frame_ms(self) -> float:
+        return self._frame_bytes / 2 / self.sample_rate * 1000
+
+    def feed(self, message) -> bool:
+        """Nhận 1 message binary. Trả về False nếu bị bỏ (hỏng / đến muộn)."""
+        if len(message) < PCM_INGEST_HEADER.size or (len(message) - PCM_INGEST_HEADER.size) % 2:
+            self.stats.record_dropped(late=False)
+            return False
+        (seq,) = PCM_INGEST_HEADER.unpack_from(message)
+        if self._expected_seq is not None and seq < self._expected_seq:
+            self.stats.record_dropped(late=True)
+            return False
+
+        gap_ms = 0.0
+        if self._expected_seq is not None and seq > self._expected_seq:
+            missing = seq - self._expected_seq
+            gap_ms = min(missing * self._frame_ms(), self.max_gap_ms)
+            self._sink(bytes(int(gap_ms * self.sample_rate / 1000) * 2))
+        self._expected_seq = seq + 1
+
+        payload = bytes(message[PCM_INGEST_HEADER.size:])
+        if payload:
+            self._frame_bytes = len(payload)
+        else:
+            payload = bytes(self._frame_bytes)      # heartbeat = 1 frame im lặng
+        self._sink(payload)
+        self.stats.record_frame(len(message), silent=len(message) == PCM_INGEST_HEADER.size, gap_ms=gap_ms)
+        return True
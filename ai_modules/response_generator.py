@@ -1,8 +1,8 @@
 import time
 import os
 import random
-import threading
-from typing import Optional, Dict, Any, List, Callable, Literal, AsyncGenerator
+import re
+from typing import Optional, Dict, Any, List, Callable, Literal, AsyncGenerator, Tuple
 import wave
 
 _FALLBACK_API_KEY = "MOCK_API_KEY"
@@ -54,6 +54,59 @@ class MockTTS(BaseTTS):
     pass
 
 
+# ========================================================
+# MẪU CÂU TRẢ LỜI TỪ DB (phần cố định + slot)
+# ========================================================
+# Mỗi mẫu là dãy segment; segment không có "{...}" là phần cố định → TTS
+# tổng hợp sẵn vào phrase cache, lượt hội thoại chỉ phải tổng hợp phần slot.
+DB_REPLY_TEMPLATES: Dict[str, Tuple[str, ...]] = {
+    "customer": ("Khách hàng:", "{customer_name}", "— Lần đặt gần nhất:", "{last_order}."),
+    "product_discount": ("Sản phẩm", "{product_name}", "giá", "{price}", "— Giảm", "{discount}%."),
+    "product": ("Sản phẩm", "{product_name}", "giá", "{price}", "— Không giảm giá."),
+}
+
+_SLOT_RE = re.compile(r"\{(\w+)\}")
+
+
+def _template_regex(segments: Tuple[str, ...]) -> "re.Pattern":
+    parts = []
+    for segment in segments:
+        pattern, pos = "", 0
+        for m in _SLOT_RE.finditer(segment):
+            pattern += re.escape(segment[pos:m.start()]) + f"(?P<{m.group(1)}>.+?)"
+            pos = m.end()
+        parts.append(pattern + re.escape(segment[pos:]))
+    return re.compile(r"^" + r"\s+".join(parts) + r"$", re.S)
+
+
+_TEMPLATE_PATTERNS = {name: _template_regex(segs) for name, segs in DB_REPLY_TEMPLATES.items()}
+
+
+def render_template(name: str, **slots) -> str:
+    return " ".join(segment.format(**slots) for segment in DB_REPLY_TEMPLATES[name])
+
+
+def template_fixed_segments() -> List[str]:
+    """Các segment cố định của mọi mẫu (để tổng hợp sẵn lúc khởi động)."""
+    return list(dict.fromkeys(
+        segment for segs in DB_REPLY_TEMPLATES.values() for segment in segs if not _SLOT_RE.search(segment)
+    ))
+
+
+def split_templated_reply(text: str) -> List[str]:
+    """
+    Câu trả lời sinh từ mẫu → list segment (cố định + slot đã điền) cho TTS;
+    câu không khớp mẫu nào → [text].
+    """
+    text = (text or "").strip()
+    for name, pattern in _TEMPLATE_PATTERNS.items():
+        m = pattern.match(text)
+        if m:
+            slots = m.groupdict()
+            return [segment.format(**slots) for segment in DB_REPLY_TEMPLATES[name]]
+    return [text]
+
+
 # ========================================================
 # RESPONSE GENERATOR
 # ========================================================
@@ -68,15 +121,14 @@ class ResponseGenerator:
         self.tts_mode = tts_mode
         self.db_mode = db_mode
 
-        self.api_key_var = threading.local()
-
-        # ƯU TIÊN API KEY TỪ BACKEND
+        # ƯU TIÊN API KEY TỪ BACKEND. Key theo phiên truyền tường minh vào
+        # generate() (RG dùng chung, được gọi từ nhiều worker thread)
         if api_key and api_key != _FALLBACK_API_KEY:
-            self.api_key_var.value = api_key
+            self.default_api_key = api_key
         else:
-            self.api_key_var.value = API_KEY
+            self.default_api_key = API_KEY
 
-        self.log(f"[RG] API KEY INIT = {self.api_key_var.value}")
+        self.log(f"[RG] API KEY INIT = {self.default_api_key}")
 
         self._initialize_tts_client()
 
@@ -119,13 +171,15 @@ class ResponseGenerator:
         product = db_result.get("product_data")
 
         if intent == "query_customer_info" and customer:
-            return f"Khách hàng: {customer['customer_name']} — Lần đặt gần nhất: {customer['last_order']}."
+            return render_template("customer", customer_name=customer['customer_name'],
+                                   last_order=customer['last_order'])
 
         if intent == "query_product_info" and product:
             discount = product.get("discount")
             if discount and int(discount) > 0:
-                return f"Sản phẩm {product['product_name']} giá {product['price']} — Giảm {discount}%."
-            return f"Sản phẩm {product['product_name']} giá {product['price']} — Không giảm giá."
+                return render_template("product_discount", product_name=product['product_name'],
+                                       price=product['price'], discount=discount)
+            return render_template("product", product_name=product['product_name'], price=product['price'])
 
         return None
 
@@ -133,7 +187,7 @@ class ResponseGenerator:
     # MOCK LLM
     # ========================================================
     def _generate_with_llm_mock(self, ctx: Dict[str, Any]) -> str:
-        key = getattr(self.api_key_var, "value", None)
+        key = ctx.get("api_key")
 
     # Nếu không có API key → phản hồi rõ ràng, KHÔNG rỗng
         if not key or key == _FALLBACK_API_KEY:
@@ -166,7 +220,8 @@ class ResponseGenerator:
         entities: Dict[str, Any],
         db_result: Dict[str, Any],
         current_state: str,
-        history: List[Dict[str, str]] = []
+        history: List[Dict[str, str]] = [],
+        api_key: Optional[str] = None,
     ) -> str:
 
         # RULE ENGINE
@@ -194,6 +249,7 @@ class ResponseGenerator:
             "db_result": db_result,
             "current_state": current_state,
             "history": history,
+            "api_key": api_key or self.default_api_key,
         }
 
         return self._generate_with_llm_mock(ctx)
@@ -215,11 +271,11 @@ class ResponseGenerator:
         history: List[Dict[str, str]] = []
     ) -> str:
 
-        # Update API KEY mỗi lần sinh response
-        if api_key and api_key != _FALLBACK_API_KEY:
-            self.api_key_var.value = api_key
+        # API KEY của phiên (không hợp lệ → key mặc định của RG)
+        if not api_key or api_key == _FALLBACK_API_KEY:
+            api_key = self.default_api_key
 
-        self.log(f"[RG] API KEY ACTIVE = {self.api_key_var.value}")
+        self.log(f"[RG] API KEY ACTIVE = {api_key}")
 
         # Nếu logic_manager đã trả bot_text → dùng luôn
         if logic_data and logic_data.get("bot_text"):
@@ -234,4 +290,5 @@ class ResponseGenerator:
             db_result=db_data,
             current_state=state,
             history=history,
+            api_key=api_key,
         )
@@ -10,7 +10,12 @@ from pathlib import Path
 from datetime import datetime
 from gtts import gTTS
 import tempfile
+import time
 import traceback
+from typing import Optional
+
+from core.cancellation import CancellationToken, TurnCancelled
+from core.metrics import STEP_ERRORS, observe_step, timed_step
 
 import shutil
 from pathlib import Path
@@ -32,6 +37,15 @@ except Exception as e:
 # =========================================================
 INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "LOCAL-STT-KEY")
 
+# =========================================================
+# STUB MODE — load test không cần mạng / model
+# =========================================================
+# VOICE_STUB_MODE=1 → không nạp Whisper / Silero; ASR trả STUB_ASR_TEXT sau thời
+# gian giả lập STUB_ASR_RTF × độ dài audio (backend dùng TTS_ENGINE=STUB)
+VOICE_STUB_MODE = os.getenv("VOICE_STUB_MODE", "0") == "1"
+STUB_ASR_TEXT = os.getenv("STUB_ASR_TEXT", "cho tôi hỏi giá sản phẩm này")
+STUB_ASR_RTF = float(os.getenv("STUB_ASR_RTF", "0.1"))
+
 # =========================================================
 # LOGGING
 # =========================================================
@@ -44,62 +58,87 @@ def _log_colored(msg: str, color="white"):
 SAMPLE_RATE = 16000
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 WHISPER_MODEL_NAME = os.getenv("WHISPER_MODEL_NAME", "base")
+# Label "model" cho metrics ASR
+ASR_METRIC_MODEL = "stub" if VOICE_STUB_MODE else f"whisper:{WHISPER_MODEL_NAME or 'base'}:{DEVICE}"
 
 # =========================================================
 # WHISPER INITIALIZATION
 # =========================================================
-try:
-    import whisper
-    _log_colored(f"[ASR] Đang tải Whisper model '{WHISPER_MODEL_NAME}' trên thiết bị {DEVICE}...", "yellow")
-    WHISPER_MODEL = whisper.load_model(WHISPER_MODEL_NAME if WHISPER_MODEL_NAME else "base")
-    WHISPER_MODEL = WHISPER_MODEL.to(DEVICE)
-    WHISPER_IS_READY = True
-    _log_colored(f"✅ Whisper model '{WHISPER_MODEL_NAME if WHISPER_MODEL_NAME else 'base'}' loaded.", "green")
-except Exception as e:
+if VOICE_STUB_MODE:
     WHISPER_MODEL = None
     WHISPER_IS_READY = False
-    _log_colored(f"❌ Không thể tải Whisper model: {e}", "red")
+    _log_colored("[ASR] VOICE_STUB_MODE=1 → bỏ qua Whisper, dùng ASR giả lập.", "yellow")
+else:
+    try:
+        import whisper
+        _log_colored(f"[ASR] Đang tải Whisper model '{WHISPER_MODEL_NAME}' trên thiết bị {DEVICE}...", "yellow")
+        WHISPER_MODEL = whisper.load_model(WHISPER_MODEL_NAME if WHISPER_MODEL_NAME else "base")
+        WHISPER_MODEL = WHISPER_MODEL.to(DEVICE)
+        WHISPER_IS_READY = True
+        _log_colored(f"✅ Whisper model '{WHISPER_MODEL_NAME if WHISPER_MODEL_NAME else 'base'}' loaded.", "green")
+    except Exception as e:
+        WHISPER_MODEL = None
+        WHISPER_IS_READY = False
+        _log_colored(f"❌ Không thể tải Whisper model: {e}", "red")
 
 # ============================================================
 # 🧠 SILERO VAD FIX – hỗ trợ đa phiên bản
 # ============================================================
 
-try:
-    vad_load = torch.hub.load(repo_or_dir="snakers4/silero-vad", model="silero_vad", trust_repo=True)
-    if isinstance(vad_load, tuple) and len(vad_load) == 2:
-        VAD_MODEL, utils = vad_load
-    else:
-        VAD_MODEL = vad_load
-        try:
-            from silero_vad import utils as _vad_utils
-            utils = _vad_utils
-        except Exception as inner_e:
-            utils = None
-            print(f"[⚠️ VAD] Không thể import utils trực tiếp: {inner_e}")
-
-    if isinstance(utils, tuple):
-        try:
-            if len(utils) > 0 and hasattr(utils[0], "get_speech_timestamps"):
-                utils = utils[0]
-                print("[FIX] Silero VAD: utils tuple → utils[0] (module hợp lệ).")
-            else:
-                from silero_vad import utils as _vad_utils
-                utils = _vad_utils
-                print("[FIX] Silero VAD: fallback import utils từ silero_vad.")
-        except Exception as fix_e:
-            print(f"[FIX ERROR] Không thể khởi tạo utils chính xác: {fix_e}")
-
-    VAD_IS_READY = True
-    print("[✅] Silero VAD loaded successfully (multi-version safe).")
-except Exception as e:
+if VOICE_STUB_MODE:
     VAD_MODEL, utils = None, None
     VAD_IS_READY = False
-    print(f"[❌] Lỗi tải Silero VAD: {e}")
+else:
+    try:
+        vad_load = torch.hub.load(repo_or_dir="snakers4/silero-vad", model="silero_vad", trust_repo=True)
+        if isinstance(vad_load, tuple) and len(vad_load) == 2:
+            VAD_MODEL, utils = vad_load
+        else:
+            VAD_MODEL = vad_load
+            try:
+                from silero_vad import utils as _vad_utils
+                utils = _vad_utils
+            except Exception as inner_e:
+                utils = None
+                print(f"[⚠️ VAD] Không thể import utils trực tiếp: {inner_e}")
+
+        if isinstance(utils, tuple):
+            try:
+                if len(utils) > 0 and hasattr(utils[0], "get_speech_timestamps"):
+                    utils = utils[0]
+                    print("[FIX] Silero VAD: utils tuple → utils[0] (module hợp lệ).")
+                else:
+                    from silero_vad import utils as _vad_utils
+                    utils = _vad_utils
+                    print("[FIX] Silero VAD: fallback import utils từ silero_vad.")
+            except Exception as fix_e:
+                print(f"[FIX ERROR] Không thể khởi tạo utils chính xác: {fix_e}")
+
+        VAD_IS_READY = True
+        print("[✅] Silero VAD loaded successfully (multi-version safe).")
+    except Exception as e:
+        VAD_MODEL, utils = None, None
+        VAD_IS_READY = False
+        print(f"[❌] Lỗi tải Silero VAD: {e}")
 
 # =========================================================
 # HELPER FUNCTIONS
 # =========================================================
-def _apply_silero_vad(audio_path: Path, log=_log_colored):
+def _speech_timestamps(vad_utils, wav_t, sr, token: Optional[CancellationToken] = None):
+    """get_speech_timestamps; có token → kiểm tra huỷ giữa các chunk (progress callback)."""
+    if token is not None:
+        try:
+            return vad_utils.get_speech_timestamps(
+                wav_t, VAD_MODEL, sampling_rate=sr,
+                progress_tracking_callback=lambda _progress: token.raise_if_cancelled("asr"),
+            )
+        except TypeError:
+            # Bản Silero cũ chưa có progress_tracking_callback → chỉ kiểm tra trước khi chạy
+            token.raise_if_cancelled("asr")
+    return vad_utils.get_speech_timestamps(wav_t, VAD_MODEL, sampling_rate=sr)
+
+
+def _apply_silero_vad(audio_path: Path, log=_log_colored, token: Optional[CancellationToken] = None):
     """
     Cắt bỏ đoạn im lặng bằng Silero VAD, đảm bảo output dạng np.float32
     """
@@ -120,14 +159,12 @@ def _apply_silero_vad(audio_path: Path, log=_log_colored):
         wav_t = torch.tensor(wav, dtype=torch.float32)
 
         try:
-            speech_timestamps = utils.get_speech_timestamps(
-                wav_t, VAD_MODEL, sampling_rate=sr
-            )
+            speech_timestamps = _speech_timestamps(utils, wav_t, sr, token)
+        except TurnCancelled:
+            raise
         except:
             from silero_vad import utils as _vad_utils
-            speech_timestamps = _vad_utils.get_speech_timestamps(
-                wav_t, VAD_MODEL, sampling_rate=sr
-            )
+            speech_timestamps = _speech_timestamps(_vad_utils, wav_t, sr, token)
 
         if not speech_timestamps:
             log("[VAD] Không thấy tiếng nói", "yellow")
@@ -143,6 +180,8 @@ def _apply_silero_vad(audio_path: Path, log=_log_colored):
 
         return vad_seg.astype(np.float32)
 
+    except TurnCancelled:
+        raise
     except Exception as e:
         log(f"[❌ VAD ERROR] {e}", "red")
         wav, _ = sf.read(audio_path)
@@ -159,38 +198,124 @@ class ASRServiceWhisper:
     def __init__(self, log_callback=_log_colored, model=None):
         self._log = log_callback
         self._model = model or WHISPER_MODEL
+        # Giây xử lý Whisper / giây audio (EWMA) → ước tính CPU tiết kiệm khi huỷ
+        self._whisper_rtf: Optional[float] = None
+
+    def _whisper_estimate_ms(self, audio_sec: float) -> float:
+        return audio_sec * (self._whisper_rtf or 0.0) * 1000
+
+    def _observe_whisper(self, audio_sec: float, elapsed_sec: float):
+        if audio_sec <= 0:
+            return
+        rtf = elapsed_sec / audio_sec
+        self._whisper_rtf = rtf if self._whisper_rtf is None else 0.8 * self._whisper_rtf + 0.2 * rtf
 
     async def transcribe(self, audio_filepath: Path):
+        yield await asyncio.to_thread(self.transcribe_sync, audio_filepath)
+
+    def transcribe_sync(self, audio_filepath: Path, token: Optional[CancellationToken] = None) -> str:
+        """
+        VAD + Whisper đồng bộ (chạy trong executor của stage ASR).
+        token: kiểm tra huỷ trước VAD, giữa các chunk VAD và trước Whisper;
+        Whisper đã chạy thì không dừng giữa chừng được.
+        """
         try:
             if not os.path.exists(audio_filepath):
                 self._log(f"[❌ [ASR]] Không tìm thấy file {audio_filepath}", "red")
-                yield "[NO SPEECH DETECTED]"
-                return
+                return "[NO SPEECH DETECTED]"
 
             audio_numpy, sr = sf.read(audio_filepath)
             rms = np.sqrt(np.mean(audio_numpy**2))
             if rms < 0.005:
                 self._log(f"[⚠️ [ASR]] Âm lượng thấp ({rms:.4f}) hoặc không có giọng nói.", "yellow")
-                yield "[NO SPEECH DETECTED]"
-                return
-
-            audio_input = await asyncio.to_thread(_apply_silero_vad, audio_filepath, self._log)
+                return "[NO SPEECH DETECTED]"
+
+            audio_sec = len(audio_numpy) / sr
+            if token is not None:
+                token.raise_if_cancelled("asr", self._whisper_estimate_ms(audio_sec))
+            try:
+                with timed_step("vad", model="silero" if VAD_IS_READY else "none"):
+                    audio_input = _apply_silero_vad(audio_filepath, self._log, token)
+            except TurnCancelled as e:
+                e.saved_ms = self._whisper_estimate_ms(audio_sec)
+                raise
             if len(audio_input) == 0:
                 self._log("[⚠️ [ASR]] File sau VAD trống.", "yellow")
-                yield "[NO SPEECH DETECTED]"
-                return
-
-            result = await asyncio.to_thread(self._model.transcribe, audio_input)
+                return "[NO SPEECH DETECTED]"
+
+            input_sec = len(audio_input) / SAMPLE_RATE
+            if token is not None:
+                token.raise_if_cancelled("asr", self._whisper_estimate_ms(input_sec))
+            started = time.perf_counter()
+            result = self._model.transcribe(audio_input)
+            elapsed = time.perf_counter() - started
+            self._observe_whisper(input_sec, elapsed)
+            observe_step("asr", elapsed * 1000, model=ASR_METRIC_MODEL, mode="full")
             text = result.get("text", "").strip()
             if not text:
                 text = "[NO SPEECH DETECTED]"
             self._log(f"[🧠 [ASR]] Văn bản nhận được: {text}")
-            yield text
+            return text
 
+        except TurnCancelled:
+            raise
         except Exception as e:
+            STEP_ERRORS.inc(step="asr", model=ASR_METRIC_MODEL)
             self._log(f"[❌ [ASR]] Lỗi khi nhận dạng: {e}", "red")
             traceback.print_exc()
-            yield "[NO SPEECH DETECTED]"
+            return "[NO SPEECH DETECTED]"
+
+    def transcribe_partial(self, pcm: bytes) -> str:
+        """
+        ASR nhanh trên PCM16 đang ghi dở (chạy trong thread, bỏ qua VAD).
+        Dùng cho speculative NLU/DB prefetch khi người dùng còn đang nói.
+        """
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        if len(audio) < SAMPLE_RATE // 2 or np.sqrt(np.mean(audio ** 2)) < 0.005:
+            return ""
+        with timed_step("asr", model=ASR_METRIC_MODEL, mode="partial"):
+            result = self._model.transcribe(
+                audio, temperature=0.0, condition_on_previous_text=False, fp16=(DEVICE == "cuda")
+            )
+        return result.get("text", "").strip()
+
+
+class ASRServiceStub:
+    """
+    ASR giả lập cho load test (VOICE_STUB_MODE=1): đọc WAV, kiểm tra âm lượng
+    như ASRServiceWhisper rồi ngủ STUB_ASR_RTF × độ dài audio trong thread
+    (chiếm worker ASR như Whisper nhưng không tốn CPU) và trả STUB_ASR_TEXT.
+    """
+
+    def __init__(self, log_callback=_log_colored, text: str = STUB_ASR_TEXT, rtf: float = STUB_ASR_RTF):
+        self._log = log_callback
+        self.text = text
+        self.rtf = rtf
+
+    async def transcribe(self, audio_filepath: Path):
+        yield await asyncio.to_thread(self.transcribe_sync, audio_filepath)
+
+    def transcribe_sync(self, audio_filepath: Path, token: Optional[CancellationToken] = None) -> str:
+        if not os.path.exists(audio_filepath):
+            return "[NO SPEECH DETECTED]"
+        audio, sr = sf.read(audio_filepath)
+        if len(audio) == 0 or np.sqrt(np.mean(audio ** 2)) < 0.005:
+            return "[NO SPEECH DETECTED]"
+        audio_sec = len(audio) / sr
+        if token is not None:
+            token.raise_if_cancelled("asr", audio_sec * self.rtf * 1000)
+        with timed_step("asr", model=ASR_METRIC_MODEL, mode="full"):
+            time.sleep(audio_sec * self.rtf)
+        self._log(f"[🧠 [ASR Stub]] {audio_sec:.2f}s audio → '{self.text}'")
+        return self.text
+
+    def transcribe_partial(self, pcm: bytes) -> str:
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        if len(audio) < SAMPLE_RATE // 2 or np.sqrt(np.mean(audio ** 2)) < 0.005:
+            return ""
+        with timed_step("asr", model=ASR_METRIC_MODEL, mode="partial"):
+            time.sleep(len(audio) / SAMPLE_RATE * self.rtf)
+        return self.text
 
 # =========================================================
 # NLU & DIALOG MANAGER
@@ -236,7 +361,9 @@ class TTSService:
 class RTCStreamProcessor:
     def __init__(self, log_callback=_log_colored):
         self._log = log_callback
-        if WHISPER_IS_READY and WHISPER_MODEL is not None:
+        if VOICE_STUB_MODE:
+            self._asr_client = ASRServiceStub(self._log)
+        elif WHISPER_IS_READY and WHISPER_MODEL is not None:
             self._asr_client = ASRServiceWhisper(self._log, WHISPER_MODEL)
         else:
             self._log("⚠️ [ASR] Whisper chưa sẵn sàng. Sử dụng chế độ giả lập.", "orange")
@@ -244,11 +371,23 @@ class RTCStreamProcessor:
             async def mock_transcribe(fp):
                 yield "[NO SPEECH DETECTED]"
 
-            self._asr_client = type("ASRMock", (), {"transcribe": mock_transcribe})()
+            self._asr_client = type("ASRMock", (), {
+                "transcribe": staticmethod(mock_transcribe),
+                "transcribe_sync": staticmethod(lambda fp, token=None: "[NO SPEECH DETECTED]"),
+                "transcribe_partial": staticmethod(lambda pcm: ""),
+            })()
 
         self._dm = DialogManager(self._log)
         self._tts = TTSService(self._log)
 
+    def transcribe_partial(self, pcm: bytes) -> str:
+        """Transcript tạm cho speculative prefetch (đồng bộ, gọi qua to_thread)."""
+        return self._asr_client.transcribe_partial(pcm)
+
+    def transcribe_file(self, record_file: Path, token: Optional[CancellationToken] = None) -> str:
+        """VAD + ASR đồng bộ cho stage ASR của VoicePipeline (không kèm DM/TTS)."""
+        return self._asr_client.transcribe_sync(record_file, token)
+
     async def handle_rtc_session(self, record_file: Path, session_id: str, api_key: str):
         try:
             self._log(f"[▶️ [RTC]] Bắt đầu phiên xử lý ASR/NLU. Session ID: {session_id}.")
@@ -0,0 +1,337 @@
+# ai_modules/rtc_setup.py
+"""
+Profile kết nối WebRTC và đo thời gian thiết lập phiên (/offer).
+
+RTC_PROFILE (client chọn được qua field "profile" của /offer):
+  - "default"    : STUN công cộng RTC_STUN_URL (aiortc chỉ dùng 1 STUN server)
+  - "lan"        : chỉ host candidate, không hỏi STUN — kiosk cùng LAN với backend
+  - "local_stun" : STUN trong LAN RTC_LOCAL_STUN_URL; RTC_LOCAL_STUN_PORT > 0 →
+                   backend tự chạy STUN stand-in (chỉ trả lời BINDING) trên cổng đó
+
+Gather (trong setLocalDescription) được rút ngắn cho từng peer connection:
+  - host address lấy sẵn 1 lần lúc khởi động (RTC_HOST_ADDRESSES để ghim IP LAN):
+    gather_candidates của Connection được thay để không gọi get_host_addresses()
+    (liệt kê interface, vài ms) mỗi phiên
+  - hostname STUN resolve 1 lần thay vì gethostbyname mỗi phiên
+  - chờ srflx tối đa RTC_GATHER_TIMEOUT_SEC (aioice mặc định chờ 5s khi STUN
+    không trả lời — mạng cửa hàng chặn UDP ra ngoài) — phần tiết kiệm chính
+Chỉ gắn vào Connection aioice của pc đó, không sửa hằng số toàn cục của aioice.
+aiortc không có API công khai cho Connection (iceGatherer._connection) và
+gather_candidates dựa trên trạng thái nội bộ của aioice (0.9 – 0.10): phiên bản
+khác thiếu thuộc tính → bỏ qua phần tương ứng, aioice gather như mặc định.
+
+Mốc thời gian mỗi phiên: offer_parse → session_init → remote_description →
+answer → gather → connected (ICE + DTLS xong, connectionState = "connected").
+"""
+import asyncio
+import functools
+import ipaddress
+import os
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from aioice import stun
+from aioice.ice import get_host_addresses
+from aiortc import RTCConfiguration, RTCIceServer
+
+from core.metrics import percentile
+
+RTC_PROFILES = ("default", "lan", "local_stun")
+RTC_PROFILE = os.getenv("RTC_PROFILE", "default").lower()
+RTC_STUN_URL = os.getenv("RTC_STUN_URL", "stun:stun1.l.google.com:19302")
+RTC_LOCAL_STUN_URL = os.getenv("RTC_LOCAL_STUN_URL", "")
+RTC_LOCAL_STUN_PORT = int(os.getenv("RTC_LOCAL_STUN_PORT", "0"))
+RTC_GATHER_TIMEOUT_SEC = float(os.getenv("RTC_GATHER_TIMEOUT_SEC", "1.0"))
+RTC_HOST_ADDRESSES = [a.strip() for a in os.getenv("RTC_HOST_ADDRESSES", "").split(",") if a.strip()]
+RTC_HOST_IPV6 = os.getenv("RTC_HOST_IPV6", "1") == "1"
+# Số phiên gần nhất giữ lại để tính p50/p95 từng mốc
+RTC_SETUP_WINDOW = int(os.getenv("RTC_SETUP_WINDOW", "500"))
+
+if RTC_PROFILE not in RTC_PROFILES:
+    RTC_PROFILE = "default"
+
+SETUP_PHASES = ("offer_parse", "session_init", "remote_description", "answer", "gather", "connected")
+
+# Lấy sẵn bởi prepare_rtc(); None = để aioice tự làm mỗi phiên
+_host_addresses: Optional[List[str]] = None
+_resolved_stun: Dict[str, str] = {}
+_stun_stand_in = None
+
+
+# ============================================================
+# PROFILE → ICE SERVERS
+# ============================================================
+def resolve_profile(requested: Optional[str] = None) -> str:
+    profile = (requested or RTC_PROFILE).lower()
+    return profile if profile in RTC_PROFILES else RTC_PROFILE
+
+
+def ice_server_urls(profile: str) -> List[str]:
+    if profile == "lan":
+        return []
+    if profile == "local_stun":
+        return [RTC_LOCAL_STUN_URL] if RTC_LOCAL_STUN_URL else []
+    return [RTC_STUN_URL] if RTC_STUN_URL else []
+
+
+def client_ice_servers(profile: str) -> List[Dict[str, str]]:
+    """iceServers cho RTCPeerConnection phía trình duyệt (cùng profile với backend)."""
+    return [{"urls": url} for url in ice_server_urls(profile)]
+
+
+def rtc_configuration(profile: str) -> RTCConfiguration:
+    # iceServers=[] (không phải None) → aiortc không thêm STUN mặc định
+    urls = [_resolved_stun.get(url, url) for url in ice_server_urls(profile)]
+    return RTCConfiguration(iceServers=[RTCIceServer(urls=url) for url in urls])
+
+
+def _split_stun_url(url: str):
+    # "stun:host:port" → (host, port)
+    host, _, port = url.split(":", 1)[1].rpartition(":")
+    return (host, port) if host else (port, "3478")
+
+
+def _resolve_stun_url(url: str) -> str:
+    host, port = _split_stun_url(url)
+    try:
+        ipaddress.ip_address(host)
+        return url
+    except ValueError:
+        return f"stun:{socket.gethostbyname(host)}:{port}"
+
+
+# ============================================================
+# LẤY SẴN HOST ADDRESS / STUN KHI KHỞI ĐỘNG
+# ============================================================
+async def prepare_rtc(log_callback: Callable = print) -> Dict[str, Any]:
+    """Gọi 1 lần lúc startup: lấy host address, resolve STUN, bật STUN stand-in."""
+    global _host_addresses
+    loop = asyncio.get_running_loop()
+    _host_addresses = RTC_HOST_ADDRESSES or await loop.run_in_executor(
+        None, lambda: get_host_addresses(use_ipv4=True, use_ipv6=RTC_HOST_IPV6)
+    )
+
+    for url in {RTC_STUN_URL, RTC_LOCAL_STUN_URL} - {""}:
+        try:
+            _resolved_stun[url] = await loop.run_in_executor(None, _resolve_stun_url, url)
+        except OSError as e:
+            log_callback(f"[RTC] ⚠️ Không resolve được STUN {url}: {e}")
+
+    if RTC_LOCAL_STUN_PORT > 0 and _stun_stand_in is None:
+        await start_stun_stand_in(RTC_LOCAL_STUN_PORT, log_callback=log_callback)
+
+    log_callback(
+        f"[RTC] 🌐 Profile={RTC_PROFILE}, host={_host_addresses}, "
+        f"gather_timeout={RTC_GATHER_TIMEOUT_SEC}s"
+    )
+    return {"host_addresses": list(_host_addresses), "resolved_stun": dict(_resolved_stun)}
+
+
+def _ice_connections(pc):
+    """Connection aioice của mọi transport trong pc (bundle → thường chỉ 1)."""
+    transports = [t.sender.transport for t in pc.getTransceivers()]
+    if pc.sctp is not None:
+        transports.append(pc.sctp.transport)
+    seen = set()
+    for dtls in transports:
+        if dtls is None:
+            continue
+        connection = getattr(dtls.transport.iceGatherer, "_connection", None)
+        if connection is not None and id(connection) not in seen:
+            seen.add(id(connection))
+            yield connection
+
+
+# Trạng thái nội bộ aioice.Connection mà gather_candidates đọc / ghi
+_GATHER_STATE_ATTRS = ("_local_candidates_start", "_local_candidates_end", "_local_candidates", "_components")
+
+
+async def _gather_with_host_addresses(connection, addresses: List[str]):
+    """Connection.gather_candidates của aioice, nhưng dùng host address lấy sẵn."""
+    if connection._local_candidates_start:
+        return
+    connection._local_candidates_start = True
+    coros = [
+        connection.get_component_candidates(component=component, addresses=list(addresses))
+        for component in connection._components
+    ]
+    for candidates in await asyncio.gather(*coros):
+        connection._local_candidates += candidates
+    connection._local_candidates_end = True
+
+
+def tune_gather(pc, timeout: float = RTC_GATHER_TIMEOUT_SEC) -> int:
+    """
+    Gọi sau setRemoteDescription, trước setLocalDescription (lúc gather).
+    Giới hạn thời gian chờ srflx/relay; có host address lấy sẵn → thay
+    gather_candidates để bỏ get_host_addresses() của phiên.
+    Trả về số Connection đã chỉnh.
+    """
+    tuned = 0
+    for connection in _ice_connections(pc):
+        original = connection.get_component_candidates
+        wait = timeout if timeout > 0 else 5
+
+        async def get_component_candidates(component, addresses, timeout=wait, _original=original):
+            return await _original(component=component, addresses=addresses, timeout=timeout)
+
+        connection.get_component_candidates = get_component_candidates
+        if _host_addresses and all(hasattr(connection, a) for a in _GATHER_STATE_ATTRS):
+            connection.gather_candidates = functools.partial(
+                _gather_with_host_addresses, connection, _host_addresses
+            )
+        tuned += 1
+    return tuned
+
+
+# ============================================================
+# STUN STAND-IN (CHỈ BINDING, KHÔNG AUTH)
+# ============================================================
+class _StunStandInProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, stats: "RTCSetupStats"):
+        self.transport = None
+        self.stats = stats
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = stun.parse_message(data)
+        except ValueError:
+            return
+        if request.message_method != stun.Method.BINDING or request.message_class != stun.Class.REQUEST:
+            return
+        response = stun.Message(
+            message_method=stun.Method.BINDING,
+            message_class=stun.Class.RESPONSE,
+            transaction_id=request.transaction_id,
+        )
+        response.attributes["XOR-MAPPED-ADDRESS"] = addr[:2]
+        self.transport.sendto(bytes(response), addr)
+        self.stats.record_stun_request()
+
+
+async def start_stun_stand_in(port: int, host: str = "0.0.0.0", log_callback: Callable = print):
+    global _stun_stand_in
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _StunStandInProtocol(RTC_SETUP_STATS), local_addr=(host, port)
+    )
+    _stun_stand_in = transport
+    log_callback(f"[RTC] 📍 STUN stand-in lắng nghe udp {host}:{port}")
+    return transport
+
+
+def stop_stun_stand_in():
+    global _stun_stand_in
+    if _stun_stand_in is not None:
+        _stun_stand_in.close()
+        _stun_stand_in = None
+
+
+# ============================================================
+# ĐO THỜI GIAN THIẾT LẬP PHIÊN
+# ============================================================
+class SetupTimer:
+    """Mốc thời gian thiết lập 1 phiên: mark(phase) = ms kể từ mốc trước."""
+    __slots__ = ("profile", "phases", "started", "_last", "outcome")
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.phases: Dict[str, float] = {}
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.outcome: Optional[str] = None
+
+    def mark(self, phase: str) -> float:
+        now = time.perf_counter()
+        elapsed = (now - self._last) * 1000
+        self.phases[phase] = round(elapsed, 2)
+        self._last = now
+        return elapsed
+
+    def total_ms(self) -> float:
+        return round((self._last - self.started) * 1000, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"profile": self.profile, **self.phases, "total": self.total_ms()}
+
+
+class RTCSetupStats:
+    """Thống kê thời gian thiết lập phiên theo mốc, dùng chung toàn process."""
+
+    def __init__(self, window: int = RTC_SETUP_WINDOW):
+        self._lock = threading.Lock()
+        self.outcomes: Dict[str, int] = {}
+        self.by_profile: Dict[str, int] = {}
+        self.stun_requests = 0
+        self._phases: Dict[str, deque] = {p: deque(maxlen=window) for p in SETUP_PHASES + ("total",)}
+
+    def record(self, timer: SetupTimer, outcome: str):
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.by_profile[timer.profile] = self.by_profile.get(timer.profile, 0) + 1
+            if outcome != "connected":
+                return
+            for phase, ms in timer.phases.items():
+                if phase in self._phases:
+                    self._phases[phase].append(ms)
+            self._phases["total"].append(timer.total_ms())
+
+    def record_stun_request(self):
+        with self._lock:
+            self.stun_requests += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = {}
+            for phase, values in self._phases.items():
+                if not values:
+                    continue
+                ordered = sorted(values)
+                phases[phase] = {
+                    "count": len(ordered),
+                    "avg_ms": round(sum(ordered) / len(ordered), 2),
+                    "p50_ms": percentile(ordered, 0.50),
+                    "p95_ms": percentile(ordered, 0.95),
+                    "max_ms": ordered[-1],
+                }
+            return {
+                "profile": RTC_PROFILE,
+                "gather_timeout_sec": RTC_GATHER_TIMEOUT_SEC,
+                "host_addresses": list(_host_addresses or []),
+                "outcomes": dict(self.outcomes),
+                "by_profile": dict(self.by_profile),
+                "stun_stand_in": {
+                    "port": RTC_LOCAL_STUN_PORT if _stun_stand_in is not None else None,
+                    "requests": self.stun_requests,
+                },
+                "phases": phases,
+            }
+
+
+RTC_SETUP_STATS = RTCSetupStats()
+
+
+def watch_setup(pc, timer: SetupTimer, stats: RTCSetupStats = RTC_SETUP_STATS,
+                log_callback: Optional[Callable] = None):
+    """Chốt mốc "connected" (ICE + DTLS xong) hoặc ghi phiên thiết lập thất bại."""
+
+    @pc.on("connectionstatechange")
+    def on_setup_state():
+        if timer.outcome is not None:
+            return
+        state = pc.connectionState
+        if state == "connected":
+            timer.mark("connected")
+        elif state not in ("failed", "closed"):
+            return
+        timer.outcome = state
+        stats.record(timer, state)
+        if log_callback is not None:
+            log_callback(f"[RTC] ⏱️ Thiết lập phiên ({timer.profile}) → {state}: {timer.to_dict()}")
@@ -0,0 +1,202 @@
+# ai_modules/session_registry.py
+"""
+Registry vòng đời các phiên WebRTC.
+
+Mỗi /offer (hoặc /ws/audio) đăng ký một RTCSession giữ peer connection
+(hoặc WebSocketChannel), recorder, bot track và các task xử lý lượt. Phiên bị đóng khi:
+  - ICE / connection state chuyển sang failed hoặc closed
+  - không có hoạt động quá RTC_SESSION_IDLE_TIMEOUT_SEC
+  - client gửi hangup
+Đóng phiên = huỷ lượt đang chạy, dừng đọc track, đóng pc (giải phóng cổng
+UDP), xoá state hội thoại → bộ nhớ không tăng dần trên node chạy lâu.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Set
+
+RTC_SESSION_IDLE_TIMEOUT_SEC = float(os.getenv("RTC_SESSION_IDLE_TIMEOUT_SEC", "300"))
+RTC_SESSION_SWEEP_INTERVAL_SEC = float(os.getenv("RTC_SESSION_SWEEP_INTERVAL_SEC", "30"))
+
+
+class RTCSession:
+    """Các object sống theo một peer connection."""
+    __slots__ = (
+        "session_id", "pc", "recorder", "bot_track", "barge_in", "dialog_session",
+        "tasks", "created_at", "last_activity", "closed", "close_reason", "setup",
+    )
+
+    def __init__(self, session_id: str, pc, recorder=None, bot_track=None,
+                 barge_in=None, dialog_session=None, setup=None):
+        now = time.monotonic()
+        self.session_id = session_id
+        self.pc = pc
+        self.recorder = recorder
+        self.bot_track = bot_track
+        self.barge_in = barge_in
+        self.dialog_session = dialog_session
+        self.tasks: Set[asyncio.Task] = set()
+        self.created_at = now
+        self.last_activity = now
+        self.closed = False
+        self.close_reason: Optional[str] = None
+        # SetupTimer (ai_modules/rtc_setup.py) — mốc thời gian thiết lập phiên
+        self.setup = setup
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def add_task(self, task: asyncio.Task) -> asyncio.Task:
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def memory_bytes(self) -> int:
+        """Ước tính bộ nhớ audio / state phiên đang giữ."""
+        total = 0
+        if self.recorder is not None:
+            total += self.recorder.buffered_bytes
+        if self.bot_track is not None:
+            total += int(self.bot_track.buffered_seconds * self.bot_track.sample_rate * 2)
+        if self.dialog_session is not None:
+            total += self.dialog_session.size_bytes
+        return total
+
+    def to_dict(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "session_id": self.session_id,
+            "connection_state": getattr(self.pc, "connectionState", None),
+            "age_sec": round(now - self.created_at, 1),
+            "idle_sec": round(now - self.last_activity, 1),
+            "tasks": len(self.tasks),
+            "memory_bytes": self.memory_bytes(),
+            "setup_ms": self.setup.to_dict() if self.setup is not None else None,
+        }
+
+
+class SessionRegistry:
+
+    def __init__(self, idle_timeout: float = RTC_SESSION_IDLE_TIMEOUT_SEC,
+                 sweep_interval: float = RTC_SESSION_SWEEP_INTERVAL_SEC,
+                 on_closed: Optional[Callable[[RTCSession], None]] = None,
+                 log_callback: Callable = print):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._on_closed = on_closed
+        self._log = log_callback
+        self._sessions: Dict[str, RTCSession] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.opened_total = 0
+        self.closed_total = 0
+        self.close_reasons: Dict[str, int] = {}
+
+    # ========================================================
+    # ĐĂNG KÝ / THEO DÕI
+    # ========================================================
+    def register(self, session: RTCSession) -> RTCSession:
+        old = self._sessions.get(session.session_id)
+        if old is not None and old is not session:
+            # Client mở lại phiên cùng session_id → đóng kết nối cũ
+            asyncio.create_task(self._close_session(old, "replaced"))
+        self._sessions[session.session_id] = session
+        self.opened_total += 1
+        self._watch(session)
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+        return session
+
+    def _watch(self, session: RTCSession):
+        pc = session.pc
+        if not hasattr(pc, "on"):
+            # WebSocketChannel: endpoint tự đóng phiên khi socket ngắt
+            return
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            if pc.connectionState in ("failed", "closed"):
+                await self._close_session(session, f"connection_{pc.connectionState}")
+
+        @pc.on("iceconnectionstatechange")
+        async def on_iceconnectionstatechange():
+            if pc.iceConnectionState == "failed":
+                await self._close_session(session, "ice_failed")
+
+    def get(self, session_id: str) -> Optional[RTCSession]:
+        return self._sessions.get(session_id)
+
+    # ========================================================
+    # ĐÓNG PHIÊN
+    # ========================================================
+    async def close(self, session_id: str, reason: str = "closed") -> bool:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return False
+        return await self._close_session(session, reason)
+
+    async def _close_session(self, session: RTCSession, reason: str) -> bool:
+        if session.closed:
+            return False
+        session.closed = True
+        session.close_reason = reason
+        session_id = session.session_id
+        if self._sessions.get(session_id) is session:
+            del self._sessions[session_id]
+
+        # 1) Huỷ lượt đang xử lý (hợp tác qua token + huỷ task chờ pipeline)
+        if session.barge_in is not None:
+            session.barge_in.cancel_turn(reason)
+        for task in list(session.tasks):
+            task.cancel()
+        # 2) Dừng đọc track, bỏ audio chưa phát
+        if session.recorder is not None:
+            session.recorder.close()
+        if session.bot_track is not None:
+            session.bot_track.clear()
+            session.bot_track.stop()
+        # 3) Đóng peer connection (giải phóng ICE / DTLS / cổng UDP)
+        try:
+            await session.pc.close()
+        except Exception as e:
+            self._log(f"[Sessions] ⚠️ Lỗi đóng peer connection {session_id}: {e}")
+
+        self.closed_total += 1
+        self.close_reasons[reason] = self.close_reasons.get(reason, 0) + 1
+        if self._on_closed:
+            self._on_closed(session)
+        self._log(f"[Sessions] 📴 Đóng phiên {session_id} ({reason}), còn {len(self._sessions)} phiên")
+        return True
+
+    async def close_all(self, reason: str = "shutdown"):
+        for session in list(self._sessions.values()):
+            await self._close_session(session, reason)
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+
+    async def _sweep_loop(self):
+        while self._sessions:
+            await asyncio.sleep(self.sweep_interval)
+            deadline = time.monotonic() - self.idle_timeout
+            for session in list(self._sessions.values()):
+                if session.last_activity < deadline and not session.tasks:
+                    await self._close_session(session, "idle_timeout")
+
+    # ========================================================
+    # THỐNG KÊ
+    # ========================================================
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self, include_sessions: bool = True) -> Dict[str, Any]:
+        sessions = [s.to_dict() for s in self._sessions.values()]
+        result = {
+            "live_sessions": len(sessions),
+            "memory_bytes_total": sum(s["memory_bytes"] for s in sessions),
+            "opened_total": self.opened_total,
+            "closed_total": self.closed_total,
+            "close_reasons": dict(self.close_reasons),
+            "idle_timeout_sec": self.idle_timeout,
+        }
+        if include_sessions:
+            result["sessions"] = sessions
+        return result
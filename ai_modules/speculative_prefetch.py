@@ -0,0 +1,206 @@
+# ai_modules/speculative_prefetch.py
+"""
+Speculative NLU + DB prefetch trên transcript tạm (partial).
+
+Trong lúc người dùng còn đang nói, recorder định kỳ đưa vài giây PCM cuối
+cho ASR chạy nhanh một lượt (trên executor của stage ASR). Khi transcript tạm ổn định (lặp lại N lần liên tiếp),
+Parser → LogicManager.handle_nlu_result → DB.query_data được chạy trước
+trong thread. Khi có transcript cuối:
+  - intent + entities trùng → dùng lại kết quả (HIT), bỏ qua NLU/DB trên
+    đường găng của lượt hội thoại.
+  - khác → bỏ kết quả speculative (MISS), pipeline chạy bình thường.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+NO_SPEECH_TEXT = "[NO SPEECH DETECTED]"
+
+
+class SpeculationStats:
+    """Thống kê speculation dùng chung toàn process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.wasted_ms = 0.0
+
+    def record(self, hit: bool, cost_ms: float):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.saved_ms += cost_ms
+            else:
+                self.misses += 1
+                self.wasted_ms += cost_ms
+
+    def record_attempt(self):
+        with self._lock:
+            self.attempts += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            resolved = self.hits + self.misses
+            return {
+                "attempts": self.attempts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / resolved, 4) if resolved else 0.0,
+                "saved_ms_total": round(self.saved_ms, 2),
+                "saved_ms_avg": round(self.saved_ms / self.hits, 2) if self.hits else 0.0,
+                "wasted_ms_total": round(self.wasted_ms, 2),
+            }
+
+
+SPECULATION_STATS = SpeculationStats()
+
+
+class SpeculativeResult:
+    __slots__ = ("text", "nlu_json", "decision", "db_result", "cost_ms")
+
+    def __init__(self, text, nlu_json, decision, db_result, cost_ms):
+        self.text = text
+        self.nlu_json = nlu_json
+        self.decision = decision
+        self.db_result = db_result
+        self.cost_ms = cost_ms
+
+
+class SpeculativePrefetcher:
+    """
+    Một instance cho mỗi session WebRTC.
+
+    feed_audio(pcm, transcribe_fn)  ← recorder gọi định kỳ khi đang ghi
+    resolve(final_nlu_json)         ← pipeline gọi khi có transcript cuối
+    """
+
+    def __init__(self, parser, logic_manager, db, log_callback=print,
+                 stable_hits: int = 2, stats: SpeculationStats = SPECULATION_STATS):
+        self._parser = parser
+        self._logic = logic_manager
+        self._db = db
+        self._log = log_callback
+        self.stable_hits = max(1, stable_hits)
+        self.stats = stats
+
+        self._last_partial = ""
+        self._stable_count = 0
+        self._speculated_text: Optional[str] = None
+        self._asr_busy = False
+        self._task: Optional[asyncio.Task] = None
+        self._result: Optional[SpeculativeResult] = None
+
+    # ========================================================
+    # PARTIAL ASR
+    # ========================================================
+    async def feed_audio(self, pcm: bytes, transcribe_fn: Callable[[bytes], str],
+                         run_blocking: Optional[Callable[..., Awaitable[Any]]] = None):
+        """
+        Chạy ASR tạm trên PCM đã ghi (bỏ qua nếu lượt trước chưa xong).
+        run_blocking: chạy transcribe_fn trên executor riêng (vd PipelineStage.run_blocking
+        của stage ASR); không truyền → asyncio.to_thread.
+        """
+        if self._asr_busy or not pcm:
+            return
+        self._asr_busy = True
+        try:
+            text = await (run_blocking or asyncio.to_thread)(transcribe_fn, pcm)
+        except Exception as e:
+            self._log(f"[Speculative] ⚠️ Partial ASR lỗi: {e}")
+            return
+        finally:
+            self._asr_busy = False
+        self.on_partial(text)
+
+    def on_partial(self, text: str):
+        text = (text or "").strip()
+        if not text or text == NO_SPEECH_TEXT:
+            return
+
+        normalized = text.lower()
+        if normalized == self._last_partial:
+            self._stable_count += 1
+        else:
+            self._last_partial = normalized
+            self._stable_count = 1
+
+        if self._stable_count < self.stable_hits or normalized == self._speculated_text:
+            return
+
+        # Transcript tạm đã ổn định → chạy speculative NLU + DB
+        self._speculated_text = normalized
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self.stats.record_attempt()
+        self._log(f"[Speculative] 🔮 Transcript ổn định: '{text}' → prefetch NLU/DB")
+        self._task = asyncio.create_task(self._speculate(text))
+
+    async def _speculate(self, text: str):
+        try:
+            result = await asyncio.to_thread(self._run_stages, text)
+            self._result = result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._log(f"[Speculative] ⚠️ Prefetch lỗi: {e}")
+            self._result = None
+
+    def _run_stages(self, text: str) -> SpeculativeResult:
+        t0 = time.perf_counter()
+        nlu_json = self._parser.convert({"text_response": {"user_text": text}})
+        decision = self._logic.handle_nlu_result(nlu_json)
+        try:
+            db_result = self._db.query_data(nlu_json.get("intent"), nlu_json.get("entities", {}))
+        except Exception as e:
+            self._log(f"[Speculative] DB lỗi: {e}")
+            db_result = {}
+        cost_ms = (time.perf_counter() - t0) * 1000
+        return SpeculativeResult(text, nlu_json, decision, db_result, cost_ms)
+
+    # ========================================================
+    # KẾT QUẢ CUỐI
+    # ========================================================
+    async def resolve(self, final_nlu_json: Dict[str, Any],
+                      wait_timeout: float = 0.05) -> Optional[SpeculativeResult]:
+        """
+        So khớp kết quả speculative với NLU của transcript cuối.
+        Trả về SpeculativeResult nếu HIT, None nếu MISS / không có speculation.
+        """
+        task = self._task
+        if task is not None and not task.done():
+            # Speculation sắp xong thì chờ một chút, không thì bỏ
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=wait_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                task.cancel()
+
+        result = self._result
+        self.reset()
+        if result is None:
+            return None
+
+        spec_nlu = result.nlu_json
+        hit = (
+            spec_nlu.get("intent") == final_nlu_json.get("intent")
+            and spec_nlu.get("entities", {}) == final_nlu_json.get("entities", {})
+        )
+        self.stats.record(hit, result.cost_ms)
+        self._log(
+            f"[Speculative] {'✅ HIT' if hit else '❌ MISS'} "
+            f"(intent={spec_nlu.get('intent')}, cost={result.cost_ms:.1f}ms)"
+        )
+        return result if hit else None
+
+    def reset(self):
+        """Xoá trạng thái speculation cho lượt nói tiếp theo."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._task = None
+        self._result = None
+        self._last_partial = ""
+        self._stable_count = 0
+        self._speculated_text = None
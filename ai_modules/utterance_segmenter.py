@@ -0,0 +1,81 @@
+# ai_modules/utterance_segmenter.py
+"""
+Tách track audio liên tục thành từng lượt nói bằng VAD năng lượng.
+
+Dùng cho phiên hội thoại liên tục (segmentation="vad"): một peer connection
+cho cả phiên, recorder không dừng. Khi đang nghỉ:
+  - >= VAD_SEG_MIN_SPEECH_MS trên ngưỡng → on_start(preroll) (kèm vài trăm
+    ms audio trước đó để không mất âm đầu)
+Khi đang ghi:
+  - im lặng >= VAD_SEG_END_SILENCE_MS hoặc quá VAD_SEG_MAX_UTTERANCE_SEC → on_end()
+Lượt trước được xử lý trong pipeline trong khi lượt sau đã được ghi.
+"""
+import os
+from collections import deque
+from typing import Callable
+
+from ai_modules.barge_in import frame_dbfs
+
+VAD_SEG_THRESHOLD_DBFS = float(os.getenv("VAD_SEG_THRESHOLD_DBFS", "-40"))
+VAD_SEG_MIN_SPEECH_MS = float(os.getenv("VAD_SEG_MIN_SPEECH_MS", "150"))
+VAD_SEG_END_SILENCE_MS = float(os.getenv("VAD_SEG_END_SILENCE_MS", "700"))
+VAD_SEG_MAX_UTTERANCE_SEC = float(os.getenv("VAD_SEG_MAX_UTTERANCE_SEC", "15"))
+VAD_SEG_PREROLL_MS = float(os.getenv("VAD_SEG_PREROLL_MS", "300"))
+
+
+class UtteranceSegmenter:
+
+    def __init__(self, on_start: Callable[[bytes], None], on_end: Callable[[], None],
+                 is_recording: Callable[[], bool], sample_rate: int = 16000,
+                 threshold_dbfs: float = VAD_SEG_THRESHOLD_DBFS,
+                 min_speech_ms: float = VAD_SEG_MIN_SPEECH_MS,
+                 end_silence_ms: float = VAD_SEG_END_SILENCE_MS,
+                 max_utterance_sec: float = VAD_SEG_MAX_UTTERANCE_SEC,
+                 preroll_ms: float = VAD_SEG_PREROLL_MS):
+        self._on_start = on_start
+        self._on_end = on_end
+        self._is_recording = is_recording
+        self.sample_rate = sample_rate
+        self.threshold_dbfs = threshold_dbfs
+        self.min_speech_ms = min_speech_ms
+        self.end_silence_ms = end_silence_ms
+        self.max_utterance_ms = max_utterance_sec * 1000
+        self._preroll_max_bytes = int(preroll_ms * sample_rate / 1000) * 2
+
+        self._preroll: deque = deque()
+        self._preroll_bytes = 0
+        self._speech_ms = 0.0
+        self._silence_ms = 0.0
+        self._utterance_ms = 0.0
+
+    def feed(self, pcm: bytes):
+        frame_ms = len(pcm) / 2 / self.sample_rate * 1000
+        loud = frame_dbfs(pcm) >= self.threshold_dbfs
+
+        if not self._is_recording():
+            self._speech_ms = self._speech_ms + frame_ms if loud else 0.0
+            if self._speech_ms >= self.min_speech_ms:
+                preroll = b"".join(self._preroll)
+                self._reset_idle()
+                self._utterance_ms = self._silence_ms = 0.0
+                self._on_start(preroll)
+            else:
+                self._push_preroll(pcm)
+            return
+
+        self._utterance_ms += frame_ms
+        self._silence_ms = 0.0 if loud else self._silence_ms + frame_ms
+        if self._silence_ms >= self.end_silence_ms or self._utterance_ms >= self.max_utterance_ms:
+            self._utterance_ms = self._silence_ms = 0.0
+            self._on_end()
+
+    def _push_preroll(self, pcm: bytes):
+        self._preroll.append(pcm)
+        self._preroll_bytes += len(pcm)
+        while self._preroll and self._preroll_bytes - len(self._preroll[0]) >= self._preroll_max_bytes:
+            self._preroll_bytes -= len(self._preroll.popleft())
+
+    def _reset_idle(self):
+        self._preroll.clear()
+        self._preroll_bytes = 0
+        self._speech_ms = 0.0
@@ -0,0 +1,331 @@
+# ai_modules/voice_pipeline.py
+"""
+Event-Driven Asynchronous Pipeline: đồ thị stage VAD/ASR → NLU → DM → TTS.
+
+Mỗi stage có:
+  - asyncio.Queue riêng (bounded) → backpressure: stage sau đầy thì worker
+    stage trước chờ, hàng đợi đầu vào đầy thì submit() chờ
+  - số worker riêng (concurrency)
+  - ThreadPoolExecutor riêng cho việc blocking (Whisper, gTTS, decode audio...)
+  - metrics: độ sâu hàng đợi, thời gian xử lý, số lỗi (+ histogram
+    Prometheus theo stage / mode trong core/metrics.py)
+
+Một TurnContext đi xuyên suốt các stage; /offer và /api/upload_wav cùng
+submit vào một VoicePipeline.
+"""
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from core.cancellation import CANCELLATION_STATS, CancellationToken, TurnCancelled, run_cancellable
+from core.metrics import STAGE_LATENCY, STAGE_QUEUE_WAIT, TURN_LATENCY
+from core.tracing import TRACER, bind, next_turn_id, unbind, wrap_job
+
+
+class TurnContext:
+    """Dữ liệu của một lượt hội thoại chảy qua các stage."""
+    __slots__ = (
+        "session_id", "session", "api_key", "source", "record_file",
+        "data_channel", "prefetcher", "prefetched", "cancel_token",
+        "user_text", "nlu_json", "decision", "dm_response", "bot_text",
+        "tts_text", "audio_sink", "audio_transport", "audio_url",
+        "timings", "created_at", "enqueued_at", "future", "turn_id",
+    )
+
+    def __init__(self, session_id: str, record_file: str, source: str = "rtc",
+                 session=None, api_key: Optional[str] = None,
+                 data_channel=None, prefetcher=None):
+        self.session_id = session_id
+        self.session = session
+        self.api_key = api_key
+        self.source = source              # "rtc" | "upload"
+        self.record_file = record_file
+        self.data_channel = data_channel
+        self.prefetcher = prefetcher
+        self.prefetched: Optional[Dict[str, Any]] = None
+        self.cancel_token: Optional[CancellationToken] = None
+
+        self.user_text = ""
+        self.nlu_json: Dict[str, Any] = {}
+        self.decision: Dict[str, Any] = {}
+        self.dm_response: Dict[str, Any] = {}
+        self.bot_text = ""
+        self.tts_text = ""
+        self.audio_sink: Optional[Callable[[bytes], None]] = None   # nhận PCM theo từng mảnh TTS
+        self.audio_transport: Optional[str] = None                  # "track" | "datachannel"
+        self.audio_url: Optional[str] = None
+
+        self.timings: Dict[str, float] = {}
+        self.created_at = time.perf_counter()
+        self.enqueued_at = self.created_at
+        self.future: Optional[asyncio.Future] = None
+        self.turn_id = next_turn_id()
+
+    def observe_turn(self, outcome: str):
+        now = time.perf_counter()
+        TURN_LATENCY.observe((now - self.created_at) * 1000, mode=self.source, outcome=outcome)
+        TRACER.add(self.session_id, "turn", self.created_at, now, track="turns", cat="turn",
+                   turn=self.turn_id, source=self.source, outcome=outcome)
+
+    def send(self, payload: Dict[str, Any]):
+        """Gửi JSON qua DataChannel (nếu phiên có DataChannel và còn mở)."""
+        ch = self.data_channel
+        if ch is None or getattr(ch, "readyState", "open") != "open":
+            return
+        try:
+            message = json.dumps(payload, ensure_ascii=False)
+            ch.send(message)
+            TRACER.instant(self.session_id, f"send:{payload.get('type')}", track="datachannel",
+                           cat="io", turn=self.turn_id, bytes=len(message))
+        except Exception:
+            pass
+
+
+# Số mẫu độ trễ gần nhất giữ cho p95 theo cửa sổ thời gian (admission control)
+STAGE_LATENCY_WINDOW = int(os.getenv("PIPELINE_LATENCY_WINDOW", "500"))
+
+
+StageHandler = Callable[[TurnContext, "PipelineStage"], Awaitable[None]]
+
+
+class PipelineStage:
+    """Một stage: hàng đợi bounded + N worker + executor riêng."""
+
+    def __init__(self, name: str, handler: StageHandler, workers: int = 1,
+                 queue_size: int = 8, executor_threads: Optional[int] = None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_threads or self.workers,
+            thread_name_prefix=f"stage-{name}",
+        )
+        self.queue: Optional[asyncio.Queue] = None
+        self.next_stage: Optional["PipelineStage"] = None
+
+        # metrics
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.busy = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.queue_wait_ms = 0.0
+        self.max_queue_depth = 0
+        # (thời điểm, chờ hàng đợi + xử lý ms) của các turn gần đây
+        self._recent = deque(maxlen=STAGE_LATENCY_WINDOW)
+
+    async def run_blocking(self, fn: Callable, *args, **kwargs):
+        """Chạy hàm blocking trên executor riêng của stage (không chặn event loop)."""
+        loop = asyncio.get_running_loop()
+        job = wrap_job(fn, f"pipeline:{self.name}")
+        return await loop.run_in_executor(self.executor, functools.partial(job, *args, **kwargs))
+
+    async def run_cancellable(self, token: Optional[CancellationToken], fn: Callable, *args):
+        """
+        Như run_blocking, nhưng job chưa chạy bị rút khỏi executor khi token bị huỷ
+        (tiết kiệm ước tính = thời gian xử lý trung bình của stage).
+        """
+        job = wrap_job(fn, f"pipeline:{self.name}")
+        return await run_cancellable(self.executor, token, job, *args,
+                                     stage=self.name, expected_ms=self.avg_ms())
+
+    def avg_ms(self) -> float:
+        with self._lock:
+            return self.total_ms / self.processed if self.processed else 0.0
+
+    def _record(self, elapsed_ms: float, wait_ms: float, ok: bool):
+        with self._lock:
+            self.processed += 1
+            if not ok:
+                self.errors += 1
+            self.total_ms += elapsed_ms
+            self.queue_wait_ms += wait_ms
+            self._recent.append((time.monotonic(), wait_ms + elapsed_ms))
+            if elapsed_ms > self.max_ms:
+                self.max_ms = elapsed_ms
+
+    def recent_p95_ms(self, window_sec: float = 30.0) -> float:
+        """p95 (chờ hàng đợi + xử lý) của các turn trong window_sec gần nhất."""
+        since = time.monotonic() - window_sec
+        with self._lock:
+            values = sorted(ms for t, ms in self._recent if t >= since)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+    def metrics(self) -> Dict[str, Any]:
+        depth = self.queue.qsize() if self.queue is not None else 0
+        p95 = self.recent_p95_ms()
+        with self._lock:
+            n = self.processed or 1
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": depth,
+                "max_queue_depth": self.max_queue_depth,
+                "busy": self.busy,
+                "processed": self.processed,
+                "errors": self.errors,
+                "cancelled": self.cancelled,
+                "avg_ms": round(self.total_ms / n, 2),
+                "max_ms": round(self.max_ms, 2),
+                "avg_queue_wait_ms": round(self.queue_wait_ms / n, 2),
+                "recent_p95_ms": round(p95, 2),
+            }
+
+
+class VoicePipeline:
+    """Đồ thị stage tuyến tính, worker khởi động lười khi có turn đầu tiên."""
+
+    def __init__(self, stages: List[PipelineStage], log_callback=print):
+        if not stages:
+            raise ValueError("VoicePipeline cần ít nhất 1 stage")
+        self.stages = stages
+        self._log = log_callback
+        for cur, nxt in zip(stages, stages[1:]):
+            cur.next_stage = nxt
+        self._workers: List[asyncio.Task] = []
+        self._started = False
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+        for stage in self.stages:
+            for i in range(stage.workers):
+                self._workers.append(
+                    asyncio.create_task(self._worker(stage), name=f"pipeline-{stage.name}-{i}")
+                )
+        self._started = True
+        self._log(
+            "[Pipeline] ▶️ Khởi động: "
+            + " → ".join(f"{s.name}(x{s.workers}, q={s.queue_size})" for s in self.stages)
+        )
+
+    async def _enqueue(self, stage: PipelineStage, ctx: TurnContext):
+        ctx.enqueued_at = time.perf_counter()
+        await stage.queue.put(ctx)          # chờ nếu đầy → backpressure
+        depth = stage.queue.qsize()
+        if depth > stage.max_queue_depth:
+            stage.max_queue_depth = depth
+
+    async def submit(self, ctx: TurnContext) -> TurnContext:
+        """Đưa 1 turn vào pipeline và chờ tới khi stage cuối xử lý xong."""
+        self._ensure_started()
+        if ctx.cancel_token is None:
+            ctx.cancel_token = CancellationToken()
+        ctx.future = asyncio.get_running_loop().create_future()
+        try:
+            await self._enqueue(self.stages[0], ctx)
+            return await ctx.future
+        except asyncio.CancelledError:
+            # Caller bỏ đi (phiên đóng, client ngắt) → dừng cả job đang chạy trong executor
+            ctx.cancel_token.cancel("caller_cancelled")
+            raise
+
+    def remaining_ms(self, stage: PipelineStage) -> float:
+        """Ước tính thời gian xử lý trung bình từ stage này tới cuối pipeline."""
+        idx = self.stages.index(stage)
+        return sum(s.avg_ms() for s in self.stages[idx:])
+
+    def stage(self, stage_name: str) -> Optional[PipelineStage]:
+        for stage in self.stages:
+            if stage.name == stage_name:
+                return stage
+        return None
+
+    def queue_depth(self, stage_name: str) -> int:
+        stage = self.stage(stage_name)
+        if stage is not None and stage.queue is not None:
+            return stage.queue.qsize()
+        return 0
+
+    async def _worker(self, stage: PipelineStage):
+        while True:
+            ctx: TurnContext = await stage.queue.get()
+            started = time.perf_counter()
+            wait_ms = (started - ctx.enqueued_at) * 1000
+            stage.busy += 1
+            ok = True
+            dropped = False
+            try:
+                if ctx.future is not None and ctx.future.done():
+                    # caller đã huỷ turn → bỏ qua
+                    dropped = True
+                    stage.cancelled += 1
+                    CANCELLATION_STATS.record_turn(stage.name, "caller_cancelled", self.remaining_ms(stage))
+                    continue
+                if ctx.cancel_token is not None and ctx.cancel_token.cancelled:
+                    # Lượt đã bị huỷ (barge-in...) → bỏ các stage còn lại
+                    dropped = True
+                    ctx.cancel_token.raise_if_cancelled(stage.name, self.remaining_ms(stage))
+                trace_token = bind(ctx.session_id, ctx.turn_id)
+                try:
+                    await stage.handler(ctx, stage)
+                finally:
+                    unbind(trace_token)
+            except asyncio.CancelledError:
+                raise
+            except TurnCancelled as e:
+                stage.cancelled += 1
+                if not dropped and stage.next_stage is not None:
+                    # Huỷ giữa stage: e.saved_ms = phần còn lại của stage này (handler ước tính,
+                    # job bị rút khỏi executor trước khi chạy → trung bình của cả stage)
+                    e.saved_ms += self.remaining_ms(stage.next_stage)
+                CANCELLATION_STATS.record_turn(stage.name, e.reason, e.saved_ms)
+                ctx.observe_turn("cancelled")
+                if ctx.future is not None and not ctx.future.done():
+                    ctx.future.set_exception(e)
+                continue
+            except Exception as e:
+                ok = False
+                self._log(f"[Pipeline][{stage.name}][{ctx.session_id}] ❌ Lỗi: {e}")
+                ctx.observe_turn("error")
+                if ctx.future is not None and not ctx.future.done():
+                    ctx.future.set_exception(e)
+                continue
+            finally:
+                stage.busy -= 1
+                if not dropped:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    ctx.timings[f"{stage.name}_ms"] = round(elapsed_ms, 2)
+                    ctx.timings[f"{stage.name}_queue_ms"] = round(wait_ms, 2)
+                    stage._record(elapsed_ms, wait_ms, ok)
+                    STAGE_LATENCY.observe(elapsed_ms, stage=stage.name, mode=ctx.source)
+                    STAGE_QUEUE_WAIT.observe(wait_ms, stage=stage.name, mode=ctx.source)
+                    track = f"pipeline:{stage.name}"
+                    # Track riêng cho chờ hàng đợi: lượt sau chờ trong khi lượt trước đang xử lý
+                    TRACER.add(ctx.session_id, "queue_wait", ctx.enqueued_at, started,
+                               track=f"queue:{stage.name}", cat="queue", turn=ctx.turn_id)
+                    TRACER.add(ctx.session_id, stage.name, started, started + elapsed_ms / 1000, track=track,
+                               cat="stage", turn=ctx.turn_id, ok=ok)
+                stage.queue.task_done()
+
+            if stage.next_stage is not None:
+                await self._enqueue(stage.next_stage, ctx)
+            elif ctx.future is not None and not ctx.future.done():
+                ctx.timings["total_ms"] = round((time.perf_counter() - ctx.created_at) * 1000, 2)
+                ctx.observe_turn("ok")
+                ctx.future.set_result(ctx)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {stage.name: stage.metrics() for stage in self.stages}
+
+    async def shutdown(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for stage in self.stages:
+            stage.executor.shutdown(wait=False, cancel_futures=True)
+        self._workers.clear()
+        self._started = False
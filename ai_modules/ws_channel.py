@@ -0,0 +1,62 @@
+# ai_modules/ws_channel.py
+"""
+WebSocket (Starlette) với giao diện tối thiểu giống RTCDataChannel /
+peer connection mà pipeline và SessionRegistry dùng:
+send(str | bytes), readyState, connectionState, close().
+
+send() đồng bộ (gọi từ callback của pipeline) → đưa vào hàng đợi, một
+task gửi tuần tự để giữ thứ tự message (text_response trước audio...).
+"""
+import asyncio
+import os
+from typing import Union
+
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "512"))
+
+
+class WebSocketChannel:
+    label = "ws"
+
+    def __init__(self, websocket, max_queue: int = WS_SEND_QUEUE_MAX):
+        self._ws = websocket
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.readyState = "open"
+        self.dropped = 0
+        self._sender = asyncio.create_task(self._send_loop())
+
+    @property
+    def connectionState(self) -> str:
+        return "connected" if self.readyState == "open" else "closed"
+
+    def send(self, data: Union[str, bytes]):
+        if self.readyState != "open":
+            return
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Client đọc quá chậm → bỏ message thay vì giữ RAM không giới hạn
+            self.dropped += 1
+
+    async def _send_loop(self):
+        try:
+            while True:
+                data = await self._queue.get()
+                if isinstance(data, str):
+                    await self._ws.send_text(data)
+                else:
+                    await self._ws.send_bytes(bytes(data))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket đã đóng phía client
+            self.readyState = "closed"
+
+    async def close(self):
+        if self.readyState == "closed" and self._sender.done():
+            return
+        self.readyState = "closed"
+        self._sender.cancel()
+        try:
+            await self._ws.close()
+        except Exception:
+            pass
@@ -10,34 +10,52 @@ import warnings
 from typing import Dict, Any, Optional, Callable
 from pathlib import Path
 import traceback 
-from fastapi import FastAPI, Request, UploadFile, File, Form
+from fastapi import FastAPI, Request, UploadFile, File, Form, WebSocket, WebSocketDisconnect, Depends, Header, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack, RTCConfiguration, RTCIceServer
+from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
 from aiortc.exceptions import InvalidStateError
+from aiortc.mediastreams import MediaStreamError
 
 # Routers
 from routers import products, orders, promotions, payment
 
 # WebRTC Pipeline
-from ai_modules.rtc_integration_layer import RTCStreamProcessor, SAMPLE_RATE, INTERNAL_API_KEY
+from ai_modules.rtc_integration_layer import RTCStreamProcessor, SAMPLE_RATE, INTERNAL_API_KEY, VOICE_STUB_MODE
 
 # === MODULES MỚI (NLU → LOGIC → DIALOG) ===
-from core.logic_manager import LogicManager
+from core.logic_manager import LogicManager, PAYMENT_OPENED_TEXT
 from ai_modules.dialog_manager import DialogManager
+from ai_modules.response_generator import split_templated_reply, template_fixed_segments
 from core.stt_log_parser import STTLogParser
 from core.json_loader import JSONLogLoader
+from core.session_store import SessionStore, DialogSession
+from ai_modules.speculative_prefetch import SpeculativePrefetcher, SPECULATION_STATS
+from ai_modules.voice_pipeline import VoicePipeline, PipelineStage, TurnContext
+from ai_modules.bot_audio_track import BotAudioTrack
+from ai_modules.barge_in import BargeInController, BARGE_IN_STATS
+from ai_modules.utterance_segmenter import UtteranceSegmenter
+from ai_modules.session_registry import SessionRegistry, RTCSession
+from ai_modules.admission import AdmissionController
+from ai_modules.pcm_ingest import PcmIngest, PCM_INGEST_CHANNEL, PCM_INGEST_STATS
+from ai_modules.ws_channel import WebSocketChannel
+from ai_modules.rtc_setup import (
+    RTC_SETUP_STATS, SetupTimer, resolve_profile, rtc_configuration, client_ice_servers,
+    prepare_rtc, stop_stun_stand_in, tune_gather, watch_setup,
+)
+from core.cancellation import TurnCancelled, CancellationToken, CANCELLATION_STATS
+from core.tts_connector import TTSClient, TTS_SAMPLE_RATE, split_segments
+from core.tts_phrase_cache import PhraseCache
+from core.audio_store import AudioStore, pcm_to_wav_bytes
+from core.metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, observe_step, timed_call
+from core.tracing import TRACER
+from core.loop_monitor import LoopMonitor, LOOP_MONITOR_ENABLED
+from core.profiler import SamplingProfiler, MemoryTracker, ProfilerBusy
 
 import base64
-from gtts import gTTS
-
-# ============================================================
-# 🔧 FIX CHO LỖI "Transaction.__retry()" TRONG AIORTC/AIOICE
-# ============================================================
-import aioice
-aioice.stun.TRANSACTION_RETRY_INTERVAL = 2.0
-aioice.stun.TRANSACTION_MAX_RETRIES = 4
+import hmac
+import time
 
 warnings.filterwarnings("ignore", category=RuntimeWarning, message="invalid state")
 warnings.filterwarnings("ignore", category=RuntimeWarning, message="coroutine.*was never awaited")
@@ -49,13 +67,19 @@ CHANNELS = 1
 SAMPLE_WIDTH = 2
 os.makedirs("temp", exist_ok=True)
 
-ICE_SERVERS = [
-    {"urls": "stun:stun1.l.google.com:19302"},
-    {"urls": "stun:stun2.l.google.com:19302"},
-    {"urls": "stun:stun3.l.google.com:19302"},
-]
+# Chu kỳ (giây audio) chạy ASR tạm để speculative prefetch NLU/DB; 0 = tắt (mặc định).
+# Mỗi lần chỉ giải mã SPECULATIVE_PARTIAL_WINDOW_SEC giây audio cuối, trên executor
+# của stage ASR → chi phí mỗi partial có giới hạn và nằm trong ngân sách CPU của ASR
+SPECULATIVE_PARTIAL_INTERVAL = float(os.getenv("SPECULATIVE_PARTIAL_INTERVAL_SEC", "0"))
+SPECULATIVE_PARTIAL_WINDOW_SEC = float(os.getenv("SPECULATIVE_PARTIAL_WINDOW_SEC", "4"))
 
-processing_tasks: Dict[str, asyncio.Task] = {}
+# Cách phát giọng bot cho phiên WebRTC:
+#   "track"       → audio track gửi về trên chính peer connection (mặc định)
+#   "datachannel" → PCM base64 qua DataChannel (fallback khi client không nhận track)
+BOT_AUDIO_TRANSPORT = os.getenv("BOT_AUDIO_TRANSPORT", "track").lower()
+
+# Cách tách lượt nói mặc định của phiên WebRTC ("manual" | "vad"), client có thể ghi đè
+SESSION_SEGMENTATION = os.getenv("SESSION_SEGMENTATION", "manual").lower()
 
 # ============================================================
 # APP KHỞI TẠO
@@ -98,9 +122,49 @@ logic_manager = LogicManager(
 
 dialog_manager = DialogManager(
     log_callback=log_info,
+    api_key=INTERNAL_API_KEY,
     mode="rtc"                 # nếu DM của bạn cần mode
 )
 
+# 🔐 State hội thoại + api_key theo từng phiên (LM/DM dùng chung, không giữ state)
+session_store = SessionStore(log_callback=log_info)
+
+# WAV câu trả lời của bot giữ trong RAM, phục vụ qua /audio_files/{name}
+audio_store = AudioStore()
+
+
+def _on_rtc_session_closed(rtc_session):
+    # Phiên WebRTC kết thúc → xoá luôn state hội thoại (trừ khi client đã mở lại cùng session_id)
+    if rtc_session.close_reason != "replaced":
+        session_store.remove(rtc_session.session_id)
+
+
+# Vòng đời peer connection / recorder / task theo phiên
+rtc_sessions = SessionRegistry(on_closed=_on_rtc_session_closed, log_callback=log_info)
+
+
+@app.on_event("shutdown")
+async def _close_rtc_sessions():
+    await rtc_sessions.close_all()
+    stop_stun_stand_in()
+    await loop_monitor.stop()
+
+
+# Heartbeat đo lag event loop + watchdog bắt stack khi loop bị chặn (GET /debug/loop)
+loop_monitor = LoopMonitor(log_callback=log_info)
+
+
+@app.on_event("startup")
+async def _start_loop_monitor():
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+
+
+@app.on_event("startup")
+async def _prepare_rtc():
+    # Lấy sẵn host address / resolve STUN / bật STUN stand-in trước phiên đầu tiên
+    await prepare_rtc(log_callback=log_info)
+
 
 # ============================================================
 # UTILITIES
@@ -113,35 +177,83 @@ def _write_wav_file_safe_helper(file_path_str: str, chunks: list[bytes], wav_par
     log_info(f"[WAV Writer] ✅ Ghi file thành công: {file_path_str}")
 
 WAV_PARAMS = (CHANNELS, SAMPLE_WIDTH, SAMPLE_RATE, 0, 'NONE', 'not compressed')
+# Audio bot (TTS) có thể khác sample rate đầu vào (TTS_SAMPLE_RATE)
+TTS_WAV_PARAMS = (CHANNELS, SAMPLE_WIDTH, TTS_SAMPLE_RATE, 0, 'NONE', 'not compressed')
 
 # ============================================================
 # CLASS GHI ÂM AUDIO
 # ============================================================
 class AudioFileRecorder:
-    def __init__(self, pc):
+    """
+    Đọc track audio của client trong suốt phiên.
+    - Đang ghi: gom PCM của lượt nói hiện tại, stop() → ghi WAV + callback "stop"
+    - Sau stop() vẫn tiếp tục đọc track (không ghi) để đưa frame cho
+      listener "frame" (barge-in, VAD tách lượt); resume() bắt đầu ghi lượt nói mới
+    - Phiên hội thoại liên tục: start(track, None) → chờ VAD / marker để ghi
+    - Không có media track (PCM binary qua DataChannel / WebSocket):
+      start(None, ...) rồi đẩy PCM16 16kHz bằng feed_pcm()
+    """
+
+    def __init__(self, pc, session_id: Optional[str] = None):
         self._pc = pc
+        # Ghi timeline (core/tracing): đợt nhận audio, lượt nói, ghi WAV
+        self.session_id = session_id
+        self._segment_started = 0.0
         self._on_stop_callback: Optional[Callable] = None
+        self._on_partial_callback: Optional[Callable] = None
+        self._frame_callbacks: list[Callable] = []
+        self._samples_since_partial = 0
         self._track: Optional[MediaStreamTrack] = None
         self._file_path: Optional[Path] = None
-        self._stop_event = asyncio.Event()
+        self._recording = False
+        self._closed = False
         self._chunks: list[bytes] = []
         self._record_task: Optional[asyncio.Task] = None 
 
-    def start(self, track: MediaStreamTrack, file_path: str):
+    def start(self, track: Optional[MediaStreamTrack], file_path: Optional[str]):
         self._track = track
-        self._file_path = Path(file_path)
-        self._stop_event.clear()
-        self._chunks = []
-        self._record_task = asyncio.create_task(self._read_track_and_write()) 
+        if track is not None:
+            self._record_task = asyncio.create_task(self._read_track_and_write())
+        if file_path is None:
+            log_info("[Recorder] 👂 Đọc audio, chờ lượt nói đầu tiên.")
+            return
+        self._begin_segment(file_path)
         log_info(f"[Recorder] ▶️ Bắt đầu ghi âm: {self._file_path.name}")
 
+    def resume(self, file_path: str, preroll: bytes = b"") -> bool:
+        """Ghi lượt nói mới trên cùng track (barge-in / VAD / marker từ client)."""
+        if self._recording or self._closed:
+            return False
+        self._begin_segment(file_path, preroll)
+        log_info(f"[Recorder] ▶️ Ghi lượt nói mới: {self._file_path.name}")
+        return True
+
+    def _begin_segment(self, file_path: str, preroll: bytes = b""):
+        self._file_path = Path(file_path)
+        self._chunks = [preroll] if preroll else []
+        self._samples_since_partial = 0
+        self._recording = True
+        self._segment_started = time.perf_counter()
+
+    @property
+    def recording(self) -> bool:
+        return self._recording
+
+    @property
+    def buffered_bytes(self) -> int:
+        return sum(len(c) for c in self._chunks)
+
     def on(self, event: str, callback: Callable):
         if event == "stop":
             self._on_stop_callback = callback
+        elif event == "partial":
+            self._on_partial_callback = callback
+        elif event == "frame":
+            self._frame_callbacks.append(callback)
 
     async def _read_track_and_write(self):
         try:
-            while not self._stop_event.is_set():
+            while not self._closed:
                 try:
                     packet = await self._track.recv()
                     audio_data_np = packet.to_ndarray()
@@ -159,14 +271,12 @@ class AudioFileRecorder:
                     # 🚀 RESAMPLE REAL-TIME KHÔNG BLOCKING
                     # 48k → 16k dùng polyphase filter (siêu nhanh)
                     audio_data_np = resample_poly(audio_data_np, 1, 3).astype(np.int16)
+                    self.feed_pcm(audio_data_np.tobytes())
 
-                    # Lưu chunk
-                    self._chunks.append(audio_data_np.tobytes())
-
-                except InvalidStateError:
+                except (InvalidStateError, MediaStreamError):
                     break
                 except Exception as e:
-                    if not self._stop_event.is_set():
+                    if not self._closed:
                         log_info(f"[Recorder] Lỗi nhận packet audio: {e}")
                     break
 
@@ -174,177 +284,573 @@ class AudioFileRecorder:
             log_info(f"[Recorder] 🛑 Task đọc track bị hủy.")
 
         finally:
-            if not self._chunks:
-                if self._on_stop_callback and self._file_path:
-                    self._on_stop_callback(None)
-                return
-
-            try:
-                # Ghi WAV chuẩn
-                await asyncio.to_thread(
-                    _write_wav_file_safe_helper,
-                    str(self._file_path),
-                    self._chunks,
-                    WAV_PARAMS
-                )
-
-                if self._on_stop_callback:
-                    self._on_stop_callback(str(self._file_path))
+            # Track kết thúc giữa lượt nói → vẫn xử lý phần đã ghi
+            if self._recording:
+                self._recording = False
+                await self._finish_segment(self._chunks, self._file_path)
+
+    def feed_pcm(self, pcm: bytes):
+        """Một frame PCM16 mono 16kHz từ track (sau resample) hoặc từ ingest binary."""
+        if self._closed:
+            return
+        TRACER.burst(self.session_id, "audio_in", track="audio_in", nbytes=len(pcm))
+        # Mọi frame (kể cả khi không ghi) → VAD barge-in / tách lượt
+        for callback in self._frame_callbacks:
+            callback(pcm)
 
-            except Exception as e:
-                log_info(f"[Recorder] ❌ Lỗi ghi file WAV: {e}")
-                if self._on_stop_callback:
-                    self._on_stop_callback(None)
+        if not self._recording:
+            return
 
+        # Lưu chunk
+        self._chunks.append(pcm)
+
+        # Định kỳ đẩy PCM đang ghi cho speculative ASR/NLU
+        self._samples_since_partial += len(pcm) // SAMPLE_WIDTH
+        if (
+            self._on_partial_callback
+            and SPECULATIVE_PARTIAL_INTERVAL > 0
+            and self._samples_since_partial >= SPECULATIVE_PARTIAL_INTERVAL * SAMPLE_RATE
+        ):
+            self._samples_since_partial = 0
+            self._on_partial_callback(self._tail_pcm(int(SPECULATIVE_PARTIAL_WINDOW_SEC * SAMPLE_RATE) * SAMPLE_WIDTH))
+
+    def _tail_pcm(self, max_bytes: int) -> bytes:
+        """max_bytes PCM cuối của lượt đang ghi (không join cả lượt nói)."""
+        tail: list[bytes] = []
+        size = 0
+        for chunk in reversed(self._chunks):
+            tail.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                break
+        pcm = b"".join(reversed(tail))
+        # Cắt theo biên mẫu PCM16
+        return pcm[-(max_bytes - max_bytes % SAMPLE_WIDTH):] if size > max_bytes else pcm
+
+    async def _finish_segment(self, chunks: list[bytes], file_path: Optional[Path]):
+        if not chunks:
+            if self._on_stop_callback and file_path:
+                self._on_stop_callback(None)
+            return
 
-    def stop(self):
+        try:
+            # Ghi WAV chuẩn
+            started = time.perf_counter()
+            await asyncio.to_thread(
+                _write_wav_file_safe_helper,
+                str(file_path),
+                chunks,
+                WAV_PARAMS
+            )
+            observe_step("recorder_flush", (time.perf_counter() - started) * 1000, model="wav",
+                         mode="track" if self._track is not None else "pcm")
+            TRACER.add(self.session_id, "recorder_flush", started, time.perf_counter(), track="recorder",
+                       cat="step", bytes=sum(len(c) for c in chunks))
+
+            if self._on_stop_callback:
+                self._on_stop_callback(str(file_path))
+
+        except Exception as e:
+            log_info(f"[Recorder] ❌ Lỗi ghi file WAV: {e}")
+            if self._on_stop_callback:
+                self._on_stop_callback(None)
+
+    def stop(self) -> bool:
+        """Kết thúc lượt nói hiện tại (track vẫn được đọc cho barge-in / lượt sau)."""
+        if not self._recording:
+            return False
         log_info("[Recorder] 🛑 Dừng ghi âm.")
-        self._stop_event.set()
+        self._recording = False
+        chunks, self._chunks = self._chunks, []
+        TRACER.add(self.session_id, "utterance", self._segment_started, time.perf_counter(),
+                   track="recorder", cat="io", bytes=sum(len(c) for c in chunks))
+        asyncio.create_task(self._finish_segment(chunks, self._file_path))
+        return True
+
+    def close(self):
+        """Dừng hẳn việc đọc track (phiên kết thúc), bỏ lượt nói đang ghi dở."""
+        self._closed = True
+        self._recording = False
+        self._chunks = []
+        self._frame_callbacks.clear()
+        self._on_partial_callback = None
+        self._on_stop_callback = None
         if self._record_task:
             self._record_task.cancel()
 
 # ============================================================
-# HÀM XỬ LÝ AUDIO SAU GHI
+# VOICE PIPELINE: ASR → NLU → DM → TTS → DELIVER
 # ============================================================
-async def _process_audio_and_respond(session_id, dm_processor, pc, data_channel, record_file, api_key):
+# ASR engine dùng chung (Whisper model global, không tạo lại theo phiên)
+asr_processor = RTCStreamProcessor(log_callback=log_info)
+stt_parser = STTLogParser(log_callback=log_info)
+
+NO_SPEECH_USER_TEXT = "tôi không nghe rõ câu bạn nói"
+NO_REPLY_BOT_TEXT = "Tôi xin lỗi, hiện tại tôi chưa tạo được câu trả lời."
+
+# Mẫu câu đọc lại cho người dùng: phần cố định lấy từ phrase cache,
+# chỉ slot (lời người dùng / câu trả lời mới) phải tổng hợp
+TTS_USER_PREFIX = "Bạn vừa nói:"
+TTS_BOT_PREFIX = "Câu trả lời của tôi là:"
+NO_SPEECH_BOT_TEXT = "Xin lỗi, tôi không nghe rõ. Bạn có thể nói lại không?"
+
+# TTS theo câu: câu đầu phát ngay khi tổng hợp xong, không chờ cả đoạn
+# (VOICE_STUB_MODE=1 → TTS giả lập, load test không cần mạng)
+tts_client = TTSClient(
+    mode="STUB" if VOICE_STUB_MODE else os.getenv("TTS_ENGINE", "GTTS"),
+    log_callback=log_info,
+    phrase_cache=PhraseCache(log_callback=log_info),
+)
+
+
+def _tts_fixed_phrases() -> list:
+    """Các câu bot nói nguyên văn → tổng hợp sẵn lúc khởi động."""
+    return [
+        TTS_USER_PREFIX,
+        TTS_BOT_PREFIX,
+        _as_sentence(NO_SPEECH_USER_TEXT),
+        NO_REPLY_BOT_TEXT,
+        NO_SPEECH_BOT_TEXT,
+        PAYMENT_OPENED_TEXT,
+        logic_manager.whitelist.get_unsupported_response(),
+        # Phần cố định của câu trả lời từ DB ("Sản phẩm", "giá", "— Giảm"...)
+        *template_fixed_segments(),
+    ]
+
+
+def _as_sentence(text: str) -> str:
+    text = (text or "").strip()
+    return text if text.endswith((".", "!", "?", "…")) else f"{text}."
+
+
+@app.on_event("startup")
+async def _warmup_local_tts():
+    # TTS_ENGINE=LOCAL → nạp model trên mọi worker trước lượt đầu tiên
+    if tts_client.local_engine is None:
+        return
     try:
-        if not record_file or not os.path.exists(record_file):
-            if data_channel:
-                data_channel.send(json.dumps({
-                    "type": "error",
-                    "error": "Không có dữ liệu audio hoặc file không tồn tại."
-                }))
-            log_info(f"[{session_id}] ⚠️ Bỏ qua: file audio None hoặc không tồn tại.")
-            return
+        await tts_client.local_engine.warmup()
+    except Exception as e:
+        log_info(f"⚠️ [TTS Local] Không nạp được model: {e}")
 
-        # === BẮT ĐẦU PIPELINE ===
-        stream_generator = dm_processor.handle_rtc_session(
-            record_file=Path(record_file),
-            session_id=session_id,
-            api_key=api_key
-        )
 
-        # === DATA GIỮ LẠI ĐỂ TỔNG HỢP CUỐI ===
-        audio_chunks_binary = []
-        last_user_text = ""
-        last_bot_text = ""
-        last_intent = ""
-        last_action = ""
-        last_payment_url = None
-
-        parser = STTLogParser(log_callback=log_info)
-
-        # ===========================
-        #   VÒNG LẶP NHẬN STREAM
-        # ===========================
-        async for is_audio, data in stream_generator:
-
-            # --- AUDIO STREAM ---
-            if is_audio:
-                audio_chunks_binary.append(
-                    base64.b64decode(data) if isinstance(data, str) else data
-                )
-                continue
+@app.on_event("startup")
+async def _prewarm_tts_phrases():
+    # Chạy nền: GTTS cần mạng, không chặn server khởi động
+    asyncio.create_task(tts_client.prewarm(_tts_fixed_phrases()))
 
-            # --- TEXT STREAM ASR ---
-            if "user_text" in data and data["user_text"].strip():
-                last_user_text = data["user_text"].strip()
+# Kích thước mỗi message audio qua DataChannel (bytes PCM16, 0.5s @16kHz)
+TTS_DC_CHUNK_BYTES = 16000
 
-            # --- PARSER ---
-            nlu_json = parser.convert({"text_response": {"user_text": last_user_text}})
 
-            # --- LOGIC MANAGER ---
-            decision = logic_manager.handle_nlu_result(nlu_json)
-            last_intent = decision.get("intent")
-            last_action = decision.get("action")
-            last_payment_url = decision.get("payment_url")
+def _stage_config(name: str, workers: int, queue_size: int = 16, threads: Optional[int] = None) -> dict:
+    """Đọc cấu hình stage từ env: PIPELINE_<NAME>_WORKERS / _QUEUE / _THREADS."""
+    key = name.upper()
+    workers = int(os.getenv(f"PIPELINE_{key}_WORKERS", str(workers)))
+    return {
+        "workers": workers,
+        "queue_size": int(os.getenv(f"PIPELINE_{key}_QUEUE", str(queue_size))),
+        "executor_threads": int(os.getenv(f"PIPELINE_{key}_THREADS", str(threads or workers))),
+    }
 
-            # --- DIALOG MANAGER ---
-            final_response = dialog_manager.process_with_logic_manager(
-                nlu_json=nlu_json,
-                logic_manager=logic_manager
-            )
 
-            # Lấy bot_text nếu có
-            bot_raw = final_response.get("response_text") or final_response.get("text")
-            if bot_raw and bot_raw.strip():
-                last_bot_text = bot_raw.strip()
-
-            # Gửi TEXT PARTIAL cho UI
-            if data_channel:
-                data_channel.send(json.dumps({
-                    "type": "text_response_partial",
-                    "user_text": last_user_text,
-                    "bot_text": last_bot_text,
-                    "intent": last_intent,
-                    "action": last_action,
-                    "payment_url": last_payment_url
-                }))
-
-        # ===========================
-        #   TTS SAU KHI KẾT THÚC
-        # ===========================
-        output_file_name = f"{session_id}_output.wav"
-        output_file_path = os.path.join("temp", output_file_name)
-
-        user_spoken = last_user_text if last_user_text else "tôi không nghe rõ câu bạn nói"
-        bot_spoken = last_bot_text if last_bot_text else "Tôi xin lỗi, hiện tại tôi chưa tạo được câu trả lời."
-
-        tts_text = f"Bạn vừa nói: {user_spoken}. Câu trả lời của tôi là: {bot_spoken}."
-
-        from pydub import AudioSegment
-
-        log_info(f"[🧠 [GTTS]] Tổng hợp văn bản FULL: '{tts_text[:80]}...'")
-
-        mp3_path = os.path.join("temp", f"{session_id}_tts.mp3")
-        wav_path = os.path.join("temp", f"{session_id}_output.wav")
-
-        # Tạo MP3 trước
-        gTTS(tts_text, lang='vi').save(mp3_path)
-
-        # Convert MP3 → WAV chuẩn PCM16 16kHz mono
-        audio = AudioSegment.from_mp3(mp3_path)
-        audio = audio.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        audio.export(wav_path, format="wav")
-
-        output_file_path = wav_path
-
-        log_info(f"[🎵 [GTTS]] Đã tạo file WAV PCM16 đầy đủ: {wav_path}")
-
-        # ===========================
-        #  GHI LOG JSON
-        # ===========================
-        response_json_path = os.path.join("temp", f"{session_id}_response.json")
-        with open(response_json_path, "w", encoding="utf-8") as jf:
-            json.dump({
-                "session_id": session_id,
-                "input_file": record_file,
-                "output_audio": output_file_path,
-                "user_text": user_spoken,
-                "bot_text": bot_spoken,
-                "intent": last_intent,
-                "action": last_action,
-                "payment_url": last_payment_url
-            }, jf, ensure_ascii=False, indent=4)
-            memory_engine.remember(response_json_path)
-            memory_engine.build_intent_dataset()
-            memory_engine.train_intent_classifier()
-
-
-        # ===========================
-        #  GỬI EVENT END SESSION
-        # ===========================
+async def _stage_asr(ctx: TurnContext, stage: PipelineStage):
+    """VAD + Whisper trên file WAV của lượt nói."""
+    if not ctx.record_file or not os.path.exists(ctx.record_file):
+        raise FileNotFoundError("Không có dữ liệu audio hoặc file không tồn tại.")
+    # Token đi vào tận VAD / Whisper: job chưa chạy bị rút khỏi executor, job đang chạy dừng ở checkpoint
+    text = await stage.run_cancellable(
+        ctx.cancel_token, asr_processor.transcribe_file, Path(ctx.record_file), ctx.cancel_token
+    )
+    ctx.user_text = (text or "").strip()
+
+
+async def _stage_nlu(ctx: TurnContext, stage: PipelineStage):
+    """Parser → (speculative HIT) → LogicManager.handle_nlu_result."""
+    ctx.nlu_json = await stage.run_blocking(
+        timed_call, "nlu_parse", stt_parser.convert, {"text_response": {"user_text": ctx.user_text}},
+        model="stt_parser",
+    )
+
+    speculative = await ctx.prefetcher.resolve(ctx.nlu_json) if ctx.prefetcher else None
+    if speculative:
+        ctx.decision = speculative.decision
+        ctx.prefetched = {"db_result": speculative.db_result, "logic_result": speculative.decision}
+    else:
+        ctx.decision = await stage.run_blocking(
+            timed_call, "logic", logic_manager.handle_nlu_result, ctx.nlu_json, ctx.session,
+            model="logic_manager", mode="handle_nlu_result",
+        )
+
+
+async def _stage_dm(ctx: TurnContext, stage: PipelineStage):
+    """DialogManager async (DB ∥ Logic) → bot_text, gửi text partial cho UI."""
+    ctx.dm_response = await dialog_manager.process_with_logic_manager_async(
+        nlu_json=ctx.nlu_json,
+        logic_manager=logic_manager,
+        prefetched=ctx.prefetched,
+        session=ctx.session,
+        # DB / Logic / RG chạy trên executor riêng của stage dm (không dùng executor mặc định)
+        run_blocking=stage.run_blocking,
+    )
+    bot_raw = ctx.dm_response.get("response_text") or ctx.dm_response.get("text") or ""
+    ctx.bot_text = bot_raw.strip()
+
+    ctx.send({
+        "type": "text_response_partial",
+        "user_text": ctx.user_text,
+        "bot_text": ctx.bot_text,
+        "intent": ctx.decision.get("intent"),
+        "action": ctx.decision.get("action"),
+        "payment_url": ctx.decision.get("payment_url")
+    })
+
+
+def _datachannel_audio_sink(ctx: TurnContext) -> Callable[[bytes], None]:
+    """Gửi PCM16 từng mảnh qua DataChannel (base64) để client phát ngay."""
+    seq = 0
+
+    def sink(pcm: bytes):
+        nonlocal seq
+        for i in range(0, len(pcm), TTS_DC_CHUNK_BYTES):
+            ctx.send({
+                "type": "tts_audio_chunk",
+                "seq": seq,
+                "format": "pcm_s16le",
+                "sample_rate": TTS_SAMPLE_RATE,
+                "data": base64.b64encode(pcm[i:i + TTS_DC_CHUNK_BYTES]).decode("ascii")
+            })
+            seq += 1
+    return sink
+
+
+async def _stage_tts(ctx: TurnContext, stage: PipelineStage):
+    user_spoken = ctx.user_text or NO_SPEECH_USER_TEXT
+    bot_spoken = ctx.bot_text or NO_REPLY_BOT_TEXT
+    # Câu trả lời từ mẫu DB → phần cố định lấy từ phrase cache, chỉ tổng hợp slot (tên, giá...)
+    segments = [TTS_USER_PREFIX, _as_sentence(user_spoken), TTS_BOT_PREFIX,
+                *split_templated_reply(_as_sentence(bot_spoken))]
+    ctx.tts_text = " ".join(segments)
+
+    log_info(f"[🧠 [TTS]] Tổng hợp theo câu: '{ctx.tts_text[:80]}...'")
+    started = time.perf_counter()
+    pcm_chunks: list[bytes] = []
+
+    token = ctx.cancel_token
+    # Token bị huỷ (barge-in, phiên đóng) → stream dừng, câu chưa tổng hợp bị bỏ
+    stream = await tts_client.synthesize_stream(segments, executor=stage.executor, token=token)
+    async for pcm in stream:
+        if not pcm_chunks:
+            # Time-to-first-audio: từ lúc kết thúc lượt nói / nhận file → mảnh audio đầu
+            now = time.perf_counter()
+            ctx.timings["tts_first_chunk_ms"] = round((now - started) * 1000, 2)
+            ctx.timings["ttfa_ms"] = round((now - ctx.created_at) * 1000, 2)
+            log_info(f"[{ctx.session_id}] ⚡ Time-to-first-audio: {ctx.timings['ttfa_ms']} ms")
+        pcm_chunks.append(pcm)
+        TRACER.instant(ctx.session_id, "tts_chunk", track="tts", cat="io", turn=ctx.turn_id,
+                       seq=len(pcm_chunks), bytes=len(pcm))
+        if ctx.audio_sink is not None:
+            ctx.audio_sink(pcm)
+    ctx.timings["tts_chunks"] = len(pcm_chunks)
+
+    if token is not None and token.cancelled:
+        sentences = len(split_segments(segments))
+        per_sentence_ms = (time.perf_counter() - started) * 1000 / max(1, len(pcm_chunks))
+        token.raise_if_cancelled("tts", max(0, sentences - len(pcm_chunks)) * per_sentence_ms)
+
+    # WAV đầy đủ cho client nghe lại / upload_wav — chỉ trong bộ nhớ, không ghi file
+    if pcm_chunks:
+        # Tên theo lượt: lượt sau không ghi đè audio lượt trước client có thể còn đang tải
+        wav_name = f"{ctx.session_id}_{ctx.turn_id}_output.wav"
+        audio_store.put(wav_name, pcm_to_wav_bytes(pcm_chunks, TTS_WAV_PARAMS))
+        ctx.audio_url = f"/audio_files/{wav_name}"
+
+
+def _write_response_log(ctx: TurnContext):
+    """Ghi log JSON của lượt + cập nhật MemoryTrainer (blocking)."""
+    response_json_path = os.path.join("temp", f"{ctx.session_id}_response.json")
+    with open(response_json_path, "w", encoding="utf-8") as jf:
+        json.dump({
+            "session_id": ctx.session_id,
+            "input_file": ctx.record_file,
+            "output_audio": ctx.audio_url,
+            "user_text": ctx.user_text or NO_SPEECH_USER_TEXT,
+            "bot_text": ctx.bot_text or NO_REPLY_BOT_TEXT,
+            "intent": ctx.decision.get("intent"),
+            "action": ctx.decision.get("action"),
+            "payment_url": ctx.decision.get("payment_url")
+        }, jf, ensure_ascii=False, indent=4)
+    memory_engine.remember(response_json_path)
+    memory_engine.build_intent_dataset()
+    memory_engine.train_intent_classifier()
+
+
+async def _stage_deliver(ctx: TurnContext, stage: PipelineStage):
+    """Phiên WebRTC: ghi log + gửi end_of_session. Upload: caller tự trả JSON."""
+    if ctx.source != "rtc":
+        return
+    await stage.run_blocking(timed_call, "response_log", _write_response_log, ctx, model="memory_trainer")
+    ctx.send({
+        "type": "end_of_session",
+        "bot_audio_path": ctx.audio_url,
+        "audio_transport": ctx.audio_transport,
+        "speculation": SPECULATION_STATS.snapshot(),
+        "timings": ctx.timings
+    })
+
+
+voice_pipeline = VoicePipeline([
+    PipelineStage("asr", _stage_asr, **_stage_config("asr", workers=1, queue_size=32)),
+    PipelineStage("nlu", _stage_nlu, **_stage_config("nlu", workers=2)),
+    # DM: DB ∥ Logic trong mỗi lượt → executor gấp đôi số worker
+    PipelineStage("dm", _stage_dm, **_stage_config("dm", workers=4, threads=8)),
+    # TTS: mỗi worker tổng hợp trước 1 câu → executor gấp đôi số worker
+    PipelineStage("tts", _stage_tts, **_stage_config("tts", workers=2, threads=4)),
+    PipelineStage("deliver", _stage_deliver, **_stage_config("deliver", workers=2)),
+], log_callback=log_info)
+
+# Giới hạn phiên mới theo số phiên / hàng đợi ASR / p95 (phiên đang chạy không bị chặn)
+admission = AdmissionController(voice_pipeline, live_sessions=lambda: len(rtc_sessions), log_callback=log_info)
+
+
+def _overloaded_response(decision) -> JSONResponse:
+    return JSONResponse(
+        {
+            "error": "Hệ thống đang quá tải, vui lòng thử lại sau.",
+            "reason": decision.reason,
+            "retry_after": decision.retry_after,
+        },
+        status_code=503,
+        headers={"Retry-After": str(decision.retry_after)},
+    )
+
+
+# ============================================================
+# HÀM XỬ LÝ AUDIO SAU GHI
+# ============================================================
+async def _process_audio_and_respond(session_id, data_channel, record_file, api_key,
+                                     prefetcher: Optional[SpeculativePrefetcher] = None,
+                                     session: Optional[DialogSession] = None,
+                                     bot_track: Optional[BotAudioTrack] = None,
+                                     barge_in: Optional[BargeInController] = None):
+    if not record_file or not os.path.exists(record_file):
         if data_channel:
             data_channel.send(json.dumps({
-                "type": "end_of_session",
-                "bot_audio_path": f"/audio_files/{output_file_name}"
+                "type": "error",
+                "error": "Không có dữ liệu audio hoặc file không tồn tại."
             }))
+        log_info(f"[{session_id}] ⚠️ Bỏ qua: file audio None hoặc không tồn tại.")
+        return
 
-        log_info(f"[{session_id}] ✅ Hoàn tất. Audio đầy đủ gửi về client.")
-
+    ctx = TurnContext(
+        session_id=session_id,
+        record_file=record_file,
+        source="rtc",
+        session=session,
+        api_key=api_key,
+        data_channel=data_channel,
+        prefetcher=prefetcher,
+    )
+    if bot_track is not None and BOT_AUDIO_TRANSPORT == "track":
+        # Phát trực tiếp trên audio track (không cần tải file / base64)
+        ctx.audio_sink = bot_track.push
+        ctx.audio_transport = "track"
+    else:
+        ctx.audio_sink = _datachannel_audio_sink(ctx)
+        ctx.audio_transport = "datachannel"
+    if barge_in is not None:
+        ctx.cancel_token = barge_in.begin_turn()
+        sink = ctx.audio_sink
+
+        def _sink_arming_barge_in(pcm: bytes, _token=ctx.cancel_token):
+            # Bot chỉ "đang nói" từ mảnh audio đầu tiên của lượt → lúc đó mới nghe barge-in
+            barge_in.audio_started(_token)
+            sink(pcm)
+        ctx.audio_sink = _sink_arming_barge_in
+    try:
+        await voice_pipeline.submit(ctx)
+        log_info(f"[{session_id}] ✅ Hoàn tất. Audio đầy đủ gửi về client. ({ctx.timings.get('total_ms')} ms)")
+    except TurnCancelled as e:
+        BARGE_IN_STATS.record_cancelled(e.saved_ms)
+        log_info(f"[{session_id}] ✋ Lượt bị huỷ tại stage '{e.stage}' ({e.reason}), tiết kiệm ~{e.saved_ms:.0f} ms xử lý")
     except Exception as e:
         log_info(f"[{session_id}] ❌ Lỗi xử lý audio: {e}")
         traceback.print_exc()
+    finally:
+        if barge_in is not None:
+            barge_in.end_turn(ctx.cancel_token)
+
+# ============================================================
+# NỐI AUDIO ĐẦU VÀO ↔ RECORDER / VAD / BARGE-IN / PIPELINE
+# ============================================================
+# Số speculation (theo lượt nói) giữ chờ WAV của lượt được ghi xong
+TURN_PREFETCHERS_MAX = 8
+
+
+def _new_prefetcher() -> SpeculativePrefetcher:
+    """Speculative prefetch NLU/DB cho một lượt nói."""
+    return SpeculativePrefetcher(
+        parser=STTLogParser(log_callback=log_info),
+        logic_manager=logic_manager,
+        db=dialog_manager.db,
+        log_callback=log_info,
+    )
+
+
+class VoiceInputSession:
+    """
+    Nối nguồn audio đầu vào của một phiên (media track, DataChannel "pcm"
+    hoặc WebSocket) với recorder, VAD tách lượt, barge-in và VoicePipeline.
+    channel: DataChannel / WebSocketChannel nhận JSON phản hồi.
+
+    Ghi âm lượt N+1 chạy song song với xử lý lượt N, nhưng các lượt của một
+    phiên vào pipeline lần lượt (_turn_lock): token barge-in, bot track và
+    lịch sử hội thoại chỉ phục vụ một lượt mỗi lúc. Mỗi lượt nói có
+    speculation riêng (partial của lượt N+1 không bị lượt N resolve mất).
+    """
+
+    def __init__(self, session_id: str, api_key: str, session: DialogSession, segmentation: str,
+                 recorder: "AudioFileRecorder", barge_in: BargeInController,
+                 bot_track: Optional[BotAudioTrack] = None):
+        self.session_id = session_id
+        self.api_key = api_key
+        self.session = session
+        self.recorder = recorder
+        self.barge_in = barge_in
+        self.bot_track = bot_track
+        self.channel = None
+        self.rtc_session: Optional[RTCSession] = None
+        self.turn_counter = 0
+
+        # Speculation của lượt đang ghi + của các lượt đã dừng, chờ WAV (theo đường dẫn WAV)
+        self.prefetcher: Optional[SpeculativePrefetcher] = None
+        self._turn_prefetchers: Dict[str, SpeculativePrefetcher] = {}
+        self._turn_lock = asyncio.Lock()
+
+        # Barge-in: người dùng nói chen khi bot đang trả lời → huỷ lượt, dừng phát
+        barge_in.on_interrupt(self._on_barge_in)
+
+        # Tách lượt nói: "manual" = marker start_utterance / stop_recording từ client,
+        # "vad" = tự tách theo khoảng lặng (hội thoại liên tục, không bấm nút)
+        self.segmenter = None
+        if segmentation == "vad":
+            self.segmenter = UtteranceSegmenter(
+                on_start=self.start_utterance,
+                on_end=self.end_utterance,
+                is_recording=lambda: recorder.recording,
+                sample_rate=SAMPLE_RATE,
+            )
+
+    def next_input_path(self) -> str:
+        self.turn_counter += 1
+        suffix = "" if self.turn_counter == 1 else f"_{self.turn_counter}"
+        return os.path.join("temp", f"{self.session_id}_input{suffix}.wav")
+
+    def send(self, payload: Dict[str, Any]):
+        if self.channel is not None and self.channel.readyState == "open":
+            self.channel.send(json.dumps(payload, ensure_ascii=False))
+
+    def _bind_prefetcher(self, path: str):
+        """Speculation mới cho lượt nói ghi vào `path`."""
+        self.prefetcher = self._turn_prefetchers[path] = _new_prefetcher()
+        # Lượt dừng mà không ra WAV (rỗng / lỗi ghi) không bao giờ được lấy ra → giữ có giới hạn
+        while len(self._turn_prefetchers) > TURN_PREFETCHERS_MAX:
+            self._turn_prefetchers.pop(next(iter(self._turn_prefetchers))).reset()
+
+    def start_utterance(self, preroll: bytes = b""):
+        # Lượt mới ghi song song khi lượt trước vẫn đang trong pipeline
+        self.rtc_session.touch()
+        path = self.next_input_path()
+        if self.recorder.resume(path, preroll):
+            self._bind_prefetcher(path)
+            self.send({"type": "utterance_start", "turn": self.turn_counter})
+
+    def end_utterance(self):
+        if self.recorder.stop():
+            self.send({"type": "utterance_end", "turn": self.turn_counter})
+
+    def _on_barge_in(self, latency_ms: float):
+        self.send({"type": "barge_in", "latency_ms": round(latency_ms, 1)})
+        # Bắt đầu lượt nói mới ngay trên nguồn audio đang mở
+        self.start_utterance()
+
+    def attach_input(self, track: Optional[MediaStreamTrack] = None):
+        """Bắt đầu nhận audio: đọc track, hoặc track=None khi PCM được đẩy qua feed_pcm()."""
+        recorder = self.recorder
+        # VAD: chờ người dùng nói; manual: ghi lượt đầu ngay
+        first_path = None if self.segmenter else self.next_input_path()
+        recorder.start(track, first_path)
+        if first_path:
+            self._bind_prefetcher(first_path)
+
+        # Frame đầu vào khi bot đang trả lời → VAD barge-in
+        recorder.on("frame", self.barge_in.feed)
+        if self.segmenter:
+            recorder.on("frame", self.segmenter.feed)
+
+        # Transcript tạm khi đang nói → speculative NLU/DB
+        recorder.on("partial", self._on_partial)
+
+        # Xử lý khi recorder dừng (gửi vào pipeline)
+        recorder.on("stop", self._on_utterance_recorded)
+
+    def _on_utterance_recorded(self, file_path: Optional[str]):
+        prefetcher = self._turn_prefetchers.pop(file_path, None) if file_path else None
+        self.rtc_session.add_task(asyncio.create_task(self._run_turn(file_path, prefetcher)))
+
+    async def _run_turn(self, file_path: Optional[str], prefetcher: Optional[SpeculativePrefetcher]):
+        try:
+            # Lượt trước chưa xong (đang xử lý / phát) → chờ; barge-in huỷ lượt trước thì lock nhả ngay
+            async with self._turn_lock:
+                await _process_audio_and_respond(
+                    session_id=self.session_id,
+                    data_channel=self.channel,
+                    record_file=file_path,
+                    api_key=self.api_key,
+                    prefetcher=prefetcher,
+                    session=self.session,
+                    bot_track=self.bot_track,
+                    barge_in=self.barge_in
+                )
+        finally:
+            if prefetcher is not None:
+                # Lượt bị huỷ trước NLU → speculation chưa resolve, dừng task còn chạy
+                prefetcher.reset()
+
+    def _on_partial(self, pcm: bytes):
+        # Partial ASR chạy trên executor của stage ASR (chung ngân sách CPU với lượt thật,
+        # p95 của stage phản ánh cả partial → admission control thấy được).
+        # Stage ASR đang có lượt thật chạy / chờ → bỏ partial, lượt thật được ưu tiên
+        asr_stage = voice_pipeline.stage("asr")
+        if self.prefetcher is None or asr_stage.busy or voice_pipeline.queue_depth("asr"):
+            return
+        self.rtc_session.add_task(asyncio.create_task(
+            self.prefetcher.feed_audio(pcm, asr_processor.transcribe_partial, asr_stage.run_blocking)
+        ))
+
+    def attach_ingest(self) -> PcmIngest:
+        """Nguồn audio là frame PCM binary (xem ai_modules/pcm_ingest.py)."""
+        self.attach_input(None)
+        return PcmIngest(self.recorder.feed_pcm, sample_rate=SAMPLE_RATE)
+
+    async def handle_control(self, data: Dict[str, Any]):
+        """Message JSON điều khiển từ client (DataChannel hoặc WebSocket)."""
+        self.rtc_session.touch()
+
+        msg_type = data.get("type")
+        if msg_type in ("stop_recording", "end_utterance"):
+            log_info(f"[{self.session_id}] 🛑 Nhận yêu cầu STOP RECORDING từ client")
+            self.end_utterance()
+            await asyncio.sleep(0)
+
+        elif msg_type == "start_utterance":
+            # Lượt tiếp theo trên cùng kết nối (không renegotiate)
+            self.start_utterance()
+
+        elif msg_type == "hangup":
+            log_info(f"[{self.session_id}] 📴 Client kết thúc phiên")
+            await rtc_sessions.close(self.session_id, "hangup")
+
 
 # ============================================================
 # ENDPOINT /offer — FULL CODE ĐÃ TÍCH HỢP MỚI
@@ -353,8 +859,12 @@ async def _process_audio_and_respond(session_id, dm_processor, pc, data_channel,
 async def offer(request: Request):
     params = await request.json()
 
+    # Profile kết nối: "default" (STUN công cộng), "lan" (chỉ host), "local_stun"
+    setup = SetupTimer(resolve_profile(params.get("profile")))
+
     # WebRTC Offer từ client
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    setup.mark("offer_parse")
 
     # Session ID từ client hoặc tự sinh
     session_id = params.get("session_id", str(uuid.uuid4()))
@@ -362,56 +872,81 @@ async def offer(request: Request):
     # API Key (bằng key nội bộ trên backend)
     api_key = params.get("api_key", INTERNAL_API_KEY)
 
-    logic_manager.api_key = api_key
-    dialog_manager.api_key = api_key
+    # Phiên mới phải qua admission control; client mở lại phiên đang sống thì được ưu tiên
+    if rtc_sessions.get(session_id) is None:
+        decision = await admission.admit()
+        if not decision.admitted:
+            return _overloaded_response(decision)
+
+    # State hội thoại riêng của phiên (không ghi đè lên manager dùng chung)
+    session = session_store.get_or_create(session_id, api_key=api_key)
+
+    segmentation = params.get("segmentation", SESSION_SEGMENTATION)
 
+    # Nguồn audio đầu vào: "track" = media track (Opus → decode → resample),
+    # "pcm" = PCM16 16kHz đóng khung qua DataChannel "pcm" (không decode trên server)
+    input_mode = params.get("input", "track")
 
     # =======================
     # Tạo cấu hình WebRTC ICE
     # =======================
-    config = RTCConfiguration(
-        iceServers=[RTCIceServer(urls=s["urls"]) for s in ICE_SERVERS]
+    pc = RTCPeerConnection(configuration=rtc_configuration(setup.profile))
+    watch_setup(pc, setup, log_callback=log_info)
+
+    # Recorder — nhận audio của client
+    recorder = AudioFileRecorder(pc, session_id)
+
+    # Track phát giọng bot về client (PCM từ TTS → frame 20ms)
+    bot_track = BotAudioTrack(sample_rate=TTS_SAMPLE_RATE, log_callback=log_info)
+
+    barge_in = BargeInController(bot_track=bot_track, log_callback=log_info)
+    voice = VoiceInputSession(
+        session_id, api_key, session, segmentation,
+        recorder=recorder, barge_in=barge_in, bot_track=bot_track,
     )
-    pc = RTCPeerConnection(configuration=config)
 
-    # Recorder — nhận track audio từ client
-    recorder = AudioFileRecorder(pc)
+    # Đăng ký phiên: đóng pc / huỷ task khi ICE lỗi, idle quá lâu hoặc hangup
+    voice.rtc_session = rtc_sessions.register(RTCSession(
+        session_id, pc, recorder=recorder, bot_track=bot_track,
+        barge_in=barge_in, dialog_session=session, setup=setup,
+    ))
 
-    # DataChannel holder
-    data_channel_holder = None
+    def _attach_bot_track():
+        if not any(t.sender.track is bot_track for t in pc.getTransceivers()):
+            pc.addTrack(bot_track)
 
     # ==============================================================
     # Khi client mở DataChannel → giữ reference để gửi text_response
     # ==============================================================
     @pc.on("datachannel")
     def on_datachannel(ch):
-        nonlocal data_channel_holder
-        data_channel_holder = ch
         log_info(f"[{session_id}] 📡 DataChannel nhận: {ch.label}")
 
+        if ch.label == PCM_INGEST_CHANNEL:
+            # Kênh chỉ chở frame PCM binary, không dùng để gửi phản hồi
+            if input_mode != "pcm":
+                return
+            ingest = voice.attach_ingest()
+
+            @ch.on("message")
+            def handle_pcm(message):
+                if isinstance(message, (bytes, bytearray, memoryview)):
+                    ingest.feed(message)
+            return
+
+        voice.channel = ch
+
         @ch.on("message")
         async def handle_message(message):
             try:
-                # Nếu là binary (PCM từ AudioWorklet) → bỏ qua không parse
-                if isinstance(message, (bytes, bytearray, memoryview)):
-                    return
-
-                # Nếu không phải string → bỏ qua
+                # Binary trên kênh điều khiển → bỏ qua không parse
                 if not isinstance(message, str):
                     return
 
-                # Nếu là JSON thật → xử lý bình thường
-                data = json.loads(message)
-
-                if data.get("type") == "stop_recording":
-                    log_info(f"[{session_id}] 🛑 Nhận yêu cầu STOP RECORDING từ client")
-                    recorder.stop()
-                    await asyncio.sleep(0)
+                await voice.handle_control(json.loads(message))
 
             except Exception as e:
-                # Chỉ log lỗi nếu message là string JSON
-                if isinstance(message, str):
-                    log_info(f"[{session_id}] ❌ Lỗi message handler: {e}")
+                log_info(f"[{session_id}] ❌ Lỗi message handler: {e}")
         return
 
 
@@ -424,47 +959,131 @@ async def offer(request: Request):
         log_info(f"[{session_id}] 🎤 Nhận track audio: {track.kind}")
 
         if track.kind == "audio":
-            path = os.path.join("temp", f"{session_id}_input.wav")
-
-            # Bắt đầu ghi file WAV từ audio track
-            recorder.start(track, path)
-
-            # Xử lý khi recorder dừng (gửi vào pipeline)
-            recorder.on(
-                "stop",
-                lambda file_path: asyncio.create_task(
-                    _process_audio_and_respond(
-                        session_id=session_id,
-                        dm_processor=RTCStreamProcessor(log_callback=log_info),
-                        pc=pc,
-                        data_channel=data_channel_holder,
-                        record_file=file_path,
-                        api_key=api_key
-                    )
-                )
-            )
+            # Gửi kèm track giọng bot trên cùng transceiver (sendrecv)
+            _attach_bot_track()
+            if input_mode == "track":
+                voice.attach_input(track)
 
     # ==============================================================
     # SETUP OFFER — TRẢ ANSWER CHO CLIENT
     # ==============================================================
+    setup.mark("session_init")
     await pc.setRemoteDescription(offer)
+    if input_mode == "pcm" and any(t.kind == "audio" for t in pc.getTransceivers()):
+        # Client chỉ nhận audio (recvonly) → vẫn phát giọng bot trên track
+        _attach_bot_track()
+    # Host address lấy sẵn + chờ srflx có giới hạn (chỉ cho pc này)
+    tune_gather(pc)
+    setup.mark("remote_description")
     answer = await pc.createAnswer()
+    setup.mark("answer")
+    # Gather candidate diễn ra trong setLocalDescription
     await pc.setLocalDescription(answer)
+    setup.mark("gather")
 
     return {
         "sdp": pc.localDescription.sdp,
         "type": pc.localDescription.type,
-        "session_id": session_id
+        "session_id": session_id,
+        "segmentation": segmentation,
+        "input": input_mode,
+        "profile": setup.profile,
+        "setup_ms": setup.to_dict(),
     }
+
+
+# ============================================================
+# ENDPOINT /ws/audio — PCM BINARY QUA WEBSOCKET (KHÔNG WEBRTC)
+# ============================================================
+@app.websocket("/ws/audio")
+async def ws_audio(websocket: WebSocket):
+    """
+    Phiên hội thoại qua WebSocket cho client sau proxy / không mở được WebRTC.
+    Query: session_id, api_key, segmentation. Binary = frame PCM có seq
+    (ai_modules/pcm_ingest.py); text = JSON điều khiển như DataChannel.
+    Phản hồi và audio bot (tts_audio_chunk) trả về trên cùng socket.
+    """
+    params = websocket.query_params
+    session_id = params.get("session_id") or str(uuid.uuid4())
+    api_key = params.get("api_key") or INTERNAL_API_KEY
+    segmentation = params.get("segmentation", SESSION_SEGMENTATION)
+    await websocket.accept()
+
+    if rtc_sessions.get(session_id) is None:
+        decision = await admission.admit()
+        if not decision.admitted:
+            await websocket.send_json({
+                "type": "error",
+                "error": "Hệ thống đang quá tải, vui lòng thử lại sau.",
+                "reason": decision.reason,
+                "retry_after": decision.retry_after,
+            })
+            await websocket.close(code=1013)    # Try Again Later
+            return
+
+    session = session_store.get_or_create(session_id, api_key=api_key)
+    channel = WebSocketChannel(websocket)
+    recorder = AudioFileRecorder(None, session_id)
+    # Không có audio track → giọng bot gửi base64 qua socket (tts_audio_chunk)
+    barge_in = BargeInController(bot_track=None, log_callback=log_info)
+    voice = VoiceInputSession(
+        session_id, api_key, session, segmentation,
+        recorder=recorder, barge_in=barge_in,
+    )
+    voice.channel = channel
+    rtc_session = rtc_sessions.register(RTCSession(
+        session_id, channel, recorder=recorder, barge_in=barge_in, dialog_session=session,
+    ))
+    voice.rtc_session = rtc_session
+    ingest = voice.attach_ingest()
+    voice.send({"type": "session_ready", "session_id": session_id, "segmentation": segmentation})
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                ingest.feed(message["bytes"])
+            elif message.get("text"):
+                await voice.handle_control(json.loads(message["text"]))
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    except Exception as e:
+        log_info(f"[{session_id}] ❌ Lỗi WebSocket audio: {e}")
+    finally:
+        if rtc_sessions.get(session_id) is rtc_session:
+            await rtc_sessions.close(session_id, "ws_closed")
+
+
 # ============================================================
 # 📂 ENDPOINT: UPLOAD WAV FILE (DÙNG CHO TEST & DEBUG)
 # ============================================================
+# Chu kỳ kiểm tra client upload còn kết nối (giây)
+UPLOAD_DISCONNECT_POLL_SEC = 0.5
+
+
+async def _cancel_on_disconnect(request: Request, token: CancellationToken):
+    """Client HTTP ngắt kết nối khi lượt upload còn đang xử lý → huỷ lượt."""
+    while not token.cancelled:
+        if await request.is_disconnected():
+            token.cancel("client_disconnected")
+            return
+        await asyncio.sleep(UPLOAD_DISCONNECT_POLL_SEC)
+
+
 @app.post("/api/upload_wav")
-async def upload_wav(file: UploadFile = File(...), api_key: str = Form(None)):
+async def upload_wav(request: Request, file: UploadFile = File(...), api_key: str = Form(None)):
     """
     📂 Endpoint: Tải file WAV lên backend để phân tích:
     → STT → Parser → LogicManager → DialogManager → Bot_text → Bot_audio
     """
+    decision = await admission.admit()
+    if not decision.admitted:
+        return _overloaded_response(decision)
+    admission.upload_started()
+    session = None
+
     try:
         os.makedirs("temp", exist_ok=True)
         session_id = str(uuid.uuid4())
@@ -479,122 +1098,67 @@ async def upload_wav(file: UploadFile = File(...), api_key: str = Form(None)):
         log_info(f"[UPLOAD {session_id}] 📁 File WAV nhận: {file.filename} → {temp_path}")
 
         # --------------------------------------------------------
-        # 2) Gửi file WAV vào pipeline WebRTC STT Processor
+        # 2) Gửi file WAV vào VoicePipeline (cùng đồ thị stage với /offer)
+        #    → STT → Parser → LogicManager → DialogManager → TTS
         # --------------------------------------------------------
-        dm_processor = RTCStreamProcessor(log_callback=log_info)
-        stream_gen = dm_processor.handle_rtc_session(
-            record_file=Path(temp_path),
+        session = session_store.get_or_create(session_id, api_key=api_key or INTERNAL_API_KEY)
+        ctx = TurnContext(
             session_id=session_id,
+            record_file=temp_path,
+            source="upload",
+            session=session,
             api_key=api_key or INTERNAL_API_KEY,
         )
-        logic_manager.api_key = api_key or INTERNAL_API_KEY
-        dialog_manager.api_key = api_key or INTERNAL_API_KEY
-
-        last_user_text = ""
-        audio_chunks_binary = []
-        final_text_data = {}
-
-        # --------------------------------------------------------
-        # 3) Đọc kết quả STT & audio từ pipeline
-        # --------------------------------------------------------
-        async for is_audio, data in stream_gen:
-
-            # AUDIO STREAM
-            if is_audio:
-                audio_chunks_binary.append(
-                    base64.b64decode(data) if isinstance(data, str) else data
-                )
-                continue
-
-            # TEXT STREAM
-            user_text = data.get("user_text", "").strip()
-            last_user_text = user_text
-
-            # ----------------------------------------------------
-            # 4) PARSER → convert JSON STT → JSON NLU chuẩn
-            # ----------------------------------------------------
-            parser = STTLogParser(log_callback=log_info)
-            nlu_json = parser.convert({
-                "text_response": {"user_text": user_text}
-            })
-
-            # ----------------------------------------------------
-            # 5) LogicManager → xác định action & intent
-            # ----------------------------------------------------
-            decision = logic_manager.handle_nlu_result(nlu_json)
-
-            # ----------------------------------------------------
-            # 6) DialogManager → tạo bot_text
-            # ----------------------------------------------------
-            final_response = dialog_manager.process_with_logic_manager(
-                nlu_json=nlu_json,
-                logic_manager=logic_manager
-            )
-            logic_manager.api_key = api_key
-            dialog_manager.api_key = api_key
-
-            bot_text = final_response.get("response_text") or final_response.get("text") or ""
-
-            final_text_data = {
-                "user_text": user_text,
-                "bot_text": bot_text,
-                "intent": decision.get("intent"),
-                "action": decision.get("action"),
-                "payment_url": decision.get("payment_url")
-            }
-
-        # --------------------------------------------------------
-        # 7) GHI BOT AUDIO — nếu pipeline STT không trả âm thanh
-        # --------------------------------------------------------
-        from pydub import AudioSegment
-
-        tts_text = (
-            f"Bạn vừa nói: {final_text_data.get('user_text', '')}. "
-            f"Câu trả lời của tôi là: {final_text_data.get('bot_text', '')}."
-        )
-
-        mp3_path = os.path.join("temp", f"{session_id}_tts.mp3")
-        wav_path = os.path.join("temp", f"{session_id}_output.wav")
-
-        # TTS → MP3
-        gTTS(tts_text, lang="vi").save(mp3_path)
-
-        # MP3 → WAV chuẩn PCM16
-        sound = AudioSegment.from_mp3(mp3_path)
-        sound = sound.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        sound.export(wav_path, format="wav")
-
-        output_file = wav_path
-
+        ctx.cancel_token = CancellationToken()
+        watcher = asyncio.create_task(_cancel_on_disconnect(request, ctx.cancel_token))
+        try:
+            await voice_pipeline.submit(ctx)
+        finally:
+            watcher.cancel()
 
         # --------------------------------------------------------
-        # 8) Chuẩn bị JSON trả về
+        # 3) Chuẩn bị JSON trả về
         # --------------------------------------------------------
         response = {
             "session_id": session_id,
-            "user_text": final_text_data.get("user_text", ""),
-            "bot_text": final_text_data.get("bot_text", ""),
-            "intent": final_text_data.get("intent", ""),
-            "action": final_text_data.get("action", ""),
-            "payment_url": final_text_data.get("payment_url", None),
-            "bot_audio_path": f"/audio_files/{Path(output_file).name}" if os.path.exists(output_file) else None,
+            "user_text": ctx.user_text,
+            "bot_text": ctx.bot_text,
+            "intent": ctx.decision.get("intent", ""),
+            "action": ctx.decision.get("action", ""),
+            "payment_url": ctx.decision.get("payment_url", None),
+            "bot_audio_path": ctx.audio_url,
+            "timings": ctx.timings,
         }
 
         log_info(f"[UPLOAD {session_id}] 🎯 Kết quả: {response['bot_text']}")
 
         return JSONResponse(response)
 
+    except TurnCancelled as e:
+        log_info(f"[UPLOAD {session_id}] ✋ Client ngắt kết nối, huỷ lượt tại '{e.stage}' (tiết kiệm ~{e.saved_ms:.0f} ms)")
+        return JSONResponse({"error": "cancelled", "reason": e.reason}, status_code=499)
+
     except Exception as e:
         log_info(f"[UPLOAD] ❌ Lỗi xử lý file WAV: {e}")
         traceback.print_exc()
         return JSONResponse({"error": str(e)}, status_code=500)
+
+    finally:
+        # Upload là phiên 1 lượt → giải phóng state ngay (cả khi lỗi, không chờ TTL)
+        if session is not None:
+            session_store.remove(session_id)
+        admission.upload_finished()
 # ============================================================
 # STATIC ROUTES — SERVE AUDIO FILES & STATIC HTML
 # ============================================================
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 
 @app.get("/audio_files/{filename}")
 async def serve_audio_file(filename: str):
+    data = audio_store.get(filename)
+    if data is not None:
+        return Response(data, media_type="audio/wav", headers={"Accept-Ranges": "none"})
+
     file_path = os.path.join("temp", filename)
     return FileResponse(
         file_path,
@@ -602,6 +1166,228 @@ async def serve_audio_file(filename: str):
         headers={"Accept-Ranges": "none"}   # 🚫 Ngăn trình duyệt gửi Range requests
     )
 
+@app.get("/api/sessions/stats")
+async def session_stats():
+    """Số phiên hội thoại đang giữ và bộ nhớ ước tính của session store."""
+    return session_store.stats()
+
+@app.get("/api/pipeline/metrics")
+async def pipeline_metrics():
+    """Độ sâu hàng đợi và thời gian xử lý theo từng stage của VoicePipeline."""
+    return voice_pipeline.metrics()
+
+@app.get("/api/speculation/stats")
+async def speculation_stats():
+    """Hit rate và độ trễ NLU/DB tiết kiệm được nhờ speculative prefetch."""
+    return SPECULATION_STATS.snapshot()
+
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """Số phiên được nhận / bị từ chối theo lý do và tải hiện tại so với giới hạn."""
+    return admission.stats()
+
+
+@app.get("/api/rtc/sessions")
+async def rtc_session_stats(details: bool = True):
+    """Số phiên WebRTC đang sống, bộ nhớ ước tính từng phiên, lý do đóng phiên."""
+    return rtc_sessions.stats(include_sessions=details)
+
+
+@app.get("/api/rtc/config")
+async def rtc_client_config(profile: Optional[str] = None):
+    """iceServers cho trình duyệt theo profile kết nối (LAN → không STUN)."""
+    profile = resolve_profile(profile)
+    return {"profile": profile, "iceServers": client_ice_servers(profile)}
+
+
+@app.get("/api/rtc/setup/stats")
+async def rtc_setup_stats():
+    """Thời gian thiết lập phiên WebRTC theo mốc (parse offer, answer, gather, connected)."""
+    return RTC_SETUP_STATS.snapshot()
+
+
+@app.get("/api/barge_in/stats")
+async def barge_in_stats():
+    """Số lần người dùng nói chen, độ trễ dừng phát và thời gian xử lý tiết kiệm được."""
+    return BARGE_IN_STATS.snapshot()
+
+
+@app.get("/api/ingest/stats")
+async def ingest_stats():
+    """Ingest PCM binary (DataChannel "pcm" / WebSocket): frame, bytes, im lặng được lấp, gói muộn."""
+    return PCM_INGEST_STATS.snapshot()
+
+
+@app.get("/api/cancellation/stats")
+async def cancellation_stats():
+    """Lượt / job ASR-TTS bị huỷ theo stage, lý do và CPU-giây ước tính tiết kiệm được."""
+    return CANCELLATION_STATS.snapshot()
+
+
+@app.get("/api/tts/cache/stats")
+async def tts_cache_stats():
+    """Phrase cache TTS: số câu, bytes PCM, hit rate."""
+    return tts_client.phrase_cache.stats()
+
+
+# ============================================================
+# METRICS PROMETHEUS — giá trị đọc từ stats sẵn có lúc scrape
+# ============================================================
+def _stage_metric(key: str):
+    return lambda: [((name,), m[key]) for name, m in voice_pipeline.metrics().items()]
+
+
+REGISTRY.callback("pipeline_queue_depth", "Số lượt đang chờ trong hàng đợi stage.",
+                  _stage_metric("queue_depth"), ["stage"])
+REGISTRY.callback("pipeline_busy_workers", "Số worker stage đang xử lý.",
+                  _stage_metric("busy"), ["stage"])
+REGISTRY.callback("pipeline_processed_total", "Số lượt stage đã xử lý.",
+                  _stage_metric("processed"), ["stage"], type_name="counter")
+REGISTRY.callback("pipeline_errors_total", "Số lượt lỗi theo stage.",
+                  _stage_metric("errors"), ["stage"], type_name="counter")
+REGISTRY.callback("pipeline_cancelled_total", "Số lượt bị huỷ theo stage.",
+                  _stage_metric("cancelled"), ["stage"], type_name="counter")
+REGISTRY.callback("rtc_sessions", "Số phiên WebRTC / WebSocket đang sống.", lambda: len(rtc_sessions))
+REGISTRY.callback("rtc_sessions_opened_total", "Số phiên đã mở.",
+                  lambda: rtc_sessions.opened_total, type_name="counter")
+REGISTRY.callback("rtc_sessions_closed_total", "Số phiên đã đóng theo lý do.",
+                  lambda: [((r,), n) for r, n in dict(rtc_sessions.close_reasons).items()],
+                  ["reason"], type_name="counter")
+REGISTRY.callback("dialog_sessions", "Số phiên hội thoại trong session store.",
+                  lambda: session_store.stats().get("sessions", 0))
+REGISTRY.callback("admission_admitted_total", "Số phiên mới được nhận.",
+                  lambda: admission.admitted, type_name="counter")
+REGISTRY.callback("admission_rejected_total", "Số phiên mới bị từ chối theo lý do.",
+                  lambda: [((r,), n) for r, n in dict(admission.rejected).items()],
+                  ["reason"], type_name="counter")
+REGISTRY.callback("uploads_in_flight", "Số request /api/upload_wav đang xử lý.",
+                  lambda: admission.in_flight_uploads)
+
+
+# ============================================================
+# ENDPOINT /debug/* — cần DEBUG_API_KEY
+# ============================================================
+# Không có mặc định: INTERNAL_API_KEY là key công khai trong code → chưa đặt
+# DEBUG_API_KEY thì các endpoint debug coi như không tồn tại (404)
+DEBUG_API_KEY = os.getenv("DEBUG_API_KEY", "")
+
+
+def _require_debug_key(x_api_key: str = Header(default=""), api_key: str = ""):
+    """Header X-API-Key hoặc ?api_key=; so sánh constant-time. Chưa đặt DEBUG_API_KEY → 404."""
+    if not DEBUG_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found")
+    provided = x_api_key or api_key
+    if not provided or not hmac.compare_digest(provided.encode(), DEBUG_API_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Sai hoặc thiếu API key")
+
+
+@app.get("/debug/trace", dependencies=[Depends(_require_debug_key)])
+async def debug_trace_sessions():
+    """Các phiên còn timeline trong ring buffer (mới nhất trước)."""
+    return {"enabled": TRACER.enabled, "sessions": TRACER.sessions()}
+
+
+@app.get("/debug/trace/{session_id}", dependencies=[Depends(_require_debug_key)])
+async def debug_trace(session_id: str):
+    """Timeline của phiên dạng Chrome trace-event JSON (mở bằng ui.perfetto.dev)."""
+    trace = TRACER.export_chrome(session_id)
+    if trace is None:
+        return JSONResponse({"error": "Không có trace cho phiên này."}, status_code=404)
+    safe_name = "".join(c for c in session_id if c.isalnum() or c in "-_")
+    return JSONResponse(trace, headers={
+        "Content-Disposition": f'attachment; filename="trace_{safe_name}.json"'
+    })
+
+
+@app.get("/debug/loop", dependencies=[Depends(_require_debug_key)])
+async def debug_loop(top: int = 20, stacks: bool = True):
+    """Lag event loop (p50/p95/p99) + call site chặn loop lâu nhất kèm stack mẫu."""
+    return loop_monitor.snapshot(top=top, include_stacks=stacks)
+
+
+@app.post("/debug/loop/reset", dependencies=[Depends(_require_debug_key)])
+async def debug_loop_reset():
+    loop_monitor.reset()
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format: histogram theo stage / bước, hàng đợi, phiên, lỗi."""
+    return Response(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/api/metrics/summary")
+async def metrics_summary():
+    """p50/p95/p99 (ước tính từ bucket) của mọi histogram theo label."""
+    return REGISTRY.summary()
+
+
+# ============================================================
+# PROFILE THEO YÊU CẦU (CPU sampling + tracemalloc) — cần API key
+# ============================================================
+sampling_profiler = SamplingProfiler()
+memory_tracker = MemoryTracker()
+
+
+@app.get("/debug/profile/cpu", dependencies=[Depends(_require_debug_key)])
+async def debug_profile_cpu(seconds: float = 10.0, format: str = "collapsed",
+                            idle: bool = False, thread: str = "", top: int = 30):
+    """
+    Lấy mẫu stack mọi thread trong `seconds` giây.
+    format=collapsed → file collapsed stacks (flamegraph.pl / speedscope), format=json → top hàm + stacks.
+    idle=true giữ cả mẫu thread đang ngủ chờ việc; thread=<chuỗi> lọc theo tên thread.
+    """
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail="format phải là collapsed hoặc json")
+    log_info(f"[Profile] 🔬 Bắt đầu lấy mẫu CPU {seconds:.1f}s")
+    try:
+        result = await asyncio.to_thread(sampling_profiler.profile, seconds, idle, thread)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    log_info(f"[Profile] ✅ {result['samples']} mẫu / {result['rounds']} vòng, overhead {result['overhead_pct']}%")
+    if format == "collapsed":
+        return Response(SamplingProfiler.collapsed(result), media_type="text/plain; charset=utf-8", headers={
+            "Content-Disposition": f'attachment; filename="profile_{int(time.time())}.collapsed.txt"'
+        })
+    stacks = result.pop("stacks")
+    result["top_functions"] = SamplingProfiler.top_functions({"stacks": stacks, "samples": result["samples"]}, top)
+    result["stacks"] = dict(stacks.most_common(200))
+    return result
+
+
+@app.get("/debug/profile/status", dependencies=[Depends(_require_debug_key)])
+async def debug_profile_status():
+    return {"cpu": {"busy": sampling_profiler.busy, "last_run": sampling_profiler.last_run},
+            "memory": memory_tracker.status()}
+
+
+@app.post("/debug/memory/start", dependencies=[Depends(_require_debug_key)])
+async def debug_memory_start(frames: int = 0):
+    """Bật tracemalloc + snapshot nền (cấp phát trước lúc này không được theo dõi)."""
+    status = await asyncio.to_thread(memory_tracker.start, frames or None)
+    log_info(f"[Profile] 🧠 tracemalloc bật ({status['frames']} frame)")
+    return status
+
+
+@app.get("/debug/memory/diff", dependencies=[Depends(_require_debug_key)])
+async def debug_memory_diff(top: int = 30, group_by: str = "lineno", rebase: bool = False):
+    """So snapshot hiện tại với nền: nơi bộ nhớ tăng nhiều nhất."""
+    try:
+        return await asyncio.to_thread(memory_tracker.diff, top, group_by, rebase)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.post("/debug/memory/stop", dependencies=[Depends(_require_debug_key)])
+async def debug_memory_stop():
+    """Tắt tracemalloc → hết overhead."""
+    log_info("[Profile] 🧠 tracemalloc tắt")
+    return memory_tracker.stop()
+
 # Thư mục static → chứa QR payment, HTML demo UI
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -0,0 +1,130 @@
+# benchmarks/bench_admission_overload.py
+"""
+Overload test cho admission control (ai_modules/admission.py).
+
+Dựng VoicePipeline thật với stage ASR giả lập (ngủ asr_ms trong executor,
+1 worker như cấu hình mặc định) và bắn các phiên 1 lượt theo Poisson ở
+nhiều mức tải quanh điểm bão hoà (capacity = 1000 / asr_ms phiên/giây).
+So sánh có / không admission control:
+  - goodput = số lượt xong trong SLO / giây
+  - số phiên bị từ chối (503), p50/p95 độ trễ của lượt được nhận
+
+Không có admission: hàng đợi ASR dài dần → mọi lượt trễ quá SLO → goodput sụp.
+Có admission: phiên thừa bị từ chối sớm → goodput giữ quanh capacity.
+
+Chạy:
+    python benchmarks/bench_admission_overload.py --asr-ms 100 --slo-ms 2000 --duration 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_modules.admission import AdmissionController  # noqa: E402
+from ai_modules.voice_pipeline import PipelineStage, TurnContext, VoicePipeline  # noqa: E402
+from bench_common import percentile  # noqa: E402
+
+
+def build_pipeline(asr_ms: float) -> VoicePipeline:
+    async def asr(ctx, stage):
+        await stage.run_blocking(time.sleep, asr_ms / 1000)
+
+    async def rest(ctx, stage):
+        await asyncio.sleep(0.005)
+
+    return VoicePipeline([
+        PipelineStage("asr", asr, workers=1, queue_size=4096),
+        PipelineStage("rest", rest, workers=4, queue_size=4096),
+    ], log_callback=lambda *a, **k: None)
+
+
+async def run_level(rate: float, use_admission: bool, args) -> dict:
+    pipeline = build_pipeline(args.asr_ms)
+    in_flight = 0
+    admission = AdmissionController(
+        pipeline,
+        live_sessions=lambda: in_flight,
+        max_sessions=args.max_sessions,
+        max_asr_queue=args.max_asr_queue,
+        max_p95_ms=args.slo_ms,
+        queue_timeout_sec=0,
+        log_callback=lambda *a, **k: None,
+    )
+    rng = random.Random(args.seed)
+    latencies, rejected = [], 0
+    tasks = []
+
+    async def one_session(i: int):
+        nonlocal in_flight, rejected
+        t0 = time.perf_counter()
+        if use_admission:
+            decision = await admission.admit()
+            if not decision.admitted:
+                rejected += 1
+                return
+        in_flight += 1
+        try:
+            await pipeline.submit(TurnContext(f"s{i}", "", source="upload"))
+            latencies.append((time.perf_counter() - t0) * 1000)
+        finally:
+            in_flight -= 1
+
+    started = time.perf_counter()
+    i = 0
+    while time.perf_counter() - started < args.duration:
+        tasks.append(asyncio.create_task(one_session(i)))
+        i += 1
+        await asyncio.sleep(rng.expovariate(rate))
+
+    # Lượt còn chờ sau duration + SLO chắc chắn trễ → huỷ, không tính goodput
+    await asyncio.wait(tasks, timeout=args.slo_ms / 1000)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await pipeline.shutdown()
+
+    good = sum(1 for ms in latencies if ms <= args.slo_ms)
+    return {
+        "offered_rps": round(rate, 2),
+        "admission": use_admission,
+        "sessions": i,
+        "rejected": rejected,
+        "completed": len(latencies),
+        "good": good,
+        "goodput_rps": round(good / args.duration, 2),
+        "latency_p50_ms": round(percentile(latencies, 0.50), 1),
+        "latency_p95_ms": round(percentile(latencies, 0.95), 1),
+    }
+
+
+async def main(args):
+    capacity = 1000 / args.asr_ms
+    results = []
+    for mult in args.load:
+        for use_admission in (False, True):
+            results.append(await run_level(capacity * mult, use_admission, args))
+    return {
+        "asr_ms": args.asr_ms,
+        "capacity_rps": round(capacity, 2),
+        "slo_ms": args.slo_ms,
+        "duration_sec": args.duration,
+        "levels": results,
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--asr-ms", type=float, default=100)
+    ap.add_argument("--slo-ms", type=float, default=2000)
+    ap.add_argument("--duration", type=float, default=5)
+    ap.add_argument("--load", type=float, nargs="+", default=[0.5, 1.0, 1.5, 2.0, 3.0],
+                    help="mức tải theo bội số capacity")
+    ap.add_argument("--max-sessions", type=int, default=1000)
+    ap.add_argument("--max-asr-queue", type=int, default=8)
+    ap.add_argument("--seed", type=int, default=7)
+    print(json.dumps(asyncio.run(main(ap.parse_args())), indent=2, ensure_ascii=False))
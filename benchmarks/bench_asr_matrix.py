@@ -0,0 +1,395 @@
+# benchmarks/bench_asr_matrix.py
+"""
+Ma trận độ chính xác / tốc độ ASR để chọn WHISPER_MODEL_NAME theo phần cứng.
+
+Chạy tập test tiếng Việt có nhãn (x.wav + x.txt trong --data-dir, hoặc
+--manifest JSONL {"audio": ..., "text": ...}) qua MỌI tổ hợp:
+  - --models   : tiny base small medium large-v3 ...
+  - --backends : whisper (openai-whisper, như server), faster_whisper[:int8|float16|float32]
+  - --devices  : cpu cuda
+  - --profiles : server (model.transcribe(audio) mặc định như rtc_integration_layer),
+                 greedy (vi, temperature 0), beam5 (vi, beam search 5)
+  - --vad      : none, silero (_apply_silero_vad của server, chạy 1 lần trước
+                 cho cả tập, thời gian VAD cộng vào độ trễ từng câu)
+
+Mỗi tổ hợp chạy trong process con riêng (RSS / GPU đo sạch, model giải phóng
+khi xong). Báo cáo: WER / CER (chuẩn hoá NFC, chữ thường, bỏ dấu câu), RTF,
+p50 / p95 độ trễ mỗi câu, thời gian nạp model, RSS đỉnh và phần model chiếm;
+Pareto front theo (WER, RTF) và gợi ý tổ hợp WER thấp nhất thoả --max-rtf /
+--max-mem-mb. Backend / model không có trên máy → dòng "skipped" kèm lý do.
+
+Chạy:
+    python benchmarks/bench_asr_matrix.py --data-dir testset_vi --models tiny base small \\
+        --backends whisper faster_whisper:int8 --profiles server greedy --vad none silero \\
+        --output asr_matrix.json
+"""
+import argparse
+import contextlib
+import glob
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_common import peak_rss_mb, percentile, rss_mb  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+PROFILES = {
+    # Đúng lời gọi của ASRServiceWhisper.transcribe_sync (tự nhận ngôn ngữ, tham số mặc định)
+    "server": {},
+    "greedy": {"language": "vi", "temperature": 0.0, "condition_on_previous_text": False},
+    "beam5": {"language": "vi", "temperature": 0.0, "beam_size": 5},
+}
+
+
+# ============================================================
+# TẬP TEST + WER
+# ============================================================
+def load_testset(data_dir: str, manifest: str) -> list:
+    items = []
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    items.append({"audio": os.path.join(base, row["audio"]), "text": row["text"]})
+    else:
+        for wav_path in sorted(glob.glob(os.path.join(data_dir, "*.wav"))):
+            txt_path = os.path.splitext(wav_path)[0] + ".txt"
+            if os.path.exists(txt_path):
+                with open(txt_path, encoding="utf-8") as f:
+                    items.append({"audio": wav_path, "text": f.read().strip()})
+    if not items:
+        raise SystemExit("Không có cặp WAV + nhãn nào (cần x.wav + x.txt hoặc --manifest).")
+    for item in items:
+        with wave.open(item["audio"], "rb") as wf:
+            item["audio_sec"] = wf.getnframes() / float(wf.getframerate())
+    return items
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text or "").lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def _edit_distance(ref: list, hyp: list) -> int:
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1]
+
+
+def error_rates(refs: list, hyps: list) -> dict:
+    """WER / CER gộp trên cả tập (tổng lỗi / tổng từ, ký tự của nhãn)."""
+    word_err = word_total = char_err = char_total = 0
+    for ref, hyp in zip(refs, hyps):
+        ref, hyp = normalize_text(ref), normalize_text(hyp)
+        word_err += _edit_distance(ref.split(), hyp.split())
+        word_total += len(ref.split())
+        char_err += _edit_distance(list(ref.replace(" ", "")), list(hyp.replace(" ", "")))
+        char_total += len(ref.replace(" ", ""))
+    return {"wer": word_err / max(1, word_total), "cer": char_err / max(1, char_total)}
+
+
+# ============================================================
+# PROCESS CON: VAD 1 LẦN / 1 TỔ HỢP ASR
+# ============================================================
+def child_vad(files: list, cache_dir: str) -> dict:
+    """Silero VAD của server cho cả tập → cache .npy + thời gian VAD từng file."""
+    import numpy as np
+    from pathlib import Path
+
+    # Nạp module server để dùng đúng _apply_silero_vad; module nạp kèm Whisper
+    # mặc định khi import → ép model nhỏ nhất, chỉ 1 lần cho cả ma trận
+    os.environ["VOICE_STUB_MODE"] = "0"
+    os.environ["WHISPER_MODEL_NAME"] = "tiny"
+    from ai_modules import rtc_integration_layer as ril
+
+    if not ril.VAD_IS_READY:
+        return {"ready": False, "error": "Silero VAD không nạp được"}
+    vad_ms = []
+    for index, path in enumerate(files):
+        started = time.perf_counter()
+        audio = ril._apply_silero_vad(Path(path), lambda *a, **k: None)
+        vad_ms.append((time.perf_counter() - started) * 1000)
+        np.save(os.path.join(cache_dir, f"{index}.npy"), np.asarray(audio, dtype=np.float32))
+    return {"ready": True, "vad_ms": vad_ms}
+
+
+def _load_audio(path: str):
+    import numpy as np
+    import soundfile as sf
+
+    audio, sr = sf.read(path, dtype="float32")
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        from math import gcd
+        from scipy.signal import resample_poly
+        g = gcd(int(sr), SAMPLE_RATE)
+        audio = resample_poly(audio, SAMPLE_RATE // g, int(sr) // g).astype(np.float32)
+    return audio
+
+
+def _load_backend(backend: str, model: str, device: str):
+    """→ hàm transcribe(audio float32 16kHz, options) → text."""
+    name, _, compute_type = backend.partition(":")
+    if name == "whisper":
+        import whisper
+
+        asr = whisper.load_model(model, device=device)
+
+        def transcribe(audio, options):
+            return asr.transcribe(audio, fp16=(device == "cuda"), **options).get("text", "")
+        return transcribe
+
+    if name == "faster_whisper":
+        from faster_whisper import WhisperModel
+
+        asr = WhisperModel(model, device=device,
+                           compute_type=compute_type or ("float16" if device == "cuda" else "int8"))
+
+        def transcribe(audio, options):
+            options = dict(options)
+            if "temperature" in options and "beam_size" not in options:
+                options["beam_size"] = 1        # faster-whisper mặc định beam 5
+            segments, _info = asr.transcribe(audio, **options)
+            return "".join(segment.text for segment in segments)
+        return transcribe
+
+    raise ValueError(f"Backend không hỗ trợ: {backend}")
+
+
+def child_asr(spec: dict) -> dict:
+    import numpy as np
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    transcribe = _load_backend(spec["backend"], spec["model"], spec["device"])
+    load_sec = time.perf_counter() - started
+    rss_model = rss_mb() - rss_before
+    options = PROFILES[spec["profile"]]
+
+    def audio_of(index):
+        if spec.get("vad_cache"):
+            return np.load(os.path.join(spec["vad_cache"], f"{index}.npy"))
+        return _load_audio(spec["files"][index])
+
+    # Lượt khởi động (cấp phát, JIT / cuDNN autotune) không tính
+    transcribe(audio_of(0), options)
+
+    hyps, latency_ms = [], []
+    for index in range(len(spec["files"])):
+        audio = audio_of(index)
+        started = time.perf_counter()
+        text = transcribe(audio, options).strip() if len(audio) else ""
+        latency_ms.append((time.perf_counter() - started) * 1000)
+        hyps.append(text)
+
+    gpu_mb = None
+    if spec["device"] == "cuda":
+        try:
+            import torch
+            gpu_mb = torch.cuda.max_memory_allocated() / 2**20
+        except Exception:
+            gpu_mb = None
+    return {
+        "hyps": hyps,
+        "latency_ms": latency_ms,
+        "load_sec": load_sec,
+        "rss_mb_model": rss_model,
+        "rss_mb_peak": peak_rss_mb(),
+        "gpu_mb_peak": gpu_mb,
+    }
+
+
+def _run_child(mode: str, payload: dict, timeout: float) -> dict:
+    """Chạy process con (--child-vad / --child-asr), JSON vào qua stdin, ra ở dòng cuối stdout."""
+    cmd = [sys.executable, os.path.abspath(__file__), f"--child-{mode}"]
+    try:
+        proc = subprocess.run(cmd, input=json.dumps(payload), capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": f"timeout sau {timeout:.0f}s"}
+    lines = [line for line in proc.stdout.splitlines() if line.strip()]
+    if proc.returncode != 0 or not lines:
+        tail = (proc.stderr or "").strip().splitlines()[-1:] or ["không có output"]
+        return {"error": tail[0][:300]}
+    return json.loads(lines[-1])
+
+
+# ============================================================
+# TỔNG HỢP: BẢNG + PARETO
+# ============================================================
+def pareto_front(rows: list) -> list:
+    """Tổ hợp không bị tổ hợp nào khác tốt hơn hoặc bằng ở cả WER lẫn RTF."""
+    ok = [r for r in rows if r["status"] == "ok"]
+    front = []
+    for r in ok:
+        dominated = any(
+            o is not r and o["wer"] <= r["wer"] and o["rtf"] <= r["rtf"]
+            and (o["wer"] < r["wer"] or o["rtf"] < r["rtf"])
+            for o in ok
+        )
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: r["rtf"])
+
+
+def recommend(rows: list, max_rtf: float, max_mem_mb: float):
+    fits = [r for r in rows if r["status"] == "ok" and r["rtf"] <= max_rtf
+            and (not max_mem_mb or r["mem_mb_peak"] <= max_mem_mb)]
+    return min(fits, key=lambda r: (r["wer"], r["rtf"])) if fits else None
+
+
+def format_table(rows: list) -> str:
+    header = ("model", "backend", "device", "profile", "vad", "WER%", "CER%", "RTF",
+              "p50ms", "p95ms", "load_s", "mem_MB", "model_MB", "pareto")
+    lines = [header]
+    for r in rows:
+        if r["status"] != "ok":
+            lines.append((r["model"], r["backend"], r["device"], r["profile"], r["vad"],
+                          "-", "-", "-", "-", "-", "-", "-", "-", f"{r['status']}: {r.get('error', '')[:60]}"))
+            continue
+        lines.append((
+            r["model"], r["backend"], r["device"], r["profile"], r["vad"],
+            f"{r['wer'] * 100:.1f}", f"{r['cer'] * 100:.1f}", f"{r['rtf']:.3f}",
+            f"{r['p50_ms']:.0f}", f"{r['p95_ms']:.0f}", f"{r['load_sec']:.1f}",
+            f"{r['mem_mb_peak']:.0f}", f"{r['model_mb']:.0f}", "*" if r.get("pareto") else "",
+        ))
+    widths = [max(len(str(line[i])) for line in lines if len(line) > i) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(str(cell).ljust(widths[i]) for i, cell in enumerate(line)).rstrip() for line in lines
+    )
+
+
+def run_matrix(args) -> dict:
+    items = load_testset(args.data_dir, args.manifest)
+    files = [item["audio"] for item in items]
+    refs = [item["text"] for item in items]
+    audio_sec = [item["audio_sec"] for item in items]
+
+    vad_result, vad_cache = {}, None
+    if "silero" in args.vad:
+        vad_cache = tempfile.mkdtemp(prefix="asr_matrix_vad_")
+        print(f"[VAD] Silero cho {len(files)} file...", file=sys.stderr)
+        vad_result = _run_child("vad", {"files": files, "cache_dir": vad_cache}, args.timeout)
+
+    rows = []
+    for model, backend, device, profile, vad in itertools.product(
+            args.models, args.backends, args.devices, args.profiles, args.vad):
+        row = {"model": model, "backend": backend, "device": device, "profile": profile, "vad": vad}
+        rows.append(row)
+        if vad == "silero" and not vad_result.get("ready"):
+            row.update(status="skipped", error=vad_result.get("error", "VAD lỗi"))
+            continue
+        print(f"[ASR] {model} / {backend} / {device} / {profile} / vad={vad}", file=sys.stderr)
+        result = _run_child("asr", {
+            "backend": backend, "model": model, "device": device, "profile": profile,
+            "files": files, "vad_cache": vad_cache if vad == "silero" else None,
+        }, args.timeout)
+        if "error" in result:
+            row.update(status="skipped", error=result["error"])
+            continue
+        latency = list(result["latency_ms"])
+        if vad == "silero":
+            latency = [a + v for a, v in zip(latency, vad_result["vad_ms"])]
+        rates = error_rates(refs, result["hyps"])
+        row.update(
+            status="ok",
+            wer=round(rates["wer"], 4),
+            cer=round(rates["cer"], 4),
+            rtf=round(sum(latency) / 1000 / sum(audio_sec), 4),
+            p50_ms=round(percentile(latency, 0.50), 1),
+            p95_ms=round(percentile(latency, 0.95), 1),
+            load_sec=round(result["load_sec"], 2),
+            mem_mb_peak=round(result["rss_mb_peak"], 1),
+            model_mb=round(result["rss_mb_model"], 1),
+            gpu_mb_peak=round(result["gpu_mb_peak"], 1) if result["gpu_mb_peak"] is not None else None,
+        )
+        if args.keep_hyps:
+            row["hyps"] = result["hyps"]
+
+    front = pareto_front(rows)
+    for r in front:
+        r["pareto"] = True
+    best = recommend(rows, args.max_rtf, args.max_mem_mb)
+
+    def label(r):
+        return f"{r['model']} / {r['backend']} / {r['device']} / {r['profile']} / vad={r['vad']}"
+
+    return {
+        "testset": {"utterances": len(items), "audio_sec": round(sum(audio_sec), 2)},
+        "results": rows,
+        "pareto_front": [{"config": label(r), "wer": r["wer"], "rtf": r["rtf"], "p95_ms": r["p95_ms"],
+                          "mem_mb_peak": r["mem_mb_peak"]} for r in front],
+        "recommendation": {
+            "constraints": {"max_rtf": args.max_rtf, "max_mem_mb": args.max_mem_mb or None},
+            "config": label(best) if best else None,
+            "wer": best["wer"] if best else None,
+            "rtf": best["rtf"] if best else None,
+        },
+    }
+
+
+def main(args):
+    report = run_matrix(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(format_table(report["results"]))
+    print()
+    print(f"Tập test: {report['testset']['utterances']} câu, {report['testset']['audio_sec']}s audio")
+    print("Pareto front (WER ↓, RTF ↓):")
+    for p in report["pareto_front"]:
+        print(f"  - {p['config']}: WER {p['wer'] * 100:.1f}%, RTF {p['rtf']:.3f}, "
+              f"p95 {p['p95_ms']:.0f}ms, {p['mem_mb_peak']:.0f}MB")
+    rec = report["recommendation"]
+    if rec["config"]:
+        print(f"Gợi ý (RTF <= {args.max_rtf}): {rec['config']} — WER {rec['wer'] * 100:.1f}%, RTF {rec['rtf']:.3f}")
+    else:
+        print(f"Không tổ hợp nào thoả RTF <= {args.max_rtf}" + (f", RSS <= {args.max_mem_mb}MB" if args.max_mem_mb else ""))
+
+
+def _child_main(mode: str):
+    payload = json.loads(sys.stdin.read())
+    # Log khi nạp model in ra stdout → chuyển sang stderr, dòng cuối stdout là JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        if mode == "vad":
+            result = child_vad(payload["files"], payload["cache_dir"])
+        else:
+            result = child_asr(payload)
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] in ("--child-vad", "--child-asr"):
+        _child_main(sys.argv[1][len("--child-"):])
+        sys.exit(0)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--data-dir", default="testset_vi", help="thư mục x.wav + x.txt")
+    ap.add_argument("--manifest", default="", help='JSONL {"audio": ..., "text": ...} (thay cho --data-dir)')
+    ap.add_argument("--models", nargs="+", default=["tiny", "base", "small"])
+    ap.add_argument("--backends", nargs="+", default=["whisper"])
+    ap.add_argument("--devices", nargs="+", default=["cpu"])
+    ap.add_argument("--profiles", nargs="+", default=["server", "greedy"], choices=sorted(PROFILES))
+    ap.add_argument("--vad", nargs="+", default=["none", "silero"], choices=["none", "silero"])
+    ap.add_argument("--max-rtf", type=float, default=0.5, help="ràng buộc RTF cho tổ hợp được gợi ý")
+    ap.add_argument("--max-mem-mb", type=float, default=0.0, help="ràng buộc RSS đỉnh (0 = không giới hạn)")
+    ap.add_argument("--timeout", type=float, default=3600.0, help="timeout mỗi process con (giây)")
+    ap.add_argument("--keep-hyps", action="store_true", help="giữ transcript từng câu trong JSON")
+    ap.add_argument("--output", default="", help="ghi JSON đầy đủ ra file")
+    main(ap.parse_args())
@@ -0,0 +1,31 @@
+# benchmarks/bench_common.py
+"""
+Hàm dùng chung cho các script trong benchmarks/ (percentile, RSS của process).
+
+Import như module cùng thư mục (thư mục script nằm trong sys.path):
+    from bench_common import percentile, rss_mb, peak_rss_mb
+"""
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.metrics import percentile  # noqa: E402  (1 bản dùng chung với runtime)
+
+__all__ = ["percentile", "rss_mb", "peak_rss_mb"]
+
+
+def rss_mb() -> float:
+    """RSS hiện tại của process (MB), đọc /proc; không có /proc → 0."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    """RSS đỉnh của process (MB); ru_maxrss là bytes trên macOS, KB trên Linux."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
@@ -0,0 +1,131 @@
+# benchmarks/bench_ingest_cpu.py
+"""
+So sánh CPU phía server cho mỗi phiên: media track vs PCM binary ingest.
+
+- media track: gói Opus 20ms (OpusEncoder của aiortc, mô phỏng trình duyệt,
+  không tính CPU) → OpusDecoder của aiortc → int16 mono → resample_poly
+  48k→16k như AudioFileRecorder. Chưa tính SRTP / RTP / jitter buffer nên
+  là cận dưới của chi phí thật.
+- pcm ingest: frame [seq][PCM16 16kHz] 20ms → PcmIngest.feed → sink.
+
+Báo cáo CPU-ms cho mỗi giây audio, số phiên tối đa trên 1 core và băng
+thông upstream. Cần aiortc + numpy + scipy cho phần media track.
+
+Chạy:
+    python benchmarks/bench_ingest_cpu.py --seconds 30
+"""
+import argparse
+import array
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_modules.pcm_ingest import PcmIngest, PCM_INGEST_HEADER  # noqa: E402
+
+FRAME_MS = 20
+
+
+def synth_speechlike(seconds: float, rate: int, seed: int = 7) -> array.array:
+    """Tín hiệu giả giọng nói: vài formant điều biên + nhiễu, int16."""
+    rng = random.Random(seed)
+    n = int(seconds * rate)
+    out = array.array("h", bytes(n * 2))
+    for i in range(n):
+        t = i / rate
+        env = 0.5 + 0.5 * math.sin(2 * math.pi * 3 * t)
+        s = env * (0.4 * math.sin(2 * math.pi * 220 * t) + 0.2 * math.sin(2 * math.pi * 880 * t))
+        out[i] = int(max(-1.0, min(1.0, s + rng.uniform(-0.02, 0.02))) * 32767)
+    return out
+
+
+def _result(cpu_sec: float, audio_sec: float, upstream_bytes: int) -> dict:
+    per_sec = cpu_sec / audio_sec
+    return {
+        "cpu_ms_per_audio_sec": round(per_sec * 1000, 3),
+        "sessions_per_core": round(1 / per_sec, 1) if per_sec > 0 else None,
+        "upstream_kbps": round(upstream_bytes * 8 / audio_sec / 1000, 1),
+    }
+
+
+def bench_media_track(samples_48k: array.array, seconds: float) -> dict:
+    import av
+    import numpy as np
+    from scipy.signal import resample_poly
+    from aiortc.codecs.opus import OpusDecoder, OpusEncoder
+    from aiortc.jitterbuffer import JitterFrame
+
+    # Client: mã hoá Opus như trình duyệt (không tính vào CPU server)
+    encoder = OpusEncoder()
+    step = 48000 * FRAME_MS // 1000
+    pcm = np.frombuffer(samples_48k.tobytes(), dtype=np.int16)
+    packets = []
+    for i in range(0, len(pcm) - step + 1, step):
+        frame = av.AudioFrame.from_ndarray(pcm[i:i + step].reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = 48000
+        frame.pts = i
+        payloads, timestamp = encoder.encode(frame)
+        packets.extend((p, timestamp) for p in payloads)
+
+    decoder = OpusDecoder()
+    out_bytes = 0
+    started = time.process_time()
+    for payload, timestamp in packets:
+        for frame in decoder.decode(JitterFrame(data=payload, timestamp=timestamp)):
+            data = frame.to_ndarray()
+            if data.dtype == np.float32:
+                data = (data * 32767).astype(np.int16)
+            # s16 packed: (1, samples * channels) → mono
+            channels = len(frame.layout.channels)
+            mono = data.reshape(-1, channels).mean(axis=1).astype(np.int16)
+            out_bytes += len(resample_poly(mono, 1, 3).astype(np.int16).tobytes())
+    cpu_sec = time.process_time() - started
+
+    result = _result(cpu_sec, seconds, sum(len(p) for p, _ in packets))
+    result["pcm_out_bytes"] = out_bytes
+    return result
+
+
+def bench_pcm_ingest(samples_16k: array.array, seconds: float) -> dict:
+    step = 16000 * FRAME_MS // 1000
+    raw = samples_16k.tobytes()
+    messages = [
+        PCM_INGEST_HEADER.pack(seq) + raw[i * 2:(i + step) * 2]
+        for seq, i in enumerate(range(0, len(samples_16k) - step + 1, step))
+    ]
+    chunks = []
+    ingest = PcmIngest(chunks.append, sample_rate=16000, frame_ms=FRAME_MS)
+    started = time.process_time()
+    for message in messages:
+        ingest.feed(message)
+    cpu_sec = time.process_time() - started
+
+    result = _result(cpu_sec, seconds, sum(len(m) for m in messages))
+    result["pcm_out_bytes"] = sum(len(c) for c in chunks)
+    return result
+
+
+def main(args) -> dict:
+    samples_16k = synth_speechlike(args.seconds, 16000)
+    report = {"audio_sec": args.seconds, "frame_ms": FRAME_MS}
+    report["pcm_ingest"] = bench_pcm_ingest(samples_16k, args.seconds)
+    try:
+        samples_48k = synth_speechlike(args.seconds, 48000)
+        report["media_track"] = bench_media_track(samples_48k, args.seconds)
+        report["cpu_ratio_media_vs_ingest"] = round(
+            report["media_track"]["cpu_ms_per_audio_sec"]
+            / max(report["pcm_ingest"]["cpu_ms_per_audio_sec"], 1e-6), 1
+        )
+    except ImportError as e:
+        report["media_track"] = {"error": f"thiếu thư viện: {e}"}
+    return report
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=30)
+    print(json.dumps(main(ap.parse_args()), indent=2, ensure_ascii=False))
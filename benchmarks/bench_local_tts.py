@@ -0,0 +1,90 @@
+# benchmarks/bench_local_tts.py
+"""
+Benchmark throughput cho LocalTTSEngine (core/tts_connector.py).
+
+Với mỗi mức concurrency, gửi đồng thời N câu vào engine (model đã nạp sẵn
+trên mọi worker), đo số câu/giây, giây audio tổng hợp được / giây thực
+(xRT) và độ trễ p50/p95 mỗi câu. Cần cài `TTS` (Coqui) để chạy.
+
+Chạy:
+    python benchmarks/bench_local_tts.py --model <model Coqui tiếng Việt> --workers 2 --concurrency 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_common import percentile  # noqa: E402
+from core.tts_connector import LocalTTSEngine, TTS_LOCAL_MODEL, TTS_SAMPLE_RATE  # noqa: E402
+
+SENTENCES = [
+    "Sản phẩm này hiện còn hàng.",
+    "Đơn hàng của bạn đã được xác nhận.",
+    "Tổng số tiền cần thanh toán là năm trăm nghìn đồng.",
+    "Bạn muốn đặt thêm sản phẩm nào nữa không?",
+    "Hệ thống đã mở trang thanh toán.",
+]
+
+
+async def run_level(engine: LocalTTSEngine, concurrency: int, rounds: int) -> dict:
+    latencies = []
+    audio_bytes = 0
+
+    async def one(text: str):
+        nonlocal audio_bytes
+        t0 = time.perf_counter()
+        pcm = await engine.synthesize_async(text)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        audio_bytes += len(pcm)
+
+    started = time.perf_counter()
+    for r in range(rounds):
+        await asyncio.gather(*(
+            one(SENTENCES[(r * concurrency + i) % len(SENTENCES)]) for i in range(concurrency)
+        ))
+    elapsed = time.perf_counter() - started
+
+    audio_sec = audio_bytes / 2 / engine.sample_rate
+    return {
+        "concurrency": concurrency,
+        "utterances": len(latencies),
+        "elapsed_sec": round(elapsed, 3),
+        "utterances_per_sec": round(len(latencies) / elapsed, 3),
+        "audio_sec": round(audio_sec, 2),
+        "x_realtime": round(audio_sec / elapsed, 3),
+        "latency_p50_ms": round(percentile(latencies, 0.50), 1),
+        "latency_p95_ms": round(percentile(latencies, 0.95), 1),
+    }
+
+
+async def main(args):
+    engine = LocalTTSEngine(model_name=args.model, workers=args.workers,
+                            sample_rate=args.sample_rate, log_callback=lambda *a, **k: None)
+    t0 = time.perf_counter()
+    await engine.warmup()
+    load_sec = time.perf_counter() - t0
+
+    levels = [await run_level(engine, c, args.rounds) for c in args.concurrency]
+    engine.shutdown()
+    return {
+        "model": args.model,
+        "workers": args.workers,
+        "sample_rate": args.sample_rate,
+        "model_load_sec": round(load_sec, 2),
+        "levels": levels,
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default=TTS_LOCAL_MODEL or None, required=not TTS_LOCAL_MODEL,
+                    help="model Coqui đọc được tiếng Việt (mặc định TTS_LOCAL_MODEL)")
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--sample-rate", type=int, default=TTS_SAMPLE_RATE)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--rounds", type=int, default=5)
+    print(json.dumps(asyncio.run(main(ap.parse_args())), indent=2, ensure_ascii=False))
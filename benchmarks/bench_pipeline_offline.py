@@ -0,0 +1,285 @@
+# benchmarks/bench_pipeline_offline.py
+"""
+Benchmark offline của chuỗi xử lý (không WebRTC / HTTP): phát lại một thư
+mục WAV (mặc định kho temp/*_input*.wav do server ghi) qua đúng các thành
+phần của backend, trong cùng process:
+
+    vad (Silero) → asr (Whisper) → parser (STTLogParser) → logic
+    (LogicManager.handle_nlu_result) → dm (DialogManager async, DB ∥ Logic)
+    → tts (TTSClient theo câu, phrase cache như server)
+
+--concurrency N: N lượt chạy song song (phần blocking chạy trong thread như
+executor của VoicePipeline). Báo cáo JSON:
+  - rtf: tổng thời gian chạy / tổng giây audio (thông lượng) + RTF từng lượt
+  - từng stage: wall p50/p95/mean; CPU-ms (time.process_time, gồm cả thread
+    nội bộ của torch) — chỉ tách được theo stage khi --concurrency 1
+  - CPU process, RSS sau khi nạp model và RSS đỉnh
+--baseline <json cũ>: so p50 / CPU theo stage, vượt --max-regression-pct →
+exit code 1 (dùng trong CI / trước khi merge).
+
+VOICE_STUB_MODE=1 → ASR / TTS giả lập, chỉ đo chuỗi parser → logic → DM.
+Log của các module đi ra stderr, stdout chỉ có JSON.
+
+Chạy:
+    python benchmarks/bench_pipeline_offline.py --wav-dir temp --concurrency 1
+    python benchmarks/bench_pipeline_offline.py --concurrency 4 --output after.json --baseline before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+import wave
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_common import peak_rss_mb, percentile, rss_mb  # noqa: E402
+
+STAGES = ("vad", "asr", "parser", "logic", "dm", "tts")
+NO_SPEECH = "[NO SPEECH DETECTED]"
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def _wav_seconds(path: str) -> float:
+    with wave.open(path, "rb") as wf:
+        return wf.getnframes() / float(wf.getframerate())
+
+
+class OfflinePipeline:
+    """Các thành phần của backend, dựng như backend_webrtc_server.py (không FastAPI)."""
+
+    def __init__(self, tts_mode: str, tts_cache: bool = True):
+        from ai_modules import rtc_integration_layer as ril
+        from ai_modules.dialog_manager import DialogManager
+        from ai_modules.response_generator import split_templated_reply
+        from core.logic_manager import LogicManager
+        from core.stt_log_parser import STTLogParser
+        from core.tts_connector import TTS_SAMPLE_RATE, TTSClient
+        from core.tts_phrase_cache import PhraseCache
+
+        self.ril = ril
+        self.split_reply = split_templated_reply
+        self.tts_rate = TTS_SAMPLE_RATE
+        self.processor = ril.RTCStreamProcessor(log_callback=_quiet)
+        self.parser = STTLogParser(log_callback=_quiet)
+        self.logic_manager = LogicManager(
+            log_callback=_quiet, response_config={}, llm_mode="real", tts_mode="real",
+            db_mode="real", api_key=ril.INTERNAL_API_KEY,
+        )
+        self.dialog_manager = DialogManager(log_callback=_quiet, api_key=ril.INTERNAL_API_KEY, mode="rtc")
+        mode = "STUB" if ril.VOICE_STUB_MODE else tts_mode
+        # Phrase cache như server (câu lặp lại không tổng hợp lại); tắt để đo chi phí TTS thô
+        cache = PhraseCache(log_callback=_quiet) if tts_cache else None
+        self.tts = TTSClient(mode=mode, log_callback=_quiet, phrase_cache=cache)
+        self.config = {
+            "asr_model": ril.ASR_METRIC_MODEL,
+            "whisper_ready": ril.WHISPER_IS_READY,
+            "vad": "silero" if ril.VAD_IS_READY else "none",
+            "tts_mode": self.tts.mode,
+            "tts_cache": tts_cache,
+            "stub_mode": ril.VOICE_STUB_MODE,
+        }
+
+    # ========================================================
+    # CÁC STAGE (blocking → chạy trong thread như executor của pipeline)
+    # ========================================================
+    def _vad(self, path: str):
+        return self.ril._apply_silero_vad(Path(path), _quiet)
+
+    def _asr(self, audio, path: str) -> str:
+        if self.ril.WHISPER_IS_READY:
+            if len(audio) == 0:
+                return NO_SPEECH
+            text = self.ril.WHISPER_MODEL.transcribe(audio).get("text", "").strip()
+        else:
+            # Stub / Whisper không nạp được → đúng đường server dùng
+            text = self.processor.transcribe_file(Path(path))
+        return text or NO_SPEECH
+
+    async def _tts(self, user_text: str, bot_text: str) -> dict:
+        segments = ["Bạn vừa nói:", f"{user_text}.", "Câu trả lời của tôi là:",
+                    *self.split_reply(f"{bot_text}.")]
+        started = time.perf_counter()
+        first = None
+        pcm_bytes = 0
+        async for pcm in await self.tts.synthesize_stream(segments):
+            if first is None:
+                first = time.perf_counter() - started
+            pcm_bytes += len(pcm)
+        return {"first_chunk_ms": round((first or 0.0) * 1000, 2), "audio_out_sec": pcm_bytes / 2 / self.tts_rate}
+
+    async def run_one(self, path: str, session) -> dict:
+        record = {"file": os.path.basename(path), "audio_sec": _wav_seconds(path), "stages": {}}
+
+        async def stage(name, coro_or_fn, *args):
+            wall0, cpu0 = time.perf_counter(), time.process_time()
+            if asyncio.iscoroutinefunction(coro_or_fn):
+                result = await coro_or_fn(*args)
+            else:
+                result = await asyncio.to_thread(coro_or_fn, *args)
+            record["stages"][name] = {
+                "wall_ms": (time.perf_counter() - wall0) * 1000,
+                "cpu_ms": (time.process_time() - cpu0) * 1000,
+            }
+            return result
+
+        started = time.perf_counter()
+        audio = await stage("vad", self._vad, path)
+        user_text = await stage("asr", self._asr, audio, path)
+        nlu_json = await stage("parser", self.parser.convert, {"text_response": {"user_text": user_text}})
+        decision = await stage("logic", self.logic_manager.handle_nlu_result, nlu_json)
+
+        async def dm():
+            return await self.dialog_manager.process_with_logic_manager_async(
+                nlu_json=nlu_json, logic_manager=self.logic_manager, session=session,
+            )
+
+        dm_response = await stage("dm", dm)
+        bot_text = (dm_response.get("response_text") or dm_response.get("text") or "").strip()
+        record["tts"] = await stage("tts", self._tts, user_text, bot_text or "...")
+        record["total_ms"] = (time.perf_counter() - started) * 1000
+        record["rtf"] = record["total_ms"] / 1000 / record["audio_sec"] if record["audio_sec"] else 0.0
+        record["user_text"] = user_text
+        record["intent"] = (decision or {}).get("intent")
+        return record
+
+
+async def run(args) -> dict:
+    files = sorted(glob.glob(os.path.join(args.wav_dir, args.pattern)))[:args.limit or None]
+    if not files:
+        raise SystemExit(f"Không có file nào khớp {os.path.join(args.wav_dir, args.pattern)}")
+    jobs = files * args.repeat
+
+    from core.session_store import DialogSession
+
+    pipeline = OfflinePipeline(args.tts, tts_cache=not args.no_tts_cache)
+    rss_loaded = rss_mb()
+
+    # Lượt khởi động (nạp lazy, JIT, phrase cache) không tính vào kết quả
+    for path in files[:args.warmup]:
+        await pipeline.run_one(path, DialogSession("bench-warmup"))
+
+    gate = asyncio.Semaphore(args.concurrency)
+    errors = []
+
+    async def one(index: int, path: str):
+        async with gate:
+            try:
+                return await pipeline.run_one(path, DialogSession(f"bench-{index}"))
+            except Exception as e:
+                errors.append({"file": os.path.basename(path), "error": f"{type(e).__name__}: {e}"})
+                return None
+
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    records = [r for r in await asyncio.gather(*(one(i, p) for i, p in enumerate(jobs))) if r]
+    wall = time.perf_counter() - wall0
+    cpu = time.process_time() - cpu0
+    return build_report(args, pipeline.config, records, errors, wall, cpu, rss_loaded)
+
+
+def build_report(args, config: dict, records: list, errors: list, wall: float, cpu: float,
+                 rss_loaded: float) -> dict:
+    audio_sec = sum(r["audio_sec"] for r in records)
+    per_stage_cpu = args.concurrency == 1
+    stages = {}
+    for name in STAGES:
+        walls = [r["stages"][name]["wall_ms"] for r in records if name in r["stages"]]
+        item = {
+            "p50_ms": round(percentile(walls, 0.50), 2),
+            "p95_ms": round(percentile(walls, 0.95), 2),
+            "mean_ms": round(sum(walls) / len(walls), 2) if walls else 0.0,
+            "total_ms": round(sum(walls), 1),
+        }
+        if per_stage_cpu:
+            cpu_ms = sum(r["stages"][name]["cpu_ms"] for r in records if name in r["stages"])
+            item["cpu_ms_total"] = round(cpu_ms, 1)
+            item["cpu_ms_per_audio_sec"] = round(cpu_ms / audio_sec, 2) if audio_sec else 0.0
+        stages[name] = item
+    rtfs = [r["rtf"] for r in records]
+    return {
+        "corpus": {"dir": args.wav_dir, "pattern": args.pattern, "utterances": len(records),
+                   "audio_sec": round(audio_sec, 2), "repeat": args.repeat},
+        "config": config,
+        "concurrency": args.concurrency,
+        "wall_sec": round(wall, 3),
+        "rtf": round(wall / audio_sec, 4) if audio_sec else 0.0,
+        "utterance_rtf": {"p50": round(percentile(rtfs, 0.50), 4), "p95": round(percentile(rtfs, 0.95), 4)},
+        "end_to_end_ms": {
+            "p50": round(percentile([r["total_ms"] for r in records], 0.50), 2),
+            "p95": round(percentile([r["total_ms"] for r in records], 0.95), 2),
+        },
+        "tts_first_chunk_ms_p50": round(percentile([r["tts"]["first_chunk_ms"] for r in records], 0.50), 2),
+        "stages": stages,
+        "stage_cpu_clock": "process" if per_stage_cpu else "không tách được khi concurrency > 1",
+        "process": {
+            "cpu_sec": round(cpu, 3),
+            "cpu_sec_per_audio_sec": round(cpu / audio_sec, 4) if audio_sec else 0.0,
+            "rss_mb_after_load": round(rss_loaded, 1),
+            "rss_mb_peak": round(peak_rss_mb(), 1),
+        },
+        "errors": errors,
+    }
+
+
+def compare(report: dict, baseline: dict, max_pct: float) -> dict:
+    """So với baseline: stage nào chậm hơn / tốn CPU hơn quá max_pct (%)."""
+    regressions = []
+    for name, now in report["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        for key in ("p50_ms", "cpu_ms_per_audio_sec"):
+            old, new = before.get(key), now.get(key)
+            # Bỏ qua thay đổi dưới 1ms (nhiễu đo) và stage gần như 0
+            if old is None or new is None or old <= 0 or new - old < 1.0:
+                continue
+            pct = 100 * (new - old) / old
+            if pct > max_pct:
+                regressions.append({"stage": name, "metric": key, "baseline": old, "current": new,
+                                    "change_pct": round(pct, 1)})
+    old_rtf = baseline.get("rtf") or 0.0
+    return {
+        "rtf_change_pct": round(100 * (report["rtf"] - old_rtf) / old_rtf, 1) if old_rtf else None,
+        "max_regression_pct": max_pct,
+        "regressions": regressions,
+    }
+
+
+def main(args) -> int:
+    # Module nạp model in log ra stdout → chuyển sang stderr, stdout chỉ có JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f), args.max_regression_pct)
+        exit_code = 1 if report["comparison"]["regressions"] else 0
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+    return exit_code
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--wav-dir", default="temp")
+    ap.add_argument("--pattern", default="*_input*.wav")
+    ap.add_argument("--limit", type=int, default=0, help="chỉ lấy N file đầu (0 = tất cả)")
+    ap.add_argument("--repeat", type=int, default=1, help="lặp lại kho WAV N lần")
+    ap.add_argument("--warmup", type=int, default=1, help="số lượt khởi động không tính")
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--tts", default=os.getenv("TTS_ENGINE", "GTTS"), help="MOCK / GTTS / LOCAL / STUB")
+    ap.add_argument("--no-tts-cache", action="store_true", help="tắt phrase cache TTS (đo chi phí tổng hợp thô)")
+    ap.add_argument("--output", default="", help="ghi JSON ra file")
+    ap.add_argument("--baseline", default="", help="JSON của lần chạy trước để so sánh")
+    ap.add_argument("--max-regression-pct", type=float, default=10.0)
+    sys.exit(main(ap.parse_args()))
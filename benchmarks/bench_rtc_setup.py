@@ -0,0 +1,113 @@
+# benchmarks/bench_rtc_setup.py
+"""
+Đo thời gian thiết lập phiên WebRTC (ai_modules/rtc_setup.py) với 2 peer
+aiortc thật trong cùng process (client = offerer host-only, backend =
+answerer làm đúng trình tự của /offer).
+
+Các cấu hình:
+  - legacy     : như /offer cũ — 3 STUN Google, aioice chờ srflx tới 5s
+  - default    : STUN công cộng + host address lấy sẵn + gather có giới hạn
+  - lan        : chỉ host candidate
+  - local_stun : STUN stand-in chạy trong process (127.0.0.1)
+
+--stun-url thay STUN công cộng (legacy + default); dùng địa chỉ không trả
+lời (vd. stun:192.0.2.1:3478) để giả lập mạng cửa hàng chặn UDP ra ngoài →
+legacy chờ hết 5s trong setLocalDescription.
+
+Chạy:
+    python benchmarks/bench_rtc_setup.py --sessions 10
+    python benchmarks/bench_rtc_setup.py --sessions 5 --stun-url stun:192.0.2.1:3478
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STUN_PORT = 34780
+os.environ.setdefault("RTC_LOCAL_STUN_PORT", str(STUN_PORT))
+os.environ.setdefault("RTC_LOCAL_STUN_URL", f"stun:127.0.0.1:{STUN_PORT}")
+
+from aiortc import RTCConfiguration, RTCIceServer, RTCPeerConnection  # noqa: E402
+
+from ai_modules import rtc_setup  # noqa: E402
+from ai_modules.rtc_setup import RTCSetupStats, SetupTimer, watch_setup  # noqa: E402
+
+LEGACY_ICE_SERVERS = [
+    "stun:stun1.l.google.com:19302",
+    "stun:stun2.l.google.com:19302",
+    "stun:stun3.l.google.com:19302",
+]
+
+
+async def one_session(mode: str, stats: RTCSetupStats, timeout: float, legacy_urls: list):
+    client = RTCPeerConnection(RTCConfiguration(iceServers=[]))
+    client.createDataChannel("control")
+    client.addTransceiver("audio", direction="recvonly")
+    await client.setLocalDescription(await client.createOffer())
+
+    setup = SetupTimer(mode)
+    offer = client.localDescription
+    setup.mark("offer_parse")
+    if mode == "legacy":
+        config = RTCConfiguration(iceServers=[RTCIceServer(urls=url) for url in legacy_urls])
+    else:
+        config = rtc_setup.rtc_configuration(mode)
+    server = RTCPeerConnection(configuration=config)
+    connected = asyncio.Event()
+    watch_setup(server, setup, stats=stats)
+
+    @server.on("connectionstatechange")
+    def on_state():
+        if server.connectionState in ("connected", "failed", "closed"):
+            connected.set()
+
+    setup.mark("session_init")
+    await server.setRemoteDescription(offer)
+    if mode != "legacy":
+        rtc_setup.tune_gather(server)
+    setup.mark("remote_description")
+    answer = await server.createAnswer()
+    setup.mark("answer")
+    await server.setLocalDescription(answer)
+    setup.mark("gather")
+    await client.setRemoteDescription(server.localDescription)
+    try:
+        await asyncio.wait_for(connected.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    await client.close()
+    await server.close()
+
+
+async def main(args) -> dict:
+    legacy_urls = LEGACY_ICE_SERVERS
+    if args.stun_url:
+        rtc_setup.RTC_STUN_URL = args.stun_url
+        legacy_urls = [args.stun_url] + LEGACY_ICE_SERVERS[1:]
+    await rtc_setup.prepare_rtc(log_callback=lambda *a, **k: None)
+    report = {"sessions": args.sessions, "stun_url": rtc_setup.RTC_STUN_URL,
+              "gather_timeout_sec": rtc_setup.RTC_GATHER_TIMEOUT_SEC, "modes": {}}
+    for mode in args.modes:
+        stats = RTCSetupStats()
+        for _ in range(args.sessions):
+            await one_session(mode, stats, args.connect_timeout, legacy_urls)
+        snapshot = stats.snapshot()
+        report["modes"][mode] = {
+            "outcomes": snapshot["outcomes"],
+            "phases": {phase: {k: v[k] for k in ("p50_ms", "p95_ms")} for phase, v in snapshot["phases"].items()},
+        }
+    report["stun_stand_in_requests"] = rtc_setup.RTC_SETUP_STATS.stun_requests
+    rtc_setup.stop_stun_stand_in()
+    return report
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=10)
+    ap.add_argument("--modes", nargs="+", default=["legacy", "default", "lan", "local_stun"])
+    ap.add_argument("--connect-timeout", type=float, default=15)
+    ap.add_argument("--stun-url", default="", help="thay STUN công cộng cho legacy / default")
+    print(json.dumps(asyncio.run(main(ap.parse_args())), indent=2, ensure_ascii=False))
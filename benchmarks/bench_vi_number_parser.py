@@ -0,0 +1,195 @@
+# benchmarks/bench_vi_number_parser.py
+"""
+Benchmark throughput cho core/vi_number_parser.py.
+
+Sinh ngẫu nhiên một tập lớn câu nói tổng hợp (số lượng, số tiền, mã đơn),
+đo số câu/giây, micro-giây/câu và độ chính xác round-trip (số → chữ → số).
+Tập câu gồm cả các câu dễ nhầm: "đơn hàng" + số lượng (không phải mã đơn),
+câu không có số nhưng chứa "không" / "năm" (không được sinh ra số), cách nói
+bỏ "không trăm" ("hai nghìn lẻ năm"), mã đơn có số 0 đứng đầu ("đơn số 0012").
+MUST_MATCH là các câu cố định phải đúng tuyệt đối (sai → exit code 1).
+
+Chạy:
+    python benchmarks/bench_vi_number_parser.py --phrases 200000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.vi_number_parser import VietnameseNumberParser  # noqa: E402
+
+_DIGITS = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
+_SCALES = [(1_000_000_000, "tỷ"), (1_000_000, "triệu"), (1_000, "nghìn")]
+
+
+def _read_hundreds(n: int, full: bool) -> list:
+    """Đọc số < 1000; full=True thì đọc cả 'không trăm', 'linh'."""
+    words = []
+    h, rest = divmod(n, 100)
+    t, u = divmod(rest, 10)
+    if h or full:
+        words += [_DIGITS[h], "trăm"]
+    if t == 0:
+        if u and (h or full):
+            words.append("linh")
+    elif t == 1:
+        words.append("mười")
+    else:
+        words += [_DIGITS[t], "mươi"]
+    if u:
+        if u == 1 and t >= 2:
+            words.append("mốt")
+        elif u == 5 and t >= 1:
+            words.append("lăm")
+        else:
+            words.append(_DIGITS[u])
+    return words
+
+
+def number_to_words(n: int) -> str:
+    """Đọc số nguyên dương bằng tiếng Việt chuẩn."""
+    if n == 0:
+        return "không"
+    words = []
+    started = False
+    for scale, name in _SCALES:
+        if n >= scale:
+            q, n = divmod(n, scale)
+            words += _read_hundreds(q, started)
+            words.append(name)
+            started = True
+    if n:
+        words += _read_hundreds(n, started)
+    return " ".join(words)
+
+
+_UNITS = ["cái", "chiếc", "hộp", "chai", "gói", "bộ"]
+_PRODUCTS = ["điện thoại", "laptop", "tai nghe", "sữa", "cà phê", "áo"]
+_NO_NUMBER = [
+    "bạn có bán {p} không",
+    "năm nay {p} có mẫu mới không",
+    "{p} này còn hàng không",
+    "tôi không muốn mua {p} nữa",
+]
+_ORDER_PREFIX = ["đơn số", "đơn hàng số", "mã đơn", "mã số"]
+_ZERO_WORDS = ["lẻ", "linh"]
+_SHORT_SCALES = [(1_000, "nghìn"), (1_000, "ngàn"), (1_000_000, "triệu")]
+
+# (câu, entity mong đợi) — phải khớp 100%
+MUST_MATCH = [
+    ("giá hai nghìn lẻ năm đồng", {"amount": 2005}),
+    ("giá một nghìn lẻ năm", {"amount": 1005}),
+    ("hết hai nghìn linh tám đồng", {"amount": 2008}),
+    ("giá một triệu lẻ năm nghìn", {"amount": 1_005_000}),
+    ("giá một nghìn không trăm lẻ năm đồng", {"amount": 1005}),
+    ("cho tôi một trăm lẻ năm cái", {"quantity": 105}),
+    ("kiểm tra đơn số 0012", {"order_id": "0012"}),
+    ("mã đơn 0007", {"order_id": "0007"}),
+    ("đơn số bảy", {"order_id": "7"}),
+    ("tôi muốn đặt đơn hàng hai cái", {"quantity": 2, "order_id": None}),
+    ("năm nay có mẫu mới không", {"numbers": None}),
+]
+
+
+def make_phrase(rng: random.Random):
+    """
+    Trả về (câu, entity mong đợi). Key có giá trị None = không được xuất hiện
+    (vd: câu "đặt đơn hàng hai cái" không được sinh order_id).
+    """
+    kind = rng.randrange(8)
+    product = rng.choice(_PRODUCTS)
+    if kind == 0:
+        q = rng.randint(1, 99)
+        unit = rng.choice(_UNITS)
+        return (f"cho tôi {number_to_words(q)} {unit} {product}",
+                {"quantity": q, "order_id": None})
+    if kind == 1:
+        amount = rng.randint(1, 999) * rng.choice([1_000, 10_000, 100_000, 1_000_000])
+        suffix = rng.choice(["đồng", "", "thôi"])
+        return (f"giá {number_to_words(amount)} {suffix}".strip(), {"amount": amount})
+    if kind == 2:
+        order = rng.randint(1, 9999)
+        return (f"kiểm tra giúp tôi {rng.choice(_ORDER_PREFIX)} {number_to_words(order)}",
+                {"order_id": str(order), "quantity": None})
+    if kind == 3:
+        q = rng.randint(1, 99)
+        unit = rng.choice(_UNITS)
+        return (f"tôi muốn đặt đơn hàng {number_to_words(q)} {unit} {product}",
+                {"quantity": q, "unit": unit, "order_id": None})
+    if kind == 4:
+        q = rng.randint(2, 99)
+        unit = rng.choice(_UNITS)
+        return (f"cho tôi một đơn hàng {number_to_words(q)} {unit}",
+                {"quantity": q, "unit": unit, "order_id": None})
+    if kind == 6:
+        # "X nghìn/triệu lẻ/linh Y": bỏ "không trăm", Y là hàng đơn vị của nhóm sau scale
+        scale, name = rng.choice(_SHORT_SCALES)
+        x, y = rng.randint(1, 99), rng.randint(1, 9)
+        if scale == 1_000_000 and rng.random() < 0.5:
+            # "một triệu lẻ năm nghìn" = 1.005.000
+            return (f"giá {number_to_words(x)} triệu {rng.choice(_ZERO_WORDS)} {_DIGITS[y]} nghìn",
+                    {"amount": x * 1_000_000 + y * 1_000})
+        return (f"giá {number_to_words(x)} {name} {rng.choice(_ZERO_WORDS)} {_DIGITS[y]} đồng",
+                {"amount": x * scale + y})
+    if kind == 7:
+        code = f"{rng.randint(1, 999):0{rng.randint(4, 6)}d}"
+        return (f"kiểm tra giúp tôi {rng.choice(_ORDER_PREFIX)} {code}", {"order_id": code})
+    return (rng.choice(_NO_NUMBER).format(p=product), {"numbers": None, "quantity": None})
+
+
+def _matches(got: dict, expected: dict) -> bool:
+    return all(got.get(key) == value for key, value in expected.items())
+
+
+def run(n_phrases: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    phrases = [make_phrase(rng) for _ in range(n_phrases)]
+    parser = VietnameseNumberParser()
+
+    # warm-up
+    for text, _ in phrases[:1000]:
+        parser.extract_entities(text)
+
+    correct = 0
+    t0 = time.perf_counter()
+    for text, expected in phrases:
+        got = parser.extract_entities(text)
+        if _matches(got, expected):
+            correct += 1
+    elapsed = time.perf_counter() - t0
+
+    must_match_failures = [
+        {"text": text, "expected": expected, "got": got}
+        for text, expected in MUST_MATCH
+        if not _matches(got := parser.extract_entities(text), expected)
+    ]
+
+    return {
+        "phrases": n_phrases,
+        "seconds": round(elapsed, 4),
+        "phrases_per_sec": round(n_phrases / elapsed, 1),
+        "us_per_phrase": round(elapsed / n_phrases * 1e6, 2),
+        "accuracy": round(correct / n_phrases, 4),
+        "must_match": len(MUST_MATCH),
+        "must_match_failures": must_match_failures,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--phrases", type=int, default=200_000)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+    result = run(args.phrases, args.seed)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result["must_match_failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
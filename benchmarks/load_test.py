@@ -0,0 +1,416 @@
+# benchmarks/load_test.py
+"""
+Load test end-to-end: N client aiortc thật gọi /offer của backend đang chạy,
+phát lượt nói (WAV thu sẵn hoặc tín hiệu giả giọng nói) theo thời gian thực
+trên audio track, gửi stop_recording rồi chờ text_response_partial /
+end_of_session — đúng như trình duyệt.
+
+Mỗi lượt đo (từ lúc gửi stop_recording):
+  - partial_ms     : tới text_response_partial (ASR + NLU + DM xong)
+  - first_audio_ms : tới frame giọng bot đầu tiên không im lặng (track) /
+                     tts_audio_chunk đầu tiên (BOT_AUDIO_TRANSPORT=datachannel)
+  - end_ms         : tới end_of_session
+Mỗi phiên: thời gian /offer → DataChannel mở, phiên bị từ chối (503), lỗi /
+timeout. Báo cáo phiên/giây, p50/p95/p99, CPU / RSS của load generator và
+của server (--server-pid, đọc /proc — chỉ Linux).
+
+Server nên chạy ở chế độ stub (không Whisper / Silero / gTTS, không cần mạng):
+    VOICE_STUB_MODE=1 RTC_PROFILE=lan uvicorn backend_webrtc_server:app --port 8000
+
+--procs > 1: chia phiên cho nhiều process con (1 process Python không đủ CPU
+cho vài trăm peer aiortc), gộp kết quả thô ở process cha.
+
+Chạy:
+    python benchmarks/load_test.py --sessions 20 --concurrency 10 --turns 2
+    python benchmarks/load_test.py --sessions 200 --concurrency 80 --procs 4 --server-pid $(pgrep -f uvicorn)
+    python benchmarks/load_test.py --wav-dir samples/ --sessions 10
+"""
+import argparse
+import array
+import asyncio
+import glob
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription  # noqa: E402
+from aiortc.mediastreams import MediaStreamError  # noqa: E402
+
+from ai_modules.bot_audio_track import BotAudioTrack  # noqa: E402
+from bench_common import percentile  # noqa: E402
+from bench_ingest_cpu import synth_speechlike  # noqa: E402
+
+SAMPLE_RATE = 16000
+# Biên độ tối đa của frame nhận về để coi là có giọng bot (Opus giải mã im lặng ≠ 0 tuyệt đối)
+VOICE_PEAK_THRESHOLD = 500
+
+
+def _dist(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50), 1),
+        "p95_ms": round(percentile(values, 0.95), 1),
+        "p99_ms": round(percentile(values, 0.99), 1),
+        "max_ms": round(max(values), 1) if values else 0.0,
+    }
+
+
+# ============================================================
+# LƯỢT NÓI (WAV / GIẢ LẬP)
+# ============================================================
+def load_wav_dir(path: str) -> list:
+    """Mọi *.wav trong thư mục → PCM16 mono 16kHz (PyAV resample)."""
+    import av
+
+    utterances = []
+    for file_path in sorted(glob.glob(os.path.join(path, "*.wav"))):
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+        pcm = bytearray()
+        with av.open(file_path) as container:
+            for frame in container.decode(audio=0):
+                for out in resampler.resample(frame):
+                    pcm += bytes(out.planes[0])[:out.samples * 2]
+            for out in resampler.resample(None):
+                pcm += bytes(out.planes[0])[:out.samples * 2]
+        if pcm:
+            utterances.append(bytes(pcm))
+    if not utterances:
+        raise SystemExit(f"Không có file .wav nào trong {path}")
+    return utterances
+
+
+def synthetic_utterances(count: int, min_sec: float, max_sec: float) -> list:
+    rng = random.Random(11)
+    return [
+        synth_speechlike(rng.uniform(min_sec, max_sec), SAMPLE_RATE, seed=i).tobytes()
+        for i in range(count)
+    ]
+
+
+# ============================================================
+# 1 PHIÊN CLIENT
+# ============================================================
+def _post_json(url: str, payload: dict, timeout: float):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+class TurnProbe:
+    __slots__ = ("stop_at", "partial_at", "first_audio_at", "end_at", "server_timings", "done")
+
+    def __init__(self):
+        self.stop_at = None
+        self.partial_at = None
+        self.first_audio_at = None
+        self.end_at = None
+        self.server_timings = {}
+        self.done = asyncio.Event()
+
+    def result(self) -> dict:
+        def since(t):
+            return round((t - self.stop_at) * 1000, 1) if t is not None and self.stop_at is not None else None
+        return {
+            "partial_ms": since(self.partial_at),
+            "first_audio_ms": since(self.first_audio_at),
+            "end_ms": since(self.end_at),
+            "server_ttfa_ms": self.server_timings.get("ttfa_ms"),
+            "server_total_ms": self.server_timings.get("total_ms"),
+        }
+
+
+async def _watch_bot_audio(track, state: dict):
+    """Đọc track giọng bot (bắt buộc, không đọc thì aiortc giữ frame trong hàng đợi)."""
+    while True:
+        try:
+            frame = await track.recv()
+        except MediaStreamError:
+            return
+        probe = state.get("turn")
+        if probe is None or probe.stop_at is None or probe.first_audio_at is not None:
+            continue
+        samples = array.array("h", bytes(frame.planes[0])[:frame.samples * len(frame.layout.channels) * 2])
+        if samples and max(max(samples), -min(samples)) >= VOICE_PEAK_THRESHOLD:
+            probe.first_audio_at = time.perf_counter()
+
+
+async def run_session(args, utterances: list, rng: random.Random) -> dict:
+    session_id = f"load-{uuid.uuid4().hex[:12]}"
+    result = {"session_id": session_id, "outcome": "ok", "setup_ms": None, "turns": []}
+    state = {"turn": None}
+    opened = asyncio.Event()
+    tasks = []
+
+    pc = RTCPeerConnection(RTCConfiguration(iceServers=[]))
+    # "Micro" của client: push PCM → frame 20ms theo thời gian thực, hết thì phát im lặng
+    mic = BotAudioTrack(sample_rate=SAMPLE_RATE, log_callback=lambda *a, **k: None)
+    spoken = asyncio.Event()
+    mic.on_playback_end(spoken.set)
+    pc.addTrack(mic)
+    channel = pc.createDataChannel("control")
+
+    @channel.on("open")
+    def on_open():
+        opened.set()
+
+    @channel.on("message")
+    def on_message(message):
+        if not isinstance(message, str):
+            return
+        data = json.loads(message)
+        probe = state["turn"]
+        if probe is None:
+            return
+        now = time.perf_counter()
+        kind = data.get("type")
+        if kind == "text_response_partial" and probe.partial_at is None:
+            probe.partial_at = now
+        elif kind == "tts_audio_chunk" and probe.first_audio_at is None and probe.stop_at is not None:
+            probe.first_audio_at = now
+        elif kind == "end_of_session":
+            probe.end_at = now
+            probe.server_timings = data.get("timings") or {}
+            probe.done.set()
+        elif kind == "error":
+            probe.done.set()
+
+    @pc.on("track")
+    def on_track(track):
+        if track.kind == "audio":
+            tasks.append(asyncio.ensure_future(_watch_bot_audio(track, state)))
+
+    started = time.perf_counter()
+    try:
+        await pc.setLocalDescription(await pc.createOffer())
+        status, answer = await asyncio.to_thread(_post_json, f"{args.url}/offer", {
+            "sdp": pc.localDescription.sdp,
+            "type": pc.localDescription.type,
+            "session_id": session_id,
+            "segmentation": "manual",
+            "profile": args.profile,
+        }, args.timeout)
+        if status == 503:
+            result["outcome"] = "rejected"
+            return result
+        if status != 200 or not answer:
+            result["outcome"] = f"http_{status}"
+            return result
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        await asyncio.wait_for(opened.wait(), args.timeout)
+        result["setup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        for turn in range(args.turns):
+            probe = state["turn"] = TurnProbe()
+            if turn > 0:
+                channel.send(json.dumps({"type": "start_utterance"}))
+            spoken.clear()
+            mic.push(rng.choice(utterances))
+            await asyncio.wait_for(spoken.wait(), args.timeout)
+            probe.stop_at = time.perf_counter()
+            channel.send(json.dumps({"type": "stop_recording"}))
+            try:
+                await asyncio.wait_for(probe.done.wait(), args.timeout)
+            except asyncio.TimeoutError:
+                result["outcome"] = "timeout"
+            result["turns"].append(probe.result())
+            if result["outcome"] != "ok":
+                break
+            if probe.end_at is None:
+                result["outcome"] = "error"
+                break
+            await asyncio.sleep(args.think_time)
+
+        channel.send(json.dumps({"type": "hangup"}))
+    except asyncio.TimeoutError:
+        result["outcome"] = "timeout"
+    except Exception as e:
+        result["outcome"] = f"error:{type(e).__name__}"
+    finally:
+        for task in tasks:
+            task.cancel()
+        await pc.close()
+    return result
+
+
+# ============================================================
+# CPU / RSS
+# ============================================================
+class ProcSampler:
+    """CPU% / RSS của 1 process qua /proc/<pid> (Linux), lấy mẫu mỗi interval giây."""
+
+    def __init__(self, pid: int, interval: float = 1.0):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_pct = []
+        self.rss_mb = []
+        self._ticks = os.sysconf("SC_CLK_TCK")
+
+    def _read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_sec = (int(fields[11]) + int(fields[12])) / self._ticks
+        with open(f"/proc/{self.pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        return cpu_sec, rss_kb / 1024
+
+    async def run(self):
+        last_cpu, _ = self._read()
+        last_t = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.interval)
+            cpu, rss = self._read()
+            now = time.perf_counter()
+            self.cpu_pct.append(100 * (cpu - last_cpu) / (now - last_t))
+            self.rss_mb.append(rss)
+            last_cpu, last_t = cpu, now
+
+    def summary(self) -> dict:
+        if not self.cpu_pct:
+            return {}
+        return {
+            "cpu_pct_avg": round(sum(self.cpu_pct) / len(self.cpu_pct), 1),
+            "cpu_pct_max": round(max(self.cpu_pct), 1),
+            "rss_mb_max": round(max(self.rss_mb), 1),
+            "rss_mb_last": round(self.rss_mb[-1], 1),
+        }
+
+
+def _self_usage() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_sec": round(usage.ru_utime + usage.ru_stime, 2), "rss_mb_max": round(usage.ru_maxrss / 1024, 1)}
+
+
+# ============================================================
+# CHẠY TẢI
+# ============================================================
+async def run_load(args) -> dict:
+    """Chạy args.sessions phiên, tối đa args.concurrency phiên cùng lúc → kết quả thô."""
+    utterances = (load_wav_dir(args.wav_dir) if args.wav_dir
+                  else synthetic_utterances(args.variants, args.min_sec, args.max_sec))
+    rng = random.Random(args.seed)
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def one(index: int):
+        async with gate:
+            if args.rate > 0:
+                # Phiên mới đến theo nhịp cố định (open loop), không dồn cùng lúc
+                await asyncio.sleep(max(0.0, index / args.rate - (time.perf_counter() - started)))
+            return await run_session(args, utterances, random.Random(rng.random()))
+
+    started = time.perf_counter()
+    sessions = await asyncio.gather(*(one(i) for i in range(args.sessions)))
+    return {"wall_sec": time.perf_counter() - started, "sessions": sessions, "usage": _self_usage()}
+
+
+def _run_children(args) -> dict:
+    """Chia phiên cho args.procs process con (--raw), gộp kết quả thô."""
+    per_proc = [args.sessions // args.procs + (1 if i < args.sessions % args.procs else 0)
+                for i in range(args.procs)]
+    concurrency = max(1, -(-args.concurrency // args.procs))
+    base = [a for a in sys.argv[1:] if a not in ("--raw",)]
+    children = []
+    for i, n in enumerate(per_proc):
+        if n == 0:
+            continue
+        cmd = [sys.executable, os.path.abspath(__file__), *base, "--procs", "1", "--raw",
+               "--sessions", str(n), "--concurrency", str(concurrency), "--seed", str(args.seed + i),
+               "--rate", str(args.rate / args.procs)]
+        children.append(subprocess.Popen(cmd, stdout=subprocess.PIPE))
+    started = time.perf_counter()
+    merged = {"sessions": [], "usage": {"cpu_sec": 0.0, "rss_mb_max": 0.0}}
+    for child in children:
+        out, _ = child.communicate()
+        raw = json.loads(out)
+        merged["sessions"].extend(raw["sessions"])
+        merged["usage"]["cpu_sec"] = round(merged["usage"]["cpu_sec"] + raw["usage"]["cpu_sec"], 2)
+        merged["usage"]["rss_mb_max"] = max(merged["usage"]["rss_mb_max"], raw["usage"]["rss_mb_max"])
+    merged["wall_sec"] = time.perf_counter() - started
+    return merged
+
+
+def build_report(args, raw: dict, server: dict) -> dict:
+    sessions = raw["sessions"]
+    outcomes = {}
+    for s in sessions:
+        outcomes[s["outcome"]] = outcomes.get(s["outcome"], 0) + 1
+    turns = [t for s in sessions for t in s["turns"]]
+
+    def col(key):
+        return [t[key] for t in turns if t.get(key) is not None]
+
+    ok = outcomes.get("ok", 0)
+    wall = raw["wall_sec"]
+    end_p95 = percentile(col("end_ms"), 0.95)
+    return {
+        "url": args.url,
+        "sessions": len(sessions),
+        "concurrency": args.concurrency,
+        "procs": args.procs,
+        "turns_per_session": args.turns,
+        "wall_sec": round(wall, 2),
+        "outcomes": outcomes,
+        "sessions_per_sec": round(ok / wall, 2) if wall else 0.0,
+        "turns_per_sec": round(len(col("end_ms")) / wall, 2) if wall else 0.0,
+        "setup": _dist([s["setup_ms"] for s in sessions if s["setup_ms"] is not None]),
+        "turn_latency": {
+            "partial": _dist(col("partial_ms")),
+            "first_audio": _dist(col("first_audio_ms")),
+            "end": _dist(col("end_ms")),
+            "server_ttfa": _dist(col("server_ttfa_ms")),
+        },
+        "slo": {"end_p95_ms": args.slo_ms, "met": bool(turns) and end_p95 <= args.slo_ms},
+        "load_generator": raw["usage"],
+        "server": server,
+    }
+
+
+async def main(args) -> dict:
+    sampler = ProcSampler(args.server_pid) if args.server_pid else None
+    sampler_task = asyncio.ensure_future(sampler.run()) if sampler else None
+    try:
+        if args.procs > 1:
+            raw = await asyncio.to_thread(_run_children, args)
+        else:
+            raw = await run_load(args)
+    finally:
+        if sampler_task:
+            sampler_task.cancel()
+    if args.raw:
+        return raw
+    return build_report(args, raw, sampler.summary() if sampler else {})
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--sessions", type=int, default=10, help="tổng số phiên")
+    ap.add_argument("--concurrency", type=int, default=10, help="số phiên chạy đồng thời tối đa")
+    ap.add_argument("--rate", type=float, default=0.0, help="phiên mới / giây (0 = mở ngay khi có chỗ)")
+    ap.add_argument("--turns", type=int, default=1, help="số lượt nói mỗi phiên")
+    ap.add_argument("--think-time", type=float, default=0.5, help="giây chờ giữa 2 lượt")
+    ap.add_argument("--wav-dir", default="", help="thư mục WAV thu sẵn (mặc định: tín hiệu giả)")
+    ap.add_argument("--variants", type=int, default=5, help="số lượt nói giả khác nhau")
+    ap.add_argument("--min-sec", type=float, default=1.5)
+    ap.add_argument("--max-sec", type=float, default=3.0)
+    ap.add_argument("--profile", default="lan", help="profile kết nối gửi kèm /offer")
+    ap.add_argument("--timeout", type=float, default=60.0, help="timeout mỗi bước (giây)")
+    ap.add_argument("--slo-ms", type=float, default=3000.0, help="SLO cho p95 end_ms")
+    ap.add_argument("--procs", type=int, default=1, help="số process con chạy client")
+    ap.add_argument("--server-pid", type=int, default=0, help="PID server để đo CPU / RSS")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--raw", action="store_true", help=argparse.SUPPRESS)
+    print(json.dumps(asyncio.run(main(ap.parse_args())), indent=2, ensure_ascii=False))
@@ -0,0 +1,74 @@
+# core/audio_store.py
+"""
+Kho audio trong bộ nhớ cho câu trả lời của bot (thay cho temp/*_output.wav).
+
+TTS ghép PCM → WAV bytes ngay trong RAM, endpoint /audio_files/{name} phục
+vụ thẳng từ đây. Bị chặn theo tổng bytes (LRU) và TTL để client kịp tải
+lại / nghe lại nhưng không giữ mãi.
+"""
+import io
+import os
+import threading
+import time
+import wave
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+AUDIO_STORE_MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+AUDIO_STORE_TTL_SEC = float(os.getenv("AUDIO_STORE_TTL_SEC", "600"))
+
+
+def pcm_to_wav_bytes(chunks: Iterable[bytes], wav_params: tuple) -> bytes:
+    """Ghép các mảnh PCM thành file WAV hoàn chỉnh trong bộ nhớ."""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setparams(wav_params)
+        for chunk in chunks:
+            wf.writeframes(chunk)
+    return buf.getvalue()
+
+
+class AudioStore:
+    """LRU theo bytes + TTL, thread-safe."""
+
+    def __init__(self, max_bytes: int = AUDIO_STORE_MAX_BYTES, ttl: float = AUDIO_STORE_TTL_SEC):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()   # name → (expires_at, data)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, name: str, data: bytes):
+        with self._lock:
+            self._pop_locked(name)
+            self._items[name] = (time.monotonic() + self.ttl, data)
+            self._bytes += len(data)
+            self._evict_locked()
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(name)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._pop_locked(name)
+                return None
+            self._items.move_to_end(name)
+            return item[1]
+
+    def _pop_locked(self, name: str):
+        item = self._items.pop(name, None)
+        if item is not None:
+            self._bytes -= len(item[1])
+
+    def _evict_locked(self):
+        now = time.monotonic()
+        while self._items:
+            name, (expires_at, _) = next(iter(self._items.items()))
+            if self._bytes <= self.max_bytes and expires_at >= now:
+                break
+            self._pop_locked(name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"items": len(self._items), "bytes": self._bytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,143 @@
+# core/cancellation.py
+"""
+Cancellation token hợp tác (cooperative) cho một lượt hội thoại.
+
+Không huỷ task từ bên ngoài (Whisper / gTTS chạy trong thread không dừng
+giữa chừng được): bên yêu cầu gọi cancel(), các stage tự kiểm tra token
+ở điểm an toàn (giữa các stage, giữa các câu TTS) và dừng bằng TurnCancelled.
+
+Việc blocking gửi lên executor qua run_cancellable(): job chưa bắt đầu bị rút
+khỏi hàng đợi executor ngay khi token bị huỷ; job đang chạy tự kiểm tra
+token ở các checkpoint (giữa các chunk VAD, trước Whisper, giữa các câu TTS).
+CANCELLATION_STATS đếm số lượt / job bị bỏ và CPU-giây ước tính tiết kiệm.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class TurnCancelled(Exception):
+    """Lượt hội thoại bị huỷ (barge-in, phiên đóng...)."""
+
+    def __init__(self, stage: str = "", saved_ms: float = 0.0, reason: str = ""):
+        super().__init__(f"turn cancelled at '{stage}' ({reason})")
+        self.stage = stage
+        self.saved_ms = saved_ms
+        self.reason = reason
+
+
+class CancellationToken:
+    __slots__ = ("reason", "cancelled_at", "_callbacks")
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+        self._callbacks: List[Callable[["CancellationToken"], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_at is not None
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """Đánh dấu huỷ (chỉ lần đầu có hiệu lực) và gọi các callback đã đăng ký."""
+        if self.cancelled_at is not None:
+            return False
+        self.reason = reason
+        self.cancelled_at = time.perf_counter()
+        callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            cb(self)
+        return True
+
+    def on_cancel(self, callback: Callable[["CancellationToken"], None]):
+        if self.cancelled:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def raise_if_cancelled(self, stage: str = "", saved_ms: float = 0.0):
+        if self.cancelled:
+            raise TurnCancelled(stage, saved_ms, self.reason or "")
+
+
+class CancellationStats:
+    """Thống kê huỷ lượt dùng chung toàn process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_stage: Dict[str, Dict[str, float]] = {}
+        self.by_reason: Dict[str, int] = {}
+        self.dropped_jobs = 0
+        self.saved_cpu_sec = 0.0
+
+    def record_turn(self, stage: str, reason: str, saved_ms: float):
+        """Lượt bị huỷ tại stage; saved_ms = thời gian xử lý ước tính không phải chạy."""
+        with self._lock:
+            entry = self._stage_entry(stage)
+            entry["cancelled"] += 1
+            entry["saved_cpu_sec"] += saved_ms / 1000
+            self.by_reason[reason] = self.by_reason.get(reason, 0) + 1
+            self.saved_cpu_sec += saved_ms / 1000
+
+    def record_dropped_job(self, stage: str):
+        """Job blocking bị rút khỏi hàng đợi executor trước khi chạy."""
+        with self._lock:
+            self._stage_entry(stage)["dropped_jobs"] += 1
+            self.dropped_jobs += 1
+
+    def _stage_entry(self, stage: str) -> Dict[str, float]:
+        return self.by_stage.setdefault(stage, {"cancelled": 0, "dropped_jobs": 0, "saved_cpu_sec": 0.0})
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cancelled_turns": sum(int(e["cancelled"]) for e in self.by_stage.values()),
+                "dropped_executor_jobs": self.dropped_jobs,
+                "saved_cpu_sec_total": round(self.saved_cpu_sec, 3),
+                "by_reason": dict(self.by_reason),
+                "by_stage": {
+                    name: {
+                        "cancelled": int(e["cancelled"]),
+                        "dropped_jobs": int(e["dropped_jobs"]),
+                        "saved_cpu_sec": round(e["saved_cpu_sec"], 3),
+                    }
+                    for name, e in self.by_stage.items()
+                },
+            }
+
+
+CANCELLATION_STATS = CancellationStats()
+
+
+async def run_cancellable(executor, token: Optional[CancellationToken], fn: Callable, *args,
+                          stage: str = "", expected_ms: float = 0.0,
+                          stats: CancellationStats = CANCELLATION_STATS):
+    """
+    Chạy fn(*args) trên executor, gắn với token của lượt.
+
+    Token bị huỷ khi job còn chờ trong hàng đợi executor → job bị rút ra
+    (không tốn CPU) và caller nhận TurnCancelled với saved_ms = expected_ms
+    (thời gian xử lý trung bình của job, do caller ước tính). Job đã chạy thì
+    chạy tiếp; fn muốn dừng sớm phải tự kiểm tra token.
+    """
+    loop = asyncio.get_running_loop()
+    if token is None or executor is None:
+        return await loop.run_in_executor(executor, functools.partial(fn, *args))
+    token.raise_if_cancelled(stage, expected_ms)
+
+    job = executor.submit(fn, *args)
+
+    def drop(_token):
+        if job.cancel():
+            stats.record_dropped_job(stage)
+
+    token.on_cancel(drop)
+    try:
+        return await asyncio.wrap_future(job)
+    except (asyncio.CancelledError, concurrent.futures.CancelledError):
+        if job.cancelled() and token.cancelled:
+            raise TurnCancelled(stage, expected_ms, token.reason or "")
+        raise
@@ -7,6 +7,8 @@ import uuid # <-- BỔ SUNG: Dùng để tạo ID định danh cho Log
 from typing import List, Dict, Any, Optional, Callable, Literal
 from abc import ABC, abstractmethod
 
+from core.metrics import timed_step
+
 # --- Cấu hình API và Xác thực (Dành cho Real Impl.) ---
 CRM_API_BASE_URL = "https://api.external-crm.com/v1"
 
@@ -110,6 +112,11 @@ class SystemIntegrationManager:
     #  THÊM QUERY_DATA ĐỂ TƯƠNG THÍCH VỚI DIALOGMANAGER
     # ============================================================
     def query_data(self, intent: str, entities: Dict[str, Any]):
+        """query_data có đo thời gian (metrics step db_query, label model = MOCK/REAL)."""
+        with timed_step("db_query", model=self.mode.lower()):
+            return self._query_data(intent, entities)
+
+    def _query_data(self, intent: str, entities: Dict[str, Any]):
         """
         Chuẩn hóa interface cho DialogManager.
         Tự động chọn hàm query phù hợp theo intent.
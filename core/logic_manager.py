@@ -2,14 +2,23 @@
 # (Replace your existing logic_manager.py with this version)
 
 import json
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from core.json_loader import JSONLogLoader
 from core.stt_log_parser import STTLogParser
 from core.intent_whitelist import IntentWhitelist
 from ai_modules.response_generator import ResponseGenerator
+from core.session_store import DialogSession
 
 PAYMENT_PAGE_PATH = "/static/qr_payment_demo.html"
+PAYMENT_OPENED_TEXT = "Hệ thống đã mở trang thanh toán."
+
+# Trạng thái hội thoại của phiên sau mỗi quyết định (action → DialogSession.state);
+# action không có trong bảng (fallback, error) giữ nguyên trạng thái cũ
+ACTION_STATES = {
+    "normal": "IN_DIALOG",
+    "payment": "PAYMENT",
+}
 
 class LogicManager:
 
@@ -22,9 +31,10 @@ class LogicManager:
         db_mode: str = "MOCK",
         api_key: str = None
     ):
-        self.api_key = api_key
+        # LogicManager dùng chung cho mọi phiên → không giữ state hội thoại hay
+        # api_key: state nằm trong DialogSession truyền vào mỗi lần gọi,
+        # api_key chỉ dùng để khởi tạo ResponseGenerator.
         self.log = log_callback
-        self.state = "idle"
         self.response_config = response_config or {}
 
         self.json_loader = JSONLogLoader(log_callback=self.log)
@@ -45,7 +55,23 @@ class LogicManager:
     # ==========================================================
     # Xử lý JSON từ NLU
     # ==========================================================
-    def handle_nlu_result(self, nlu_json: Dict[str, Any]) -> Dict[str, Any]:
+    def handle_nlu_result(self, nlu_json: Dict[str, Any],
+                          session: Optional[DialogSession] = None) -> Dict[str, Any]:
+        """
+        Quyết định action cho lượt. Có session → cập nhật session.state theo
+        action; không có (speculative prefetch) → chỉ trả quyết định, không đổi phiên.
+        """
+        decision = self._decide(nlu_json)
+        if session is not None:
+            self.update_session(session, decision)
+        return decision
+
+    @staticmethod
+    def update_session(session: DialogSession, decision: Dict[str, Any]):
+        """Áp quyết định (kể cả quyết định speculative đã HIT) lên trạng thái phiên."""
+        session.state = ACTION_STATES.get((decision or {}).get("action"), session.state)
+
+    def _decide(self, nlu_json: Dict[str, Any]) -> Dict[str, Any]:
 
         text = nlu_json.get("text", "")
         intent = nlu_json.get("intent", "no_match")
@@ -67,7 +93,7 @@ class LogicManager:
             return {
                 "action": "payment",
                 "intent": "order_product",
-                "bot_text": "Hệ thống đã mở trang thanh toán.",
+                "bot_text": PAYMENT_OPENED_TEXT,
                 "payment_url": PAYMENT_PAGE_PATH,
                 "entities": entities,
                 "db_result": db_result
@@ -114,7 +140,8 @@ class LogicManager:
     # ==========================================================
     # API tương thích cho DialogManager (DM gọi decide_action)
     # ==========================================================
-    def decide_action(self, intent: str, entities: Dict[str, Any]):
+    def decide_action(self, intent: str, entities: Dict[str, Any],
+                      session: Optional[DialogSession] = None):
         """
         Hàm adapter để LogicManager tương thích với DialogManager.
         Dựa vào intent + entities để quyết định action,
@@ -128,7 +155,7 @@ class LogicManager:
                 "entities": entities,
                 "db_result": {}
             }
-            return self.handle_nlu_result(nlu_json)
+            return self.handle_nlu_result(nlu_json, session)
 
         except Exception as e:
             self.log(f"[LogicManager] decide_action error: {e}", "red")
@@ -0,0 +1,226 @@
+# core/loop_monitor.py
+"""
+Đo độ trễ lập lịch của event loop và tìm code chặn loop.
+
+- Heartbeat: coroutine ngủ LOOP_MONITOR_INTERVAL_MS, lag = thức dậy muộn bao
+  nhiêu → histogram event_loop_lag_ms (core/metrics). Loop bị chặn = mọi
+  phiên aiortc ngừng nhận/gửi gói, DataChannel đứng, pipeline đứng.
+- Watchdog (thread riêng): heartbeat trễ quá LOOP_STALL_THRESHOLD_MS → lấy
+  stack hiện tại của thread chạy loop (sys._current_frames) ngay lúc loop
+  còn đang bị chặn. Khi loop chạy lại, thời gian stall được cộng vào call
+  site: frame sâu nhất thuộc code của dự án (không phải stdlib / site-packages).
+- snapshot(): lag p50/p95/p99, các call site chặn lâu nhất kèm stack mẫu
+  → GET /debug/loop
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional
+
+from core.metrics import REGISTRY
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "1") == "1"
+LOOP_MONITOR_INTERVAL_MS = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "50"))
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+LOOP_MONITOR_MAX_SITES = int(os.getenv("LOOP_MONITOR_MAX_SITES", "100"))
+LOOP_MONITOR_STACK_DEPTH = int(os.getenv("LOOP_MONITOR_STACK_DEPTH", "25"))
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_LIB_MARKERS = ("site-packages", "dist-packages", os.path.dirname(os.__file__))
+
+LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_ms", "Độ trễ lập lịch của event loop (heartbeat thức dậy muộn, ms).",
+    buckets=(1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+LOOP_STALLS = REGISTRY.counter(
+    "event_loop_stalls_total", "Số lần event loop bị chặn quá ngưỡng, theo call site.", ["site"])
+
+
+def _is_project_file(filename: str) -> bool:
+    return filename.startswith(_PROJECT_ROOT) and not any(m in filename for m in _LIB_MARKERS)
+
+
+def _call_site(frame) -> Dict[str, Any]:
+    """(site = frame sâu nhất trong code dự án, blocking_call = frame sâu nhất, stack rút gọn)."""
+    stack = traceback.extract_stack(frame, limit=LOOP_MONITOR_STACK_DEPTH)
+    site = blocking = None
+    for entry in reversed(stack):
+        if blocking is None:
+            blocking = entry
+        if _is_project_file(entry.filename):
+            site = entry
+            break
+    site = site or blocking
+
+    def fmt(entry) -> str:
+        path = os.path.relpath(entry.filename, _PROJECT_ROOT) if _is_project_file(entry.filename) else entry.filename
+        return f"{path}:{entry.lineno} {entry.name}"
+
+    return {
+        "site": fmt(site) if site else "unknown",
+        "blocking_call": fmt(blocking) if blocking else "unknown",
+        "stack": [f"{fmt(e)} | {(e.line or '').strip()}" for e in stack],
+    }
+
+
+class _Stall:
+    __slots__ = ("started", "site", "blocking_call", "stack")
+
+    def __init__(self, started: float, info: Dict[str, Any]):
+        self.started = started
+        self.site = info["site"]
+        self.blocking_call = info["blocking_call"]
+        self.stack = info["stack"]
+
+
+class LoopMonitor:
+
+    def __init__(self, interval_ms: float = LOOP_MONITOR_INTERVAL_MS,
+                 stall_threshold_ms: float = LOOP_STALL_THRESHOLD_MS,
+                 max_sites: int = LOOP_MONITOR_MAX_SITES,
+                 log_callback: Callable = print):
+        self.interval = interval_ms / 1000
+        self.stall_threshold_ms = stall_threshold_ms
+        self.max_sites = max_sites
+        self._log = log_callback
+
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._expected_tick = 0.0
+        self._stall: Optional[_Stall] = None
+
+        self.ticks = 0
+        self.max_lag_ms = 0.0
+        self.stalls = 0
+        self.stalled_ms_total = 0.0
+        self.sites: Dict[str, Dict[str, Any]] = {}
+
+    # ========================================================
+    # KHỞI ĐỘNG / DỪNG
+    # ========================================================
+    def start(self):
+        """Gọi trong event loop (startup của FastAPI)."""
+        if self._task is not None and not self._task.done():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._expected_tick = time.perf_counter() + self.interval
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        self._log(
+            f"[Loop] 🩺 Theo dõi event loop: heartbeat {self.interval * 1000:.0f}ms, "
+            f"ngưỡng stall {self.stall_threshold_ms:.0f}ms"
+        )
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # ========================================================
+    # HEARTBEAT (TRONG LOOP) + WATCHDOG (THREAD RIÊNG)
+    # ========================================================
+    async def _heartbeat(self):
+        while True:
+            self._expected_tick = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (time.perf_counter() - self._expected_tick) * 1000)
+            LOOP_LAG.observe(lag_ms)
+            with self._lock:
+                self.ticks += 1
+                if lag_ms > self.max_lag_ms:
+                    self.max_lag_ms = lag_ms
+                stall, self._stall = self._stall, None
+            if stall is not None:
+                self._record_stall(stall, lag_ms)
+            elif lag_ms >= self.stall_threshold_ms:
+                # Watchdog chưa kịp bắt stack (stall ngắn sát ngưỡng) → vẫn đếm, không có call site
+                self._record_stall(_Stall(0.0, {"site": "unknown", "blocking_call": "unknown", "stack": []}), lag_ms)
+
+    def _watch(self):
+        check = max(0.005, self.stall_threshold_ms / 4000)
+        while not self._stop.wait(check):
+            overdue_ms = (time.perf_counter() - self._expected_tick) * 1000
+            if overdue_ms < self.stall_threshold_ms:
+                continue
+            with self._lock:
+                if self._stall is not None:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stall = _Stall(time.perf_counter(), _call_site(frame))
+            del frame
+            with self._lock:
+                if self._stall is None:
+                    self._stall = stall
+
+    def _record_stall(self, stall: _Stall, lag_ms: float):
+        LOOP_STALLS.inc(site=stall.site)
+        with self._lock:
+            self.stalls += 1
+            self.stalled_ms_total += lag_ms
+            entry = self.sites.get(stall.site)
+            if entry is None:
+                if len(self.sites) >= self.max_sites:
+                    # Bỏ site nhẹ nhất để giữ bộ nhớ có giới hạn
+                    lightest = min(self.sites, key=lambda k: self.sites[k]["total_ms"])
+                    del self.sites[lightest]
+                entry = self.sites[stall.site] = {
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "blocking_call": stall.blocking_call, "stack": stall.stack,
+                }
+            entry["count"] += 1
+            entry["total_ms"] += lag_ms
+            if lag_ms >= entry["max_ms"]:
+                entry["max_ms"] = lag_ms
+                entry["blocking_call"] = stall.blocking_call
+                entry["stack"] = stall.stack
+        self._log(f"[Loop] ⚠️ Event loop bị chặn {lag_ms:.0f}ms tại {stall.site} ({stall.blocking_call})")
+
+    # ========================================================
+    # THỐNG KÊ
+    # ========================================================
+    def snapshot(self, top: int = 20, include_stacks: bool = True) -> Dict[str, Any]:
+        lag = LOOP_LAG.summary()
+        with self._lock:
+            ranked = sorted(self.sites.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)[:top]
+            offenders = []
+            for site, e in ranked:
+                item = {
+                    "site": site,
+                    "count": e["count"],
+                    "total_ms": round(e["total_ms"], 1),
+                    "max_ms": round(e["max_ms"], 1),
+                    "avg_ms": round(e["total_ms"] / e["count"], 1),
+                    "blocking_call": e["blocking_call"],
+                }
+                if include_stacks:
+                    item["stack"] = list(e["stack"])
+                offenders.append(item)
+            return {
+                "running": self._task is not None and not self._task.done(),
+                "interval_ms": self.interval * 1000,
+                "stall_threshold_ms": self.stall_threshold_ms,
+                "ticks": self.ticks,
+                "lag": lag[0] if lag else {},
+                "max_lag_ms": round(self.max_lag_ms, 1),
+                "stalls": self.stalls,
+                "stalled_ms_total": round(self.stalled_ms_total, 1),
+                "offenders": offenders,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.sites.clear()
+            self.stalls = 0
+            self.stalled_ms_total = 0.0
+            self.max_lag_ms = 0.0
@@ -0,0 +1,316 @@
+# core/metrics.py
+"""
+Metrics dạng Prometheus, không cần prometheus_client.
+
+- Counter / Gauge / Histogram có label, thread-safe (gọi được từ executor)
+- Histogram bucket cố định (ms): observe = bisect + cộng dưới lock, không giữ mẫu
+  → p50/p95/p99 ước tính bằng nội suy trong bucket (summary()), Prometheus tự
+  tính bằng histogram_quantile() từ /metrics
+- CallbackMetric: giá trị đọc lúc scrape (độ sâu hàng đợi, số phiên...) từ các
+  stats sẵn có, không phải cập nhật ở đường nóng
+- REGISTRY.render() → text exposition format 0.0.4 cho GET /metrics
+
+Đo một bước: `with timed_step("vad", model="silero"): ...` hoặc
+observe_step("db_query", ms, model="mock").
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from core.cancellation import TurnCancelled
+from core.tracing import TRACER
+
+# Bucket mặc định (ms) cho độ trễ: 1ms → 60s
+DEFAULT_LATENCY_BUCKETS_MS = tuple(
+    float(b) for b in os.getenv(
+        "METRICS_LATENCY_BUCKETS_MS",
+        "1,2.5,5,10,25,50,100,250,500,1000,2500,5000,10000,30000,60000",
+    ).split(",")
+)
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "voice_")
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Percentile mẫu (nearest-rank) của values; rỗng → 0."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items
+        ]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "total", "count", "min", "max")
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * (n_buckets + 1)     # bucket cuối = +Inf
+        self.total = 0.0
+        self.count = 0
+        # Kẹp quantile ước tính trong [min, max] thật (bucket thưa → nội suy lệch)
+        self.min = float("inf")
+        self.max = 0.0
+
+    def copy(self) -> "_HistogramSeries":
+        other = _HistogramSeries(0)
+        other.counts, other.total, other.count = list(self.counts), self.total, self.count
+        other.min, other.max = self.min, self.max
+        return other
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS_MS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self.buckets))
+            series.counts[idx] += 1
+            series.total += value
+            series.count += 1
+            if value < series.min:
+                series.min = value
+            if value > series.max:
+                series.max = value
+
+    def _quantile(self, series: _HistogramSeries, q: float) -> float:
+        """Nội suy tuyến tính trong bucket chứa hạng q (như histogram_quantile)."""
+        if series.count == 0:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        estimate = series.max
+        for i, n in enumerate(series.counts):
+            if seen + n >= rank and n > 0:
+                if i < len(self.buckets):       # bucket +Inf → dùng max thật
+                    lower = self.buckets[i - 1] if i > 0 else 0.0
+                    estimate = lower + (self.buckets[i] - lower) * (rank - seen) / n
+                break
+            seen += n
+        return min(max(estimate, series.min), series.max)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = [(k, s.copy()) for k, s in self._series.items()]
+        return [{
+            "labels": dict(zip(self.labelnames, key)),
+            "count": series.count,
+            "avg_ms": round(series.total / series.count, 2) if series.count else 0.0,
+            "p50_ms": round(self._quantile(series, 0.50), 2),
+            "p95_ms": round(self._quantile(series, 0.95), 2),
+            "p99_ms": round(self._quantile(series, 0.99), 2),
+            "max_ms": round(series.max, 2),
+        } for key, series in items]
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(k, s.count, s.total, list(s.counts)) for k, s in self._series.items()]
+        lines = self._header()
+        for key, count, total, counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Giá trị đọc lúc scrape: fn() → [(label values, value), ...] hoặc 1 số."""
+
+    def __init__(self, name, documentation, labelnames=(), fn: Callable = None,
+                 type_name: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.type_name = type_name
+        self._fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            result = self._fn()
+        except Exception:
+            return []
+        if isinstance(result, (int, float)):
+            result = [((), result)]
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labelnames, [str(v) for v in key])} {_format_value(value)}"
+            for key, value in result
+        ]
+
+
+class MetricsRegistry:
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(self.prefix + name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS_MS) -> Histogram:
+        return self._register(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, fn: Callable,
+                 labelnames: Sequence[str] = (), type_name: str = "gauge") -> CallbackMetric:
+        return self._register(CallbackMetric(self.prefix + name, documentation, labelnames, fn, type_name))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        """p50/p95/p99 của mọi histogram (JSON cho dashboard / debug)."""
+        with self._lock:
+            histograms = [m for m in self._metrics.values() if isinstance(m, Histogram)]
+        return {h.name: h.summary() for h in histograms}
+
+
+REGISTRY = MetricsRegistry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ============================================================
+# METRICS DÙNG CHUNG CỦA VOICE PIPELINE
+# ============================================================
+STAGE_LATENCY = REGISTRY.histogram(
+    "pipeline_stage_duration_ms", "Thời gian xử lý mỗi stage VoicePipeline (ms).", ["stage", "mode"])
+STAGE_QUEUE_WAIT = REGISTRY.histogram(
+    "pipeline_stage_queue_wait_ms", "Thời gian chờ trong hàng đợi stage (ms).", ["stage", "mode"])
+TURN_LATENCY = REGISTRY.histogram(
+    "turn_duration_ms", "Tổng thời gian 1 lượt qua pipeline (ms).", ["mode", "outcome"])
+STEP_LATENCY = REGISTRY.histogram(
+    "step_duration_ms",
+    "Thời gian từng bước (recorder_flush, vad, asr, nlu_parse, dm_nlu, logic, db_query, "
+    "response_gen, tts_synth, response_log) theo model / mode (ms).",
+    ["step", "model", "mode"])
+STEP_ERRORS = REGISTRY.counter("step_errors_total", "Số lỗi theo bước.", ["step", "model"])
+
+
+def observe_step(step: str, elapsed_ms: float, model: str = "", mode: str = ""):
+    STEP_LATENCY.observe(elapsed_ms, step=step, model=model, mode=mode)
+    # Đang trong 1 lượt (core/tracing context) → bước cũng thành span trên timeline phiên
+    now = time.perf_counter()
+    TRACER.add_current(step, now - elapsed_ms / 1000, now, cat="step", model=model, mode=mode)
+
+
+@contextmanager
+def timed_step(step: str, model: str = "", mode: str = ""):
+    """Đo 1 bước; exception vẫn được ghi thời gian + đếm lỗi rồi raise lại (huỷ lượt không tính lỗi)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except TurnCancelled:
+        raise
+    except Exception:
+        STEP_ERRORS.inc(step=step, model=model)
+        raise
+    finally:
+        observe_step(step, (time.perf_counter() - started) * 1000, model, mode)
+
+
+def timed_call(step: str, fn: Callable, *args, model: str = "", mode: str = ""):
+    """Gọi fn(*args) trong timed_step (dùng được làm job cho executor)."""
+    with timed_step(step, model, mode):
+        return fn(*args)
@@ -3,6 +3,8 @@ from typing import Dict, Any, Optional, Callable
 from abc import ABC, abstractmethod
 import google.generativeai as genai
 
+from core.vi_number_parser import extract_number_entities
+
 
 # ========================================================
 # Interface chung
@@ -103,4 +105,14 @@ class NLUModule:
         )
 
     def get_intent(self, text: str, context=None):
-        return self.client.get_intent(text, context)
+        result = self.client.get_intent(text, context)
+
+        # Bổ sung entity số trích cục bộ (LLM trả về thì ưu tiên LLM)
+        local_entities = extract_number_entities(text)
+        if local_entities:
+            entities = result.get("entities") or {}
+            for key, value in local_entities.items():
+                entities.setdefault(key, value)
+            result["entities"] = entities
+
+        return result
@@ -0,0 +1,255 @@
+# core/profiler.py
+"""
+Profile theo yêu cầu khi node chạy production (không attach được py-spy / gdb).
+
+- SamplingProfiler: trong thời gian giới hạn, đọc sys._current_frames() mỗi
+  PROFILE_SAMPLE_INTERVAL_MS → stack của MỌI thread (event loop, worker
+  to_thread / executor chạy Whisper, VAD, TTS...). Kết quả dạng collapsed
+  stacks ("thread;f1;f2 count") — đưa thẳng vào flamegraph.pl / speedscope.
+  Chỉ chạy trong thread của request profile → không profile = không tốn gì.
+- MemoryTracker: bật tracemalloc khi cần, lấy snapshot nền rồi so sánh các
+  snapshot sau với nền (compare_to) → dòng code cấp phát tăng nhiều nhất.
+  Tắt (stop) → tracemalloc dừng hẳn, không còn overhead.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_MAX_DURATION_SEC = float(os.getenv("PROFILE_MAX_DURATION_SEC", "60"))
+PROFILE_MAX_DEPTH = int(os.getenv("PROFILE_MAX_DEPTH", "64"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Frame lá = thread đang ngủ chờ việc (selector của loop, worker executor chờ queue...)
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("socketserver.py", "serve_forever"),
+}
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def _short_path(filename: str) -> str:
+    if filename.startswith(_PROJECT_ROOT):
+        return os.path.relpath(filename, _PROJECT_ROOT)
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep):
+        idx = filename.find(marker)
+        if idx >= 0:
+            return filename[idx + len(marker):]
+    return os.path.basename(filename)
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS,
+                 max_duration: float = PROFILE_MAX_DURATION_SEC):
+        self.interval = interval_ms / 1000
+        self.max_duration = max_duration
+        self._running = threading.Lock()
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    @property
+    def busy(self) -> bool:
+        return self._running.locked()
+
+    def profile(self, duration: float, include_idle: bool = False,
+                thread_filter: str = "") -> Dict[str, Any]:
+        """
+        Lấy mẫu trong `duration` giây (blocking — gọi qua asyncio.to_thread).
+        Mỗi lần chỉ 1 profile; đang chạy → ProfilerBusy.
+        """
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy("Đang có profile khác chạy.")
+        try:
+            return self._run(min(max(duration, 0.1), self.max_duration), include_idle, thread_filter)
+        finally:
+            self._running.release()
+
+    def _run(self, duration: float, include_idle: bool, thread_filter: str) -> Dict[str, Any]:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        per_thread: Counter = Counter()
+        idle = 0
+        rounds = 0
+        code_cache: Dict[Any, str] = {}
+        names: Dict[int, str] = {}
+
+        started = time.perf_counter()
+        deadline = started + duration
+        sampling_time = 0.0
+        while True:
+            tick = time.perf_counter()
+            if tick >= deadline:
+                break
+            if rounds % 50 == 0:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            rounds += 1
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                thread_name = names.get(ident, f"thread-{ident}")
+                if thread_filter and thread_filter not in thread_name:
+                    continue
+                leaf = frame.f_code
+                if not include_idle and (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES:
+                    idle += 1
+                    continue
+                parts: List[str] = []
+                depth = 0
+                while frame is not None and depth < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    label = code_cache.get(code)
+                    if label is None:
+                        label = code_cache[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+                    parts.append(label)
+                    frame = frame.f_back
+                    depth += 1
+                parts.append(thread_name)
+                stacks[";".join(reversed(parts))] += 1
+                per_thread[thread_name] += 1
+            del frames
+            sampling_time += time.perf_counter() - tick
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - tick)))
+
+        elapsed = time.perf_counter() - started
+        result = {
+            "duration_sec": round(elapsed, 3),
+            "interval_ms": self.interval * 1000,
+            "rounds": rounds,
+            "samples": sum(stacks.values()),
+            "idle_samples_skipped": idle,
+            # Thời gian profiler tự tốn cho việc lấy mẫu (giữ GIL) / tổng thời gian
+            "overhead_pct": round(100 * sampling_time / elapsed, 2) if elapsed else 0.0,
+            "threads": dict(per_thread.most_common()),
+            "stacks": stacks,
+        }
+        self.last_run = {k: v for k, v in result.items() if k != "stacks"}
+        self.last_run["finished_at"] = round(time.time(), 3)
+        return result
+
+    @staticmethod
+    def collapsed(result: Dict[str, Any]) -> str:
+        """Định dạng collapsed stacks (flamegraph.pl, speedscope, inferno)."""
+        return "\n".join(f"{stack} {n}" for stack, n in result["stacks"].most_common()) + "\n"
+
+    @staticmethod
+    def top_functions(result: Dict[str, Any], top: int = 30) -> List[Dict[str, Any]]:
+        """Self time (frame lá) và total time (có mặt trong stack) theo hàm."""
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, n in result["stacks"].items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            self_counts[frames[-1]] += n
+            for fn in set(frames):
+                total_counts[fn] += n
+        samples = result["samples"] or 1
+        return [{
+            "function": fn,
+            "self_samples": self_counts[fn],
+            "self_pct": round(100 * self_counts[fn] / samples, 1),
+            "total_pct": round(100 * total_counts[fn] / samples, 1),
+        } for fn, _ in self_counts.most_common(top)]
+
+
+class MemoryTracker:
+
+    def __init__(self, frames: int = TRACEMALLOC_FRAMES):
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_at: Optional[float] = None
+        self._owned = False
+
+    @staticmethod
+    def _take() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def start(self, frames: Optional[int] = None) -> Dict[str, Any]:
+        """Bật tracemalloc (nếu chưa) + lấy snapshot nền. Chỉ cấp phát SAU lúc này mới được theo dõi."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames or self.frames)
+                self._owned = True
+            self._baseline = self._take()
+            self._baseline_at = time.time()
+            return self.status_locked()
+
+    def stop(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._owned and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self._owned = False
+            self._baseline = None
+            self._baseline_at = None
+            return self.status_locked()
+
+    def status_locked(self) -> Dict[str, Any]:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else 0,
+            "traced_current_mb": round(current / 2**20, 2),
+            "traced_peak_mb": round(peak / 2**20, 2),
+            "tracemalloc_overhead_mb": round(tracemalloc.get_tracemalloc_memory() / 2**20, 2) if tracing else 0.0,
+            "baseline_at": self._baseline_at,
+        }
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return self.status_locked()
+
+    def diff(self, top: int = 30, group_by: str = "lineno", rebase: bool = False) -> Dict[str, Any]:
+        """
+        So snapshot hiện tại với nền: dòng / file / traceback có bộ nhớ tăng nhiều nhất.
+        rebase=True → snapshot này thành nền mới (theo dõi tăng trưởng theo từng khoảng).
+        """
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise ValueError("group_by phải là lineno / filename / traceback")
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise RuntimeError("tracemalloc chưa bật — gọi start trước.")
+            snapshot = self._take()
+            stats = snapshot.compare_to(self._baseline, group_by)
+            since = self._baseline_at
+            if rebase:
+                self._baseline = snapshot
+                self._baseline_at = time.time()
+            status = self.status_locked()
+
+        def where(stat) -> Any:
+            frames = [f"{_short_path(f.filename)}:{f.lineno}" for f in stat.traceback]
+            return frames if group_by == "traceback" else frames[0]
+
+        return {
+            **status,
+            "since": since,
+            "group_by": group_by,
+            "total_diff_mb": round(sum(s.size_diff for s in stats) / 2**20, 3),
+            "top": [{
+                "where": where(s),
+                "size_diff_kb": round(s.size_diff / 1024, 1),
+                "size_kb": round(s.size / 1024, 1),
+                "count_diff": s.count_diff,
+                "count": s.count,
+            } for s in stats[:top]],
+        }
@@ -0,0 +1,193 @@
+# core/session_store.py
+"""
+Session store cho trạng thái hội thoại theo từng phiên.
+
+Thay cho việc giữ state / scenario / api_key trên DialogManager và
+LogicManager dùng chung toàn process (các phiên đồng thời ghi đè lẫn nhau).
+Mỗi phiên là một record __slots__ gọn nhẹ; store là LRU có:
+  - idle TTL: phiên không hoạt động quá SESSION_IDLE_TTL_SEC bị xoá
+  - giới hạn số phiên (SESSION_MAX) và tổng bộ nhớ ước tính (SESSION_MAX_BYTES),
+    kiểm tra cả khi tạo phiên lẫn khi history của phiên lớn lên (add_turn)
+"""
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Optional
+
+SESSION_IDLE_TTL_SEC = float(os.getenv("SESSION_IDLE_TTL_SEC", "900"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+SESSION_HISTORY_LIMIT = int(os.getenv("SESSION_HISTORY_LIMIT", "10"))
+
+INITIAL_STATE = "START"
+
+# Kích thước cố định ước tính của 1 record (object + deque rỗng)
+_BASE_SESSION_BYTES = 512
+
+
+def _turn_bytes(turn: Dict[str, str]) -> int:
+    return sys.getsizeof(turn) + sum(sys.getsizeof(v) for v in turn.values())
+
+
+class DialogSession:
+    """Trạng thái hội thoại của một phiên (không chứa object nặng)."""
+    __slots__ = (
+        "session_id", "api_key", "state", "scenario", "step_index",
+        "history", "created_at", "last_access", "size_bytes", "_store",
+    )
+
+    def __init__(self, session_id: str, api_key: Optional[str] = None,
+                 history_limit: int = SESSION_HISTORY_LIMIT):
+        now = time.monotonic()
+        self.session_id = session_id
+        self.api_key = api_key
+        self.state = INITIAL_STATE
+        self.scenario = None
+        self.step_index = 0
+        self.history = deque(maxlen=max(1, history_limit))
+        self.created_at = now
+        self.last_access = now
+        self.size_bytes = _BASE_SESSION_BYTES
+        self._store: Optional["SessionStore"] = None
+
+    def add_turn(self, user_text: str, bot_text: str):
+        """Thêm 1 lượt vào history (bị chặn độ dài), cập nhật size_bytes và báo store."""
+        turn = {"user": user_text or "", "bot": bot_text or ""}
+        delta = _turn_bytes(turn)
+        if len(self.history) == self.history.maxlen:
+            delta -= _turn_bytes(self.history[0])
+        self.history.append(turn)
+        self.size_bytes += delta
+        if self._store is not None:
+            self._store.on_session_resized(self, delta)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "state": self.state,
+            "scenario": self.scenario,
+            "step_index": self.step_index,
+            "history_len": len(self.history),
+            "size_bytes": self.size_bytes,
+            "idle_sec": round(time.monotonic() - self.last_access, 1),
+        }
+
+
+class SessionStore:
+    """LRU store các DialogSession, thread-safe."""
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL_SEC, max_sessions: int = SESSION_MAX,
+                 max_bytes: int = SESSION_MAX_BYTES, history_limit: int = SESSION_HISTORY_LIMIT,
+                 log_callback: Callable = print):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.history_limit = history_limit
+        self._log = log_callback
+        self._sessions: "OrderedDict[str, DialogSession]" = OrderedDict()
+        self._total_bytes = 0
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    # ========================================================
+    # TRUY CẬP
+    # ========================================================
+    def get_or_create(self, session_id: str, api_key: Optional[str] = None) -> DialogSession:
+        with self._lock:
+            self._evict_expired_locked()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = DialogSession(session_id, api_key, self.history_limit)
+                session._store = self
+                self._sessions[session_id] = session
+                self._total_bytes += session.size_bytes
+                self._enforce_caps_locked(keep=session_id)
+            else:
+                self._sessions.move_to_end(session_id)
+                if api_key:
+                    session.api_key = api_key
+            session.last_access = time.monotonic()
+            return session
+
+    def get(self, session_id: str) -> Optional[DialogSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_access = time.monotonic()
+            return session
+
+    def remove(self, session_id: str) -> bool:
+        with self._lock:
+            return self._pop_locked(session_id) is not None
+
+    def on_session_resized(self, session: DialogSession, delta: int):
+        """DialogSession.add_turn gọi sau khi history đổi kích thước → áp lại giới hạn bytes."""
+        with self._lock:
+            # Phiên đã bị xoá khỏi store (lượt còn chạy dở) → không tính
+            if self._sessions.get(session.session_id) is not session:
+                return
+            self._total_bytes += delta
+            if delta > 0:
+                self._enforce_caps_locked(keep=session.session_id)
+
+    def _pop_locked(self, session_id: str) -> Optional[DialogSession]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._total_bytes -= session.size_bytes
+            session._store = None
+        return session
+
+    # ========================================================
+    # EVICTION
+    # ========================================================
+    def evict_expired(self) -> int:
+        with self._lock:
+            return self._evict_expired_locked()
+
+    def _evict_expired_locked(self) -> int:
+        # OrderedDict xếp theo lần truy cập → chỉ cần duyệt từ đầu
+        deadline = time.monotonic() - self.idle_ttl
+        removed = 0
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_access > deadline:
+                break
+            self._pop_locked(session.session_id)
+            removed += 1
+        if removed:
+            self._evicted += removed
+            self._log(f"[SessionStore] 🧹 Xoá {removed} phiên hết hạn (idle > {self.idle_ttl:.0f}s)")
+        return removed
+
+    def _enforce_caps_locked(self, keep: Optional[str] = None):
+        # Tổng bytes được cộng dồn khi tạo / xoá phiên và khi add_turn → O(1) mỗi lần kiểm tra
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or self._total_bytes > self.max_bytes
+        ):
+            sid = next(iter(self._sessions))
+            if sid == keep:
+                self._sessions.move_to_end(sid)
+                continue
+            self._pop_locked(sid)
+            self._evicted += 1
+            self._log(f"[SessionStore] ⚠️ Vượt giới hạn → xoá phiên LRU {sid}")
+
+    # ========================================================
+    # THỐNG KÊ
+    # ========================================================
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "total_bytes": self._total_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "idle_ttl_sec": self.idle_ttl,
+                "evicted_total": self._evicted,
+            }
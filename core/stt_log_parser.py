@@ -1,6 +1,8 @@
 # core/stt_log_parser.py
 from typing import Dict, Any
 
+from core.vi_number_parser import extract_number_entities
+
 
 class STTLogParser:
     """
@@ -53,9 +55,14 @@ class STTLogParser:
 
         detected_intent = "no_match"   # default, chờ module NLU thật
 
+        # Entity số (số lượng / số tiền / mã đơn) trích cục bộ, không cần LLM
+        entities = extract_number_entities(user_text)
+        if entities:
+            self.log(f"[Parser] Entity số: {entities}", "cyan")
+
         return {
             "text": user_text,
             "intent": detected_intent,
-            "entities": {},
+            "entities": entities,
             "db_result": {}
         }
@@ -0,0 +1,239 @@
+# core/tracing.py
+"""
+Timeline theo phiên: span của từng lượt, xuất Chrome trace-event JSON
+(mở bằng Perfetto / chrome://tracing) tại /debug/trace/{session_id}.
+
+- Mỗi phiên giữ tối đa TRACE_MAX_EVENTS_PER_SESSION sự kiện (ring, sự kiện
+  cũ bị đẩy ra), tối đa TRACE_MAX_SESSIONS phiên gần nhất (kể cả phiên đã
+  đóng) → bộ nhớ có giới hạn
+- Track (tid trong trace): "audio_in" (gói audio gộp thành đợt), "recorder"
+  (lượt nói, ghi WAV), "queue:<stage>" (chờ hàng đợi), "pipeline:<stage>" (xử lý,
+  chờ executor), "thread:<tên>" (VAD, ASR, NLU, DB, TTS chạy trong thread),
+  "tts" (mảnh audio), "datachannel" (message gửi client), "turns"
+- Context (session_id, turn_id) đi theo contextvars: VoicePipeline gắn khi
+  chạy handler, wrap_job() mang sang thread của executor; bước được đo
+  bằng core/metrics.timed_step / observe_step tự thành span
+"""
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_MAX_SESSIONS = int(os.getenv("TRACE_MAX_SESSIONS", "200"))
+TRACE_MAX_EVENTS_PER_SESSION = int(os.getenv("TRACE_MAX_EVENTS_PER_SESSION", "5000"))
+# Gói audio cách nhau ít hơn ngưỡng này được gộp vào cùng 1 span "đợt nhận"
+TRACE_BURST_GAP_MS = float(os.getenv("TRACE_BURST_GAP_MS", "100"))
+
+_turn_ids = itertools.count(1)
+
+
+def next_turn_id() -> int:
+    return next(_turn_ids)
+
+
+class TraceContext:
+    __slots__ = ("session_id", "turn_id")
+
+    def __init__(self, session_id: str, turn_id: Optional[int] = None):
+        self.session_id = session_id
+        self.turn_id = turn_id
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("voice_trace", default=None)
+
+
+def current() -> Optional[TraceContext]:
+    return _current.get()
+
+
+def bind(session_id: str, turn_id: Optional[int] = None):
+    """Gắn context cho task hiện tại (task / to_thread tạo sau đó kế thừa). Trả token cho unbind()."""
+    return _current.set(TraceContext(session_id, turn_id))
+
+
+def unbind(token):
+    _current.reset(token)
+
+
+class TraceEvent:
+    __slots__ = ("ph", "name", "cat", "track", "ts", "dur", "args")
+
+    def __init__(self, ph: str, name: str, cat: str, track: str, ts: float, dur: float = 0.0,
+                 args: Optional[Dict[str, Any]] = None):
+        self.ph = ph              # "X" = span, "i" = sự kiện tức thời
+        self.name = name
+        self.cat = cat
+        self.track = track
+        self.ts = ts              # giây perf_counter
+        self.dur = dur
+        self.args = args
+
+
+class SessionTrace:
+    __slots__ = ("session_id", "events", "bursts", "created_at", "dropped")
+
+    def __init__(self, session_id: str, max_events: int):
+        self.session_id = session_id
+        self.events: deque = deque(maxlen=max_events)
+        self.bursts: Dict[str, TraceEvent] = {}
+        self.created_at = time.time()
+        self.dropped = 0
+
+    def append(self, event: TraceEvent):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+
+
+def _thread_track() -> str:
+    thread = threading.current_thread()
+    return "loop" if thread is threading.main_thread() else f"thread:{thread.name}"
+
+
+class Tracer:
+
+    def __init__(self, max_sessions: int = TRACE_MAX_SESSIONS,
+                 max_events: int = TRACE_MAX_EVENTS_PER_SESSION,
+                 enabled: bool = TRACE_ENABLED):
+        self.max_sessions = max_sessions
+        self.max_events = max_events
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, SessionTrace]" = OrderedDict()
+
+    def _session_locked(self, session_id: str) -> SessionTrace:
+        trace = self._sessions.get(session_id)
+        if trace is None:
+            trace = self._sessions[session_id] = SessionTrace(session_id, self.max_events)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return trace
+
+    # ========================================================
+    # GHI SỰ KIỆN
+    # ========================================================
+    def add(self, session_id: Optional[str], name: str, start: float, end: float,
+            track: Optional[str] = None, cat: str = "", **args):
+        """Span đã kết thúc [start, end] (giây perf_counter)."""
+        if not self.enabled or not session_id:
+            return
+        event = TraceEvent("X", name, cat, track or _thread_track(), start, max(0.0, end - start), args or None)
+        with self._lock:
+            self._session_locked(session_id).append(event)
+
+    def instant(self, session_id: Optional[str], name: str, track: str, cat: str = "", **args):
+        if not self.enabled or not session_id:
+            return
+        event = TraceEvent("i", name, cat, track, time.perf_counter(), 0.0, args or None)
+        with self._lock:
+            self._session_locked(session_id).append(event)
+
+    def burst(self, session_id: Optional[str], name: str, track: str, nbytes: int = 0):
+        """Sự kiện dày (gói audio 20ms): gộp các sự kiện sát nhau thành 1 span, đếm số gói / bytes."""
+        if not self.enabled or not session_id:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            trace = self._session_locked(session_id)
+            event = trace.bursts.get(name)
+            if event is not None and (now - event.ts - event.dur) * 1000 <= TRACE_BURST_GAP_MS:
+                event.dur = now - event.ts
+                event.args["packets"] += 1
+                event.args["bytes"] += nbytes
+                return
+            event = TraceEvent("X", name, "io", track, now, 0.0, {"packets": 1, "bytes": nbytes})
+            trace.bursts[name] = event
+            trace.append(event)
+
+    def add_current(self, name: str, start: float, end: float,
+                    track: Optional[str] = None, cat: str = "", **args):
+        """Span cho context hiện tại (bỏ qua nếu không ở trong lượt nào)."""
+        ctx = _current.get()
+        if ctx is None or not self.enabled:
+            return
+        if ctx.turn_id is not None:
+            args.setdefault("turn", ctx.turn_id)
+        self.add(ctx.session_id, name, start, end, track, cat, **args)
+
+    @contextmanager
+    def span(self, name: str, track: Optional[str] = None, cat: str = "", **args):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_current(name, started, time.perf_counter(), track, cat, **args)
+
+    # ========================================================
+    # XUẤT CHROME TRACE
+    # ========================================================
+    def export_chrome(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            trace = self._sessions.get(session_id)
+            if trace is None:
+                return None
+            events = list(trace.events)
+            dropped = trace.dropped
+
+        tids: Dict[str, int] = {}
+        out: List[Dict[str, Any]] = [
+            {"ph": "M", "name": "process_name", "pid": 1, "tid": 0, "args": {"name": f"session {session_id}"}},
+        ]
+        for e in sorted(events, key=lambda e: e.ts):
+            tid = tids.get(e.track)
+            if tid is None:
+                tid = tids[e.track] = len(tids) + 1
+                out.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": {"name": e.track}})
+                out.append({"ph": "M", "name": "thread_sort_index", "pid": 1, "tid": tid, "args": {"sort_index": tid}})
+            item = {"ph": e.ph, "name": e.name, "cat": e.cat or "voice", "pid": 1, "tid": tid,
+                    "ts": round(e.ts * 1e6, 1)}
+            if e.ph == "X":
+                item["dur"] = round(e.dur * 1e6, 1)
+            else:
+                item["s"] = "t"
+            if e.args:
+                item["args"] = dict(e.args)
+            out.append(item)
+        return {
+            "traceEvents": out,
+            "displayTimeUnit": "ms",
+            "otherData": {"session_id": session_id, "events": len(events), "dropped_events": dropped},
+        }
+
+    def sessions(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"session_id": t.session_id, "events": len(t.events), "dropped_events": t.dropped,
+                 "created_at": round(t.created_at, 3)}
+                for t in reversed(self._sessions.values())
+            ]
+
+
+TRACER = Tracer()
+
+
+def wrap_job(fn: Callable, track: str) -> Callable:
+    """
+    Job cho executor: mang trace context của caller sang thread (run_in_executor /
+    executor.submit không copy contextvars) + span "executor_wait" (chờ thread rảnh).
+    """
+    ctx = _current.get()
+    if ctx is None or not TRACER.enabled:
+        return fn
+    submitted = time.perf_counter()
+
+    def job(*args, **kwargs):
+        token = _current.set(ctx)
+        TRACER.add_current("executor_wait", submitted, time.perf_counter(), track=track, cat="queue")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return job
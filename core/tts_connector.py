@@ -1,33 +1,289 @@
 # D:\STT Project\core\tts_connector.py
 import os
+import re
+import io
+import array
 import asyncio
+import functools
+import math
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+from typing import Iterable, List, Optional, Union
+
+from core.cancellation import CANCELLATION_STATS, CancellationToken
+from core.metrics import observe_step, timed_call
+from core.tracing import wrap_job
+from core.tts_phrase_cache import PhraseCache
 
 # ================================================
-#  TTS Client (MOCK / LOCAL / CLOUD)
+#  TTS Client (MOCK / GTTS / LOCAL / CLOUD / STUB)
 # ================================================
 
+# Sample rate PCM16 mọi engine trả về (= track phát / WAV output của server)
+TTS_SAMPLE_RATE = int(os.getenv("TTS_SAMPLE_RATE", "16000"))
+
+# Câu dài hơn ngưỡng này sẽ được tách tiếp theo dấu phẩy
+TTS_MAX_CHUNK_CHARS = int(os.getenv("TTS_MAX_CHUNK_CHARS", "120"))
+# Mảnh quá ngắn được gộp với mảnh kế tiếp (tránh gọi TTS cho 1-2 từ)
+TTS_MIN_CHUNK_CHARS = int(os.getenv("TTS_MIN_CHUNK_CHARS", "8"))
+
+# LOCAL TTS (Coqui TTS, offline): model / giọng / số worker tổng hợp.
+# Không có mặc định: Coqui không kèm model tiếng Việt → phải chỉ định model
+# đọc được tiếng Việt (checkpoint tự huấn luyện / fine-tune) khi TTS_ENGINE=LOCAL
+TTS_LOCAL_MODEL = os.getenv("TTS_LOCAL_MODEL", "")
+TTS_LOCAL_SPEAKER = os.getenv("TTS_LOCAL_SPEAKER") or None
+TTS_LOCAL_LANGUAGE = os.getenv("TTS_LOCAL_LANGUAGE") or None
+TTS_LOCAL_WORKERS = int(os.getenv("TTS_LOCAL_WORKERS", "2"))
+
+# STUB TTS (load test, không mạng): độ dài audio theo số ký tự, thời gian tổng hợp giả lập
+TTS_STUB_MS_PER_CHAR = float(os.getenv("TTS_STUB_MS_PER_CHAR", "65"))
+TTS_STUB_RTF = float(os.getenv("TTS_STUB_RTF", "0.05"))
+
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…;:])\s+|\n+")
+_CLAUSE_SPLIT_RE = re.compile(r"(?<=,)\s+")
+
+
+def split_sentences(text: str, max_chars: int = TTS_MAX_CHUNK_CHARS,
+                    min_chars: int = TTS_MIN_CHUNK_CHARS) -> list:
+    """
+    Tách câu trả lời thành câu / mệnh đề để tổng hợp TTS theo từng mảnh.
+    Chỉ tách tại dấu câu có khoảng trắng phía sau → "5,000,000" giữ nguyên.
+    """
+    pieces = []
+    for sentence in _SENTENCE_SPLIT_RE.split(text or ""):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) > max_chars:
+            pieces.extend(p.strip() for p in _CLAUSE_SPLIT_RE.split(sentence) if p.strip())
+        else:
+            pieces.append(sentence)
+
+    merged = []
+    carry = ""
+    for piece in pieces:
+        piece = f"{carry} {piece}".strip() if carry else piece
+        if len(piece) < min_chars:
+            carry = piece
+            continue
+        merged.append(piece)
+        carry = ""
+    if carry:
+        if merged:
+            merged[-1] = f"{merged[-1]} {carry}"
+        else:
+            merged.append(carry)
+    return merged
+
+
+def split_segments(text: Union[str, Iterable[str]]) -> List[str]:
+    """
+    Văn bản → danh sách câu TTS. Nhận thêm list segment (mẫu câu cố định +
+    slot): mỗi segment được tách riêng nên phần cố định luôn ra cùng một câu
+    → trùng khoá trong PhraseCache giữa các lượt.
+    """
+    if isinstance(text, str):
+        return split_sentences(text)
+    return [sentence for segment in text for sentence in split_sentences(segment)]
+
+
+def _gtts_to_pcm(text: str, lang: str = "vi") -> bytes:
+    """gTTS → MP3 (bộ nhớ) → PCM16 mono 16kHz (blocking, không ghi file)."""
+    from gtts import gTTS
+
+    mp3_buf = io.BytesIO()
+    gTTS(text, lang=lang).write_to_fp(mp3_buf)
+    return decode_audio_to_pcm(mp3_buf.getvalue())
+
+
+# 1 chu kỳ tone 80 mẫu (200 Hz @16kHz), lặp lại cho audio STUB
+_STUB_PERIOD = array.array(
+    "h", (int(8000 * math.sin(2 * math.pi * i / 80)) for i in range(80))
+).tobytes()
+
+
+def _stub_tts_pcm(text: str) -> bytes:
+    """TTS giả lập: tone PCM16 dài TTS_STUB_MS_PER_CHAR × số ký tự, ngủ TTS_STUB_RTF × độ dài (blocking)."""
+    n_bytes = int(len(text) * TTS_STUB_MS_PER_CHAR / 1000 * TTS_SAMPLE_RATE) * 2
+    time.sleep(n_bytes / 2 / TTS_SAMPLE_RATE * TTS_STUB_RTF)
+    return (_STUB_PERIOD * (n_bytes // len(_STUB_PERIOD) + 1))[:n_bytes]
+
+
+def _float_to_pcm16(wav, src_rate: int, dst_rate: int = TTS_SAMPLE_RATE) -> bytes:
+    """Waveform float [-1, 1] → PCM16 mono ở dst_rate."""
+    import numpy as np
+    from scipy.signal import resample_poly
+
+    audio = np.asarray(wav, dtype=np.float32).reshape(-1)
+    if src_rate != dst_rate:
+        g = gcd(int(src_rate), int(dst_rate))
+        audio = resample_poly(audio, dst_rate // g, src_rate // g)
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+
+
+def decode_audio_to_pcm(data: bytes, dst_rate: int = TTS_SAMPLE_RATE) -> bytes:
+    """
+    Giải mã audio nén (MP3...) ngay trong process bằng PyAV (không spawn
+    ffmpeg như pydub) → downmix mono → resample_poly → PCM16.
+    """
+    import av
+    import numpy as np
+
+    parts = []
+    src_rate = dst_rate
+    with av.open(io.BytesIO(data)) as container:
+        for frame in container.decode(audio=0):
+            src_rate = frame.sample_rate
+            arr = frame.to_ndarray()
+            channels = len(frame.layout.channels)
+            if not frame.format.is_planar:
+                arr = arr.reshape(-1, channels).T      # packed → (channels, samples)
+            if arr.dtype.kind == "i":
+                arr = arr.astype(np.float32) / float(np.iinfo(arr.dtype).max + 1)
+            parts.append(arr.mean(axis=0, dtype=np.float32))
+    if not parts:
+        return b""
+    return _float_to_pcm16(np.concatenate(parts), src_rate, dst_rate)
+
+
+class LocalTTSEngine:
+    """
+    TTS offline với model nạp 1 lần cho mỗi thread worker.
+
+    - Pool bounded (TTS_LOCAL_WORKERS thread), mỗi thread giữ model riêng
+      trong threading.local → không phải khoá model khi tổng hợp song song
+    - synthesize() blocking, trả PCM16 mono ở sample_rate (mặc định TTS_SAMPLE_RATE)
+    - synthesize_async() chạy trên pool riêng, không chặn event loop
+    """
+
+    def __init__(self, model_name: str = TTS_LOCAL_MODEL, speaker: Optional[str] = TTS_LOCAL_SPEAKER,
+                 language: Optional[str] = TTS_LOCAL_LANGUAGE, workers: int = TTS_LOCAL_WORKERS,
+                 sample_rate: int = TTS_SAMPLE_RATE, log_callback=print):
+        if not model_name:
+            raise ValueError("TTS_ENGINE=LOCAL cần TTS_LOCAL_MODEL (model Coqui đọc được tiếng Việt)")
+        self.model_name = model_name
+        self.speaker = speaker
+        self.language = language
+        self.workers = max(1, workers)
+        self.sample_rate = sample_rate
+        self.log = log_callback or (lambda *args, **kwargs: None)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tts-local")
+        self._local = threading.local()
+
+    def _model(self):
+        model = getattr(self._local, "model", None)
+        if model is None:
+            from TTS.api import TTS
+
+            t0 = time.perf_counter()
+            model = TTS(self.model_name, progress_bar=False)
+            self._local.model = model
+            self.log(
+                f"[TTS Local] Nạp model {self.model_name} cho {threading.current_thread().name} "
+                f"({(time.perf_counter() - t0):.1f}s)"
+            )
+        return model
+
+    def synthesize(self, text: str) -> bytes:
+        model = self._model()
+        kwargs = {}
+        if self.speaker:
+            kwargs["speaker"] = self.speaker
+        if self.language:
+            kwargs["language"] = self.language
+        wav = model.tts(text, **kwargs)
+        return _float_to_pcm16(wav, model.synthesizer.output_sample_rate, self.sample_rate)
+
+    async def synthesize_async(self, text: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.synthesize, text)
+
+    async def warmup(self):
+        """Nạp model trên tất cả worker trước khi có lượt hội thoại đầu tiên."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self._model) for _ in range(self.workers)
+        ))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_local_engine: Optional[LocalTTSEngine] = None
+_local_engine_lock = threading.Lock()
+
+
+def get_local_engine(log_callback=print) -> LocalTTSEngine:
+    """LocalTTSEngine dùng chung toàn process (tạo lười, 1 lần)."""
+    global _local_engine
+    with _local_engine_lock:
+        if _local_engine is None:
+            _local_engine = LocalTTSEngine(log_callback=log_callback)
+        return _local_engine
+
+
 class TTSClient:
     """
-    TTSClient dùng cho ResponseGenerator:
+    TTSClient dùng cho ResponseGenerator / VoicePipeline:
       - synthesize_stream(text) → async generator (yield audio bytes)
-      - mode = "MOCK" | "LOCAL" | "CLOUD"
+      - mode = "MOCK" | "GTTS" | "LOCAL" | "CLOUD" | "STUB"
+      - GTTS: tách câu, tổng hợp từng câu (câu sau chạy song song khi câu
+        trước đang được phát) → yield PCM16 mono (TTS_SAMPLE_RATE) theo từng câu
+      - LOCAL: như GTTS nhưng tổng hợp offline trên LocalTTSEngine (model nạp 1 lần)
+      - STUB: như GTTS nhưng câu là tone giả lập (load test, không cần mạng)
+      - phrase_cache: câu đã tổng hợp (GTTS / LOCAL) được lấy lại từ cache,
+        không gọi TTS lần nữa
     """
 
-    def __init__(self, mode: str = "MOCK", api_key=None, log_callback=print):
+    def __init__(self, mode: str = "MOCK", api_key=None, log_callback=print, lang: str = "vi",
+                 local_engine: Optional[LocalTTSEngine] = None,
+                 phrase_cache: Optional[PhraseCache] = None):
         self.mode = (mode or "MOCK").upper()
         self.api_key = api_key
+        self.lang = lang
         self.log = log_callback or (lambda *args, **kwargs: None)
+        self.local_engine = local_engine
+        self.phrase_cache = phrase_cache
+        if self.mode == "LOCAL" and self.local_engine is None:
+            self.local_engine = get_local_engine(self.log)
 
         self.log(f"[TTS] Khởi tạo TTSClient (mode={self.mode}).")
 
         # ----------------------------------------------------
-        # Nếu chưa có API key → fallback hoàn toàn về MOCK
+        # CLOUD cần API key → không có thì fallback về MOCK
         # ----------------------------------------------------
-        if self.mode != "MOCK" and not self.api_key:
+        if self.mode == "CLOUD" and not self.api_key:
             self.log("⚠️ [TTS] Không có API key. Tự động chuyển sang MOCK.", "orange")
             self.mode = "MOCK"
 
+    @property
+    def voice_id(self) -> str:
+        """Định danh giọng cho khoá cache (đổi giọng → không dùng nhầm PCM cũ)."""
+        if self.mode == "LOCAL":
+            e = self.local_engine
+            return f"local:{e.model_name}:{e.speaker}:{e.language}:{e.sample_rate}"
+        return f"{self.mode.lower()}:{self.lang}:{TTS_SAMPLE_RATE}"
+
+    @property
+    def metric_model(self) -> str:
+        """Label "model" cho metrics TTS."""
+        if self.mode == "LOCAL":
+            return f"local:{self.local_engine.model_name}"
+        return self.mode.lower()
+
+    def _sentence_synth(self):
+        """(hàm tổng hợp 1 câu blocking, executor riêng nếu có) theo mode."""
+        if self.mode == "GTTS":
+            return (lambda sentence: _gtts_to_pcm(sentence, self.lang)), None
+        if self.mode == "LOCAL":
+            return self.local_engine.synthesize, self.local_engine.executor
+        if self.mode == "STUB":
+            return _stub_tts_pcm, None
+        return None, None
+
     # ===================================================================
     #  MOCK TTS — tạo audio giả để test pipeline WebRTC
     # ===================================================================
@@ -39,22 +295,106 @@ class TTSClient:
             await asyncio.sleep(0.02)
 
     # ===================================================================
-    #  LOCAL TTS (Silero) — offline
+    #  THEO CÂU — câu kế tiếp được tổng hợp trước 1 bước (GTTS / LOCAL)
+    # ===================================================================
+    async def _sentence_stream(self, text, synth_fn, executor=None,
+                               token: Optional[CancellationToken] = None):
+        """
+        Tổng hợp theo câu, câu kế tiếp chạy trước 1 bước trên executor.
+        token bị huỷ → stream dừng, câu còn chờ executor bị rút ra; câu đang
+        tổng hợp dở vẫn chạy xong và được lưu phrase_cache (CPU đã tốn).
+        """
+        loop = asyncio.get_running_loop()
+        sentences = split_segments(text)
+        if not sentences:
+            return
+        cache = self.phrase_cache
+        voice = self.voice_id
+        model = self.metric_model
+        timed_synth = functools.partial(timed_call, "tts_synth", synth_fn, model=model, mode="synth")
+
+        def store(sentence, fut):
+            if not fut.cancelled() and fut.exception() is None:
+                cache.put(sentence, fut.result(), voice)
+
+        def drop(job, _token):
+            if job.cancel():
+                CANCELLATION_STATS.record_dropped_job("tts")
+
+        def submit(sentence):
+            if cache is not None:
+                pcm = cache.get(sentence, voice)
+                if pcm is not None:
+                    observe_step("tts_synth", 0.0, model=model, mode="cache")
+                    fut = loop.create_future()
+                    fut.set_result(pcm)
+                    return fut
+            if executor is None:
+                job = fut = loop.run_in_executor(None, wrap_job(timed_synth, "tts"), sentence)
+            else:
+                job = executor.submit(wrap_job(timed_synth, "tts"), sentence)
+                fut = asyncio.wrap_future(job)
+                if token is not None:
+                    token.on_cancel(functools.partial(drop, job))
+            if cache is not None:
+                job.add_done_callback(functools.partial(store, sentence))
+            return fut
+
+        if token is not None and token.cancelled:
+            return
+        pending = submit(sentences[0])
+        try:
+            for i in range(len(sentences)):
+                try:
+                    pcm = await pending
+                except asyncio.CancelledError:
+                    if token is not None and token.cancelled:
+                        return      # câu bị rút khỏi executor vì lượt đã huỷ
+                    raise
+                if token is not None and token.cancelled:
+                    return
+                pending = submit(sentences[i + 1]) if i + 1 < len(sentences) else None
+                yield pcm
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def _gtts_stream(self, text, executor=None, token=None):
+        synth_fn, _ = self._sentence_synth()
+        return self._sentence_stream(text, synth_fn, executor, token)
+
+    async def prewarm(self, phrases: Iterable[str], executor=None) -> int:
+        """Tổng hợp sẵn các câu cố định vào phrase_cache. Trả về số câu mới."""
+        synth_fn, own_executor = self._sentence_synth()
+        if self.phrase_cache is None or synth_fn is None:
+            return 0
+        loop = asyncio.get_running_loop()
+        voice = self.voice_id
+        missing = [s for s in dict.fromkeys(split_segments(list(phrases)))
+                   if (s, voice) not in self.phrase_cache]
+
+        async def warm(sentence):
+            try:
+                pcm = await loop.run_in_executor(own_executor or executor, synth_fn, sentence)
+                self.phrase_cache.put(sentence, pcm, voice)
+                return 1
+            except Exception as e:
+                self.log(f"⚠️ [TTS] Không tổng hợp sẵn được '{sentence[:40]}': {e}")
+                return 0
+
+        warmed = sum(await asyncio.gather(*(warm(s) for s in missing)))
+        self.log(f"[TTS] 🔥 Phrase cache: tổng hợp sẵn {warmed}/{len(missing)} câu cố định.")
+        return warmed
+
+    # ===================================================================
+    #  LOCAL TTS (Coqui) — offline, model nạp 1 lần trên pool riêng
     # ===================================================================
-    async def _local_tts_stream(self, text: str):
+    async def _local_tts_stream(self, text, token=None):
+        engine = self.local_engine
         try:
-            import torch
-            import numpy as np
-            from TTS.api import TTS  # nếu bạn chưa cài TTS, để mode MOCK
-
-            model = TTS("tts_models/en/ljspeech/tacotron2-DDC")
-            wav = model.tts(text)
-            audio_bytes = (np.array(wav) * 32767).astype(np.int16).tobytes()
-
-            chunk_size = 16000  
-            for i in range(0, len(audio_bytes), chunk_size):
-                yield audio_bytes[i:i + chunk_size]
-                await asyncio.sleep(0.01)
+            # Luôn dùng pool của engine (mỗi thread đã giữ sẵn model)
+            async for pcm in self._sentence_stream(text, engine.synthesize, engine.executor, token):
+                yield pcm
         except Exception as e:
             self.log(f"❌ [TTS Local] Lỗi: {e}. Fallback về MOCK.")
             async for chunk in self._mock_tts_stream(text):
@@ -69,18 +409,25 @@ class TTSClient:
             yield chunk
 
     # ===================================================================
-    #  API CHÍNH — được gọi từ ResponseGenerator
+    #  API CHÍNH — được gọi từ ResponseGenerator / VoicePipeline
     # ===================================================================
-    async def synthesize_stream(self, text: str):
+    async def synthesize_stream(self, text: Union[str, List[str]], executor=None,
+                                token: Optional[CancellationToken] = None):
         """
         Trả về async generator stream audio theo mode.
+        text: chuỗi, hoặc list segment (mẫu cố định + slot) — xem split_segments.
+        executor: ThreadPoolExecutor cho phần blocking (mặc định của loop nếu None).
+        token: cancellation token của lượt — stream kết thúc sớm khi bị huỷ.
         """
         try:
             if self.mode == "MOCK":
                 return self._mock_tts_stream(text)
 
+            if self.mode in ("GTTS", "STUB"):
+                return self._gtts_stream(text, executor, token)
+
             if self.mode == "LOCAL":
-                return self._local_tts_stream(text)
+                return self._local_tts_stream(text, token)
 
             if self.mode == "CLOUD":
                 return self._cloud_tts_stream(text)
@@ -0,0 +1,87 @@
+# core/tts_phrase_cache.py
+"""
+Cache PCM cho các câu TTS đã tổng hợp (content-addressed).
+
+Khoá = sha1(giọng + câu đã chuẩn hoá khoảng trắng) → cùng một câu với cùng
+một giọng chỉ tổng hợp 1 lần. Dùng cho:
+  - câu cố định (từ chối ngoài chủ đề, không nghe rõ, mở trang thanh toán,
+    tiền tố "Bạn vừa nói:" ...) được tổng hợp sẵn lúc khởi động
+  - câu trả lời lặp lại giữa các phiên
+Bị chặn theo tổng bytes PCM, xoá theo LRU.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_WS_RE = re.compile(r"\s+")
+
+
+def phrase_key(text: str, voice: str = "") -> str:
+    normalized = _WS_RE.sub(" ", text or "").strip()
+    return hashlib.sha1(f"{voice}\x00{normalized}".encode("utf-8")).hexdigest()
+
+
+class PhraseCache:
+    """LRU cache PCM theo bytes, thread-safe."""
+
+    def __init__(self, max_bytes: int = TTS_CACHE_MAX_BYTES, log_callback: Callable = print):
+        self.max_bytes = max_bytes
+        self._log = log_callback
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, text: str, voice: str = "") -> Optional[bytes]:
+        key = phrase_key(text, voice)
+        with self._lock:
+            pcm = self._entries.get(key)
+            if pcm is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pcm
+
+    def put(self, text: str, pcm: bytes, voice: str = ""):
+        if not pcm or len(pcm) > self.max_bytes:
+            return
+        key = phrase_key(text, voice)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = pcm
+            self._bytes += len(pcm)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def __contains__(self, item) -> bool:
+        text, voice = item if isinstance(item, tuple) else (item, "")
+        with self._lock:
+            return phrase_key(text, voice) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,354 @@
+# core/vi_number_parser.py
+"""
+Bộ phân tích số tiếng Việt (finite-state, không gọi LLM).
+
+Chuyển các cụm số đọc bằng lời trong câu nói thành entity nghiệp vụ:
+  - "hai cái"            → {"quantity": 2, "unit": "cái"}
+  - "năm triệu"          → {"amount": 5000000, "currency": "VND"}
+  - "đơn số bảy"         → {"order_id": "7"}, "mã đơn 0012" → {"order_id": "0012"}
+  - "đơn hàng hai cái"   → {"quantity": 2, "unit": "cái"} (lượng từ thắng ngữ cảnh đơn)
+  - "hai triệu tư"       → 2400000, "ba nghìn rưỡi" → 3500, "50k" → 50000
+  - "hai nghìn lẻ năm"   → 2005, "một triệu lẻ năm nghìn" → 1005000
+
+Bảng từ vựng và regex tách token được biên dịch một lần khi import,
+mỗi câu chỉ duyệt token một lượt qua máy trạng thái → vài micro-giây/câu.
+"""
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+# ========================================================
+# BẢNG TỪ VỰNG (biên dịch 1 lần)
+# ========================================================
+# Loại token của máy trạng thái
+_D = 0       # chữ số 0-9
+_TEN = 1     # "mười"
+_TENS = 2    # "mươi", "chục" (nhân 10)
+_ZERO = 3    # "linh", "lẻ" (lấp hàng chục)
+_H = 4       # "trăm"
+_S = 5       # nghìn / triệu / tỷ
+_HALF = 6    # "rưỡi"
+_NUM = 7     # số viết bằng chữ số: "5", "5.000.000", "1,5"
+
+_DIGIT_WORDS = {
+    "không": 0,
+    "một": 1, "mốt": 1,
+    "hai": 2,
+    "ba": 3,
+    "bốn": 4, "tư": 4,
+    "năm": 5, "lăm": 5, "nhăm": 5,
+    "sáu": 6,
+    "bảy": 7, "bẩy": 7,
+    "tám": 8,
+    "chín": 9,
+}
+
+_SCALE_WORDS = {
+    "nghìn": 1_000, "ngàn": 1_000, "k": 1_000,
+    "triệu": 1_000_000, "tr": 1_000_000, "củ": 1_000_000,
+    "tỷ": 1_000_000_000, "tỉ": 1_000_000_000,
+}
+
+_TOKEN_TABLE: Dict[str, Tuple[int, int]] = {}
+for _w, _v in _DIGIT_WORDS.items():
+    _TOKEN_TABLE[_w] = (_D, _v)
+for _w, _v in _SCALE_WORDS.items():
+    _TOKEN_TABLE[_w] = (_S, _v)
+_TOKEN_TABLE.update({
+    "mười": (_TEN, 10),
+    "mươi": (_TENS, 10),
+    "chục": (_TENS, 10),
+    "linh": (_ZERO, 0),
+    "lẻ": (_ZERO, 0),
+    "trăm": (_H, 100),
+    "rưỡi": (_HALF, 0),
+    "rưởi": (_HALF, 0),
+})
+
+# Đơn vị tiền tệ đứng sau số
+CURRENCY_WORDS = frozenset({"đồng", "đ", "vnd", "vnđ", "dong"})
+
+# Từ chỉ đơn vị đếm (lượng từ) đứng sau số → quantity
+QUANTITY_UNITS = frozenset({
+    "cái", "chiếc", "hộp", "chai", "lon", "ly", "cốc", "phần", "suất",
+    "gói", "bộ", "đôi", "con", "quyển", "cuốn", "thùng", "kg", "ký",
+    "cân", "món", "bao", "túi", "tô", "bát", "đĩa", "cặp", "sản",
+})
+
+# Từ ngữ cảnh đứng trước số
+_PRICE_CUES = frozenset({"giá", "tiền", "hết", "khoảng", "tầm", "trả"})
+_ORDER_CUES = frozenset({"đơn", "mã", "order"})
+# Chỉ "số" / "mã" mới nối ngữ cảnh đơn với con số: "đơn số 7", "đơn hàng mã 12".
+# "hàng" / "đơn" đứng ngay trước số không đủ ("đơn hàng hai cái" là số lượng).
+_ORDER_LINKS = frozenset({"số", "mã"})
+
+# Từ vừa là chữ số vừa là từ thường ("không" = phủ định, "năm" = năm/tuổi):
+# đứng một mình chỉ là số khi ngữ cảnh ngay cạnh cho biết đó là số
+_AMBIGUOUS_DIGITS = frozenset({"không", "năm"})
+
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)*|[^\W\d_]+", re.UNICODE)
+_THOUSANDS_RE = re.compile(r"^\d{1,3}(?:([.,])\d{3})(?:\1\d{3})*$")
+
+
+def _parse_numeral(raw: str) -> float:
+    """'5.000.000' / '5,000' → số nguyên; '1,5' / '2.5' → số thực."""
+    if _THOUSANDS_RE.match(raw):
+        return int(raw.replace(".", "").replace(",", ""))
+    if "," in raw or "." in raw:
+        try:
+            return float(raw.replace(",", "."))
+        except ValueError:
+            return int(re.sub(r"\D", "", raw) or 0)
+    return int(raw)
+
+
+class NumberMatch:
+    """Một cụm số tìm được trong câu (vị trí tính theo token)."""
+    __slots__ = ("value", "start", "end", "max_scale")
+
+    def __init__(self, value, start: int, end: int, max_scale: int):
+        self.value = value
+        self.start = start
+        self.end = end              # exclusive
+        self.max_scale = max_scale  # scale lớn nhất xuất hiện (0 nếu không có)
+
+    def __repr__(self):
+        return f"NumberMatch(value={self.value}, tokens=[{self.start}:{self.end}])"
+
+
+class VietnameseNumberParser:
+    """
+    Parser số tiếng Việt dạng máy trạng thái hữu hạn.
+    Không có trạng thái giữa các lần gọi → dùng chung an toàn giữa các thread.
+    """
+
+    # ========================================================
+    # TÁCH TOKEN
+    # ========================================================
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        text = unicodedata.normalize("NFC", text or "").lower()
+        return _TOKEN_RE.findall(text)
+
+    @staticmethod
+    def _classify(token: str) -> Optional[Tuple[int, Any]]:
+        entry = _TOKEN_TABLE.get(token)
+        if entry is not None:
+            return entry
+        if token[0].isdigit():
+            return (_NUM, _parse_numeral(token))
+        return None
+
+    # ========================================================
+    # MÁY TRẠNG THÁI: 1 lượt qua token
+    # ========================================================
+    def parse_numbers(self, text: str) -> List[NumberMatch]:
+        return self._scan(self.tokenize(text))[1]
+
+    def _scan(self, tokens: List[str]) -> Tuple[List[str], List[NumberMatch]]:
+        matches: List[NumberMatch] = []
+        n = len(tokens)
+        i = 0
+        while i < n:
+            cls = self._classify(tokens[i])
+            if cls is None or cls[0] in (_TENS, _ZERO, _HALF):
+                i += 1
+                continue
+            i = self._consume_run(tokens, i, matches)
+        return tokens, matches
+
+    def _consume_run(self, tokens: List[str], start: int, out: List[NumberMatch]) -> int:
+        total = 0          # tổng các nhóm đã đóng bởi scale
+        group = 0          # giá trị nhóm hiện tại (< 1000 nếu đọc bằng lời)
+        cur = None         # chữ số đang chờ (chưa biết hàng)
+        prev = None        # loại token trước
+        last_mag = 1       # độ lớn của đơn vị cuối (trăm/nghìn/...) cho cách nói tắt
+        last_scale = 0
+        max_scale = 0
+        digit_seq = True   # toàn chữ số đơn lẻ → đọc từng số ("một hai ba" = 123)
+        i = start
+        n = len(tokens)
+
+        while i < n:
+            cls = self._classify(tokens[i])
+            if cls is None:
+                break
+            kind, val = cls
+
+            if kind == _D:
+                if prev in (_TEN, _TENS):
+                    group += val
+                    prev = _D
+                    cur = None
+                    last_mag = 1
+                    digit_seq = False
+                    i += 1
+                    # sau hàng đơn vị chỉ còn scale / rưỡi hợp lệ
+                    continue
+                if prev == _D and cur is not None:
+                    if not digit_seq:
+                        break
+                    cur = cur * 10 + val
+                    i += 1
+                    continue
+                if prev == _D and cur is None:
+                    # "hai mươi ba bốn" → dừng cụm tại đây
+                    break
+                cur = val
+
+            elif kind == _NUM:
+                if prev is not None and prev not in (_S,):
+                    break
+                cur = val
+                digit_seq = False
+
+            elif kind == _TEN:
+                if cur is not None or prev in (_TEN, _TENS):
+                    break
+                group += 10
+                last_mag = 10
+                digit_seq = False
+
+            elif kind == _TENS:
+                if prev in (_TEN, _TENS):
+                    break
+                group += (cur if cur is not None else 1) * 10
+                cur = None
+                last_mag = 10
+                digit_seq = False
+
+            elif kind == _ZERO:
+                # "một trăm lẻ năm"; sau scale: "hai nghìn lẻ năm" (trăm, chục của nhóm = 0)
+                if prev not in (_H, _S):
+                    break
+                digit_seq = False
+
+            elif kind == _H:
+                if prev == _H:
+                    break
+                group += (cur if cur is not None else 1) * 100
+                cur = None
+                last_mag = 100
+                digit_seq = False
+
+            elif kind == _S:
+                value = group + (cur or 0)
+                if prev == _S and value == 0:
+                    # "nghìn tỷ": nhân dồn
+                    total = total * val
+                elif last_scale and val > last_scale:
+                    total = (total + value) * val
+                else:
+                    total += (value if (value or prev is not None) else 1) * val
+                group = 0
+                cur = None
+                last_scale = val
+                last_mag = val
+                max_scale = max(max_scale, val)
+                digit_seq = False
+
+            elif kind == _HALF:
+                if prev == _S:
+                    total += last_scale // 2
+                elif prev == _H:
+                    group += 50
+                else:
+                    break
+                digit_seq = False
+
+            prev = kind
+            i += 1
+
+        if prev is None:
+            return start + 1
+        if i - start == 1 and tokens[start] in _AMBIGUOUS_DIGITS and not self._numeric_context(tokens, start):
+            return i
+
+        # Cách nói tắt: "hai triệu tư" = 2.400.000, "một trăm hai" = 120
+        if cur is not None and prev == _D and i - start >= 2:
+            before = self._classify(tokens[i - 2])
+            if before is not None and before[0] in (_S, _H):
+                cur = cur * (last_mag // 10)
+
+        value = total + group + (cur or 0)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        out.append(NumberMatch(value, start, i, max_scale))
+        return i
+
+    @staticmethod
+    def _numeric_context(tokens: List[str], pos: int) -> bool:
+        """Token lẻ tại pos có nằm trong ngữ cảnh số không (lượng từ / tiền phía sau, mã đơn / giá phía trước)."""
+        nxt = tokens[pos + 1] if pos + 1 < len(tokens) else ""
+        prv = tokens[pos - 1] if pos > 0 else ""
+        return (nxt in QUANTITY_UNITS or nxt in CURRENCY_WORDS
+                or prv in _ORDER_LINKS or prv in _PRICE_CUES)
+
+    @staticmethod
+    def _is_order_ref(tokens: List[str], start: int) -> bool:
+        """"đơn số 7", "đơn hàng số 7", "mã 7", "mã số 7", "mã đơn 7", "order số 7"."""
+        prv = tokens[start - 1] if start > 0 else ""
+        prv2 = tokens[start - 2] if start > 1 else ""
+        prv3 = tokens[start - 3] if start > 2 else ""
+        if prv == "đơn":
+            return prv2 == "mã"
+        if prv not in _ORDER_LINKS:
+            return False
+        return (prv == "mã" or prv2 in _ORDER_CUES
+                or (prv2 == "hàng" and prv3 == "đơn"))
+
+    # ========================================================
+    # TRÍCH XUẤT ENTITY NGHIỆP VỤ
+    # ========================================================
+    def extract_entities(self, text: str) -> Dict[str, Any]:
+        """
+        Trả về dict entity (chỉ có các key tìm thấy):
+          quantity, unit, amount, currency, order_id, numbers
+        """
+        tokens, matches = self._scan(self.tokenize(text))
+        if not matches:
+            return {}
+
+        entities: Dict[str, Any] = {"numbers": [m.value for m in matches]}
+
+        for m in matches:
+            nxt = tokens[m.end] if m.end < len(tokens) else ""
+            prv = tokens[m.start - 1] if m.start > 0 else ""
+
+            # --- Số lượng: "hai cái", "3 hộp" (kể cả sau "đơn hàng") ---
+            if nxt in QUANTITY_UNITS:
+                if "quantity" not in entities:
+                    entities["quantity"] = int(m.value)
+                    entities["unit"] = "sản phẩm" if nxt == "sản" else nxt
+                continue
+
+            # --- Mã đơn hàng: "đơn số bảy", "mã đơn 12", "đơn hàng số 3" ---
+            if "order_id" not in entities and self._is_order_ref(tokens, m.start):
+                raw = tokens[m.start]
+                # Mã viết bằng chữ số giữ nguyên ("đơn số 0012" → "0012"), đọc bằng lời → int
+                entities["order_id"] = raw if m.end - m.start == 1 and raw.isdigit() else str(int(m.value))
+                continue
+
+            # --- Số tiền: "năm triệu", "50.000 đồng", "giá 200k" ---
+            if "amount" not in entities and (
+                nxt in CURRENCY_WORDS or m.max_scale >= 1_000 or prv in _PRICE_CUES
+            ):
+                entities["amount"] = int(round(m.value))
+                entities["currency"] = "VND"
+
+        return entities
+
+
+# Instance dùng chung (parser không có state)
+_DEFAULT_PARSER = VietnameseNumberParser()
+
+
+def extract_number_entities(text: str) -> Dict[str, Any]:
+    """Helper cho tầng NLU: trích quantity / amount / order_id từ câu nói."""
+    return _DEFAULT_PARSER.extract_entities(text)
+
+
+def parse_vietnamese_number(text: str) -> Optional[Any]:
+    """Trả về giá trị cụm số đầu tiên trong câu (None nếu không có)."""
+    matches = _DEFAULT_PARSER.parse_numbers(text)
+    return matches[0].value if matches else None
@@ -1,29 +1,163 @@
+// static/audio-processor.js
+// AudioWorklet: mic (sampleRate của AudioContext, thường 48 kHz) → PCM gửi backend.
+//
+// processorOptions:
+//   emitPcm        : true  → gửi frame PCM qua port (chế độ input "pcm"); false → chỉ passthrough
+//   targetRate     : 16000 → lọc thông thấp + hạ mẫu ngay trong worklet
+//   frameMs        : 20    → gom thành frame 20–40 ms thay vì mỗi render quantum 128 mẫu
+//   gateDbfs       : -50   → frame dưới ngưỡng năng lượng coi là im lặng, không gửi
+//   hangoverMs     : 300   → vẫn gửi thêm sau frame có tiếng cuối cùng (không cắt đuôi từ)
+//   prerollMs      : 100   → khi mở gate gửi kèm vài frame trước đó (không mất âm đầu)
+//   heartbeatMs    : 100   → đang lọc: gửi frame chỉ có header để backend lấp im lặng (VAD tách lượt);
+//                            seq của heartbeat là frame vừa rời pre-roll → không vượt frame pre-roll
+//
+// Mỗi message: [seq uint32 LE][PCM int16 LE mono targetRate] — xem ai_modules/pcm_ingest.py.
+// seq tăng cho mọi frame tạo ra (kể cả frame bị lọc) → backend biết độ dài khoảng lặng.
+
+const HEADER_BYTES = 4;
+const FIR_TAPS_PER_RATIO = 8;
+
+// Bộ lọc FIR windowed-sinc (Hamming) chống alias trước khi hạ mẫu
+function designLowpass(ratio) {
+  const taps = ratio * FIR_TAPS_PER_RATIO + 1;
+  const cutoff = 0.45 / ratio;           // tần số cắt (chuẩn hoá theo sampleRate đầu vào)
+  const mid = (taps - 1) / 2;
+  const h = new Float32Array(taps);
+  let sum = 0;
+  for (let i = 0; i < taps; i++) {
+    const x = i - mid;
+    const sinc = x === 0 ? 2 * cutoff : Math.sin(2 * Math.PI * cutoff * x) / (Math.PI * x);
+    h[i] = sinc * (0.54 - 0.46 * Math.cos((2 * Math.PI * i) / (taps - 1)));
+    sum += h[i];
+  }
+  for (let i = 0; i < taps; i++) h[i] /= sum;
+  return h;
+}
+
 class PCMProcessor extends AudioWorkletProcessor {
-    constructor() {
-        super();
-        this.port.onmessage = (event) => {};
+  constructor(options) {
+    super();
+    const opts = (options && options.processorOptions) || {};
+    this.emitPcm = opts.emitPcm !== false;
+    this.targetRate = opts.targetRate || 16000;
+    this.ratio = Math.max(1, Math.round(sampleRate / this.targetRate));
+    const frameMs = Math.min(40, Math.max(20, opts.frameMs || 20));
+    this.frameSamples = Math.round((this.targetRate * frameMs) / 1000);
+
+    this.gateThreshold = Math.pow(10, (opts.gateDbfs !== undefined ? opts.gateDbfs : -50) / 20);
+    this.hangoverFrames = Math.ceil((opts.hangoverMs !== undefined ? opts.hangoverMs : 300) / frameMs);
+    this.prerollFrames = Math.ceil((opts.prerollMs !== undefined ? opts.prerollMs : 100) / frameMs);
+    this.heartbeatFrames = Math.max(1, Math.round((opts.heartbeatMs || 100) / frameMs));
+
+    // Lọc + hạ mẫu: vòng đệm lịch sử cho FIR, chỉ tính 1 mẫu ra mỗi `ratio` mẫu vào
+    this.fir = this.ratio > 1 ? designLowpass(this.ratio) : null;
+    this.history = new Float32Array(this.fir ? this.fir.length : 1);
+    this.historyPos = 0;
+    this.phase = 0;
+
+    this.frame = new Float32Array(this.frameSamples);
+    this.fill = 0;
+    this.seq = 0;
+    this.hangover = 0;
+    this.sinceSent = 0;
+    this.preroll = [];        // [{ seq, buffer }] frame bị lọc gần nhất
+    this.silentSeq = -1;      // frame im lặng mới nhất đã rời pre-roll, chưa báo backend
+
+    this.port.onmessage = (event) => {};
+  }
+
+  // Mẫu đầu ra (targetRate) tiếp theo, hoặc null nếu chưa đủ mẫu vào
+  _downsample(sample) {
+    if (!this.fir) return sample;
+    const h = this.fir;
+    const n = h.length;
+    this.history[this.historyPos] = sample;
+    this.historyPos = (this.historyPos + 1) % n;
+    if (++this.phase < this.ratio) return null;
+    this.phase = 0;
+    let acc = 0;
+    let idx = this.historyPos;
+    for (let i = 0; i < n; i++) {
+      acc += h[i] * this.history[idx];
+      if (++idx === n) idx = 0;
+    }
+    return acc;
+  }
+
+  _pack(frame, seq) {
+    const buffer = new ArrayBuffer(HEADER_BYTES + (frame ? frame.length * 2 : 0));
+    const view = new DataView(buffer);
+    view.setUint32(0, seq, true);
+    if (frame) {
+      for (let i = 0; i < frame.length; i++) {
+        const s = Math.max(-1, Math.min(1, frame[i]));
+        view.setInt16(HEADER_BYTES + i * 2, s * 0x7fff, true);
+      }
     }
+    return buffer;
+  }
 
-    process(inputs, outputs, parameters) {
-        const input = inputs[0];
+  _send(buffer) {
+    this.port.postMessage(buffer, [buffer]);
+    this.sinceSent = 0;
+  }
 
-        if (input && input[0]) {
-            const floatSamples = input[0];
+  // Energy gate + hangover: chỉ gửi frame có tiếng (và đuôi hangover)
+  _emitFrame() {
+    const frame = this.frame;
+    let energy = 0;
+    for (let i = 0; i < frame.length; i++) energy += frame[i] * frame[i];
+    const rms = Math.sqrt(energy / frame.length);
+    const seq = this.seq++;
 
-            // Chuyển float32 → int16 để backend dễ xử lý
-            const buffer = new ArrayBuffer(floatSamples.length * 2);
-            const view = new DataView(buffer);
+    if (rms >= this.gateThreshold) {
+      this.hangover = this.hangoverFrames;
+    } else if (this.hangover > 0) {
+      this.hangover--;
+    } else {
+      // Đang lọc: giữ pre-roll, thỉnh thoảng gửi heartbeat (header, không PCM)
+      this.preroll.push({ seq, buffer: this._pack(frame, seq) });
+      if (this.preroll.length > this.prerollFrames) this.silentSeq = this.preroll.shift().seq;
+      if (++this.sinceSent >= this.heartbeatFrames && this.silentSeq >= 0) {
+        this._send(this._pack(null, this.silentSeq));
+        this.silentSeq = -1;
+      }
+      return;
+    }
 
-            for (let i = 0; i < floatSamples.length; i++) {
-                let s = Math.max(-1, Math.min(1, floatSamples[i]));
-                view.setInt16(i * 2, s * 0x7fff, true);
-            }
+    for (const item of this.preroll) this._send(item.buffer);
+    this.preroll.length = 0;
+    this.silentSeq = -1;
+    this._send(this._pack(frame, seq));
+  }
 
-            this.port.postMessage(buffer, [buffer]);
+  process(inputs, outputs, parameters) {
+    const input = inputs[0];
+    const output = outputs[0];
+
+    if (input && input[0]) {
+      // Passthrough cho media track (chế độ input "track")
+      if (output) {
+        for (let ch = 0; ch < output.length; ch++) {
+          output[ch].set(input[Math.min(ch, input.length - 1)]);
         }
+      }
+      if (!this.emitPcm) return true;
 
-        return true;
+      const samples = input[0];
+      for (let i = 0; i < samples.length; i++) {
+        const y = this._downsample(samples[i]);
+        if (y === null) continue;
+        this.frame[this.fill++] = y;
+        if (this.fill === this.frameSamples) {
+          this._emitFrame();
+          this.fill = 0;
+        }
+      }
     }
+
+    return true;
+  }
 }
 
 registerProcessor("pcm-processor", PCMProcessor);